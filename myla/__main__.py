@@ -39,6 +39,11 @@ def runserver(args):
     elif 'DATA_DIR' in os.environ:
         os.environ['VECTORSTORE_DIR'] = os.path.join(os.environ['DATA_DIR'], 'vectorstore')
 
+    if args.workers > 1:
+        # Runs may be submitted, executed and streamed by different workers
+        os.environ.setdefault('RUN_QUEUE', 'database')
+        os.environ.setdefault('RUN_STREAM_BUS', 'file')
+
     if args.webui:
         os.environ['WEBUI'] = args.webui
         register_webui(args.webui)
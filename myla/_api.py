@@ -1,4 +1,3 @@
-import asyncio
 import json
 import os
 from datetime import datetime
@@ -12,9 +11,16 @@ from starlette.authentication import requires
 
 from . import (_tools, assistants, files, llms, messages, permissions, runs,
                threads, tools, users, utils)
+from ._auth_cache import AuthCache
+from ._executors import metrics as executors_metrics
+from ._executors import run_in_executor
 from ._logging import logger
 from ._models import DeletionStatus, ListModel
-from ._run_scheduler import RunScheduler
+from ._object_cache import ObjectCache
+from ._response_cache import ResponseCache
+from ._run_scheduler import RunQueueFull, RunScheduler
+from .llms.retry import default_policy as default_retry_policy
+from .persistence import Persistence
 from .vectorstores import load_vectorstore_from_file
 
 API_VERSION = "v1"
@@ -124,6 +130,21 @@ async def list_models(request: Request):
         'data': list(llms.list_models().values())
     }
 
+
+@api.get("/v1/metrics", tags=['System'])
+@requires(['authenticated'])
+async def get_metrics(request: Request):
+    check_sa(request.user.id)
+    return {
+        'scheduler': await RunScheduler.default().metrics(),
+        'llm_retry': default_retry_policy().stats(),
+        'response_cache': ResponseCache.default().metrics(),
+        'object_cache': ObjectCache.default().metrics(),
+        'auth_cache': AuthCache.default().metrics(),
+        'executors': executors_metrics(),
+        'database': Persistence.default().metrics()
+    }
+
 # Assistants
 
 
@@ -184,8 +205,8 @@ async def list_assistants(request: Request, limit: int = 20, order: str = "desc"
 # Threads
 
 
-def check_thread_permission(thread_id, request, permission):
-    t = threads.get(id=thread_id)
+async def check_thread_permission(thread_id, request, permission):
+    t = await threads.aget(id=thread_id)
     if not t:
         raise HTTPException(status_code=404, detail="Thread not found")
 
@@ -208,7 +229,7 @@ async def create_thread(thread: threads.ThreadCreate, request: Request, tag: Opt
 @ api.get("/v1/threads/{thread_id}", response_model=threads.ThreadRead, tags=['Threads'])
 @ requires(['authenticated'])
 async def retrieve_thread(thread_id: str, request: Request):
-    t = check_thread_permission(thread_id, request, "read")
+    t = await check_thread_permission(thread_id, request, "read")
 
     return t
 
@@ -216,18 +237,18 @@ async def retrieve_thread(thread_id: str, request: Request):
 @ api.post("/v1/threads/{thread_id}", response_model=threads.ThreadRead, tags=['Threads'])
 @ requires(['authenticated'])
 async def modify_thread(thread_id: str, thread: threads.ThreadModify, request: Request):
-    check_thread_permission(thread_id, request, "write")
+    await check_thread_permission(thread_id, request, "write")
 
-    return threads.modify(id=thread_id, thread=thread)
+    return await threads.amodify(id=thread_id, thread=thread)
 
 
 @ api.delete("/v1/threads/{thread_id}", tags=['Threads'])
 @ requires(['authenticated'])
 async def delete_thread(thread_id: str, request: Request):
-    t = threads.get(thread_id)
+    t = await threads.aget(thread_id)
     if t is not None:
         check_object_permission(t, request, "write")
-    return threads.delete(id=thread_id, mode=_delete_mode())
+    return await threads.adelete(id=thread_id, mode=_delete_mode())
 
 
 @ api.get("/v1/threads", response_model=threads.ThreadList, tags=['Threads'])
@@ -252,18 +273,18 @@ async def list_threads(
 @ api.post("/v1/threads/{thread_id}/messages", response_model=messages.MessageRead, tags=['Messages'])
 @ requires(['authenticated'])
 async def create_message(thread_id: str, message: messages.MessageCreate, request: Request, tag: Optional[str] = None):
-    t = check_thread_permission(thread_id, request, "write")
+    t = await check_thread_permission(thread_id, request, "write")
 
-    r = messages.create(thread_id=thread_id, message=message, tag=tag, user_id=request.user.id, org_id=t.org_id)
+    r = await messages.acreate(thread_id=thread_id, message=message, tag=tag, user_id=request.user.id, org_id=t.org_id)
     return r
 
 
 @ api.get("/v1/threads/{thread_id}/messages/{message_id}", response_model=messages.MessageRead, tags=['Messages'])
 @ requires(['authenticated'])
 async def retrieve_message(thread_id: str, message_id: str, request: Request):
-    check_thread_permission(thread_id, request, "read")
+    await check_thread_permission(thread_id, request, "read")
 
-    m = messages.get(id=message_id, thread_id=thread_id)
+    m = await messages.aget(id=message_id, thread_id=thread_id)
     if not m:
         raise HTTPException(status_code=404, detail="Message not found")
 
@@ -275,26 +296,26 @@ async def retrieve_message(thread_id: str, message_id: str, request: Request):
 @ api.post("/v1/threads/{thread_id}/messages/{message_id}", response_model=messages.MessageRead, tags=['Messages'])
 @ requires(['authenticated'])
 async def modify_message(thread_id: str, message_id: str, message: messages.MessageModify, request: Request):
-    check_thread_permission(thread_id, request, "write")
+    await check_thread_permission(thread_id, request, "write")
 
-    m = messages.get(id=message_id, thread_id=thread_id)
+    m = await messages.aget(id=message_id, thread_id=thread_id)
     if not m:
         raise HTTPException(status_code=404, detail="Message not found")
 
     check_object_permission(m, request, "write")
 
-    return messages.modify(id=message_id, message=message, thread_id=thread_id)
+    return await messages.amodify(id=message_id, message=message, thread_id=thread_id)
 
 
 @ api.delete("/v1/threads/{thread_id}/messages/{message_id}", tags=['Messages'])
 async def delete_message(thread_id: str, message_id: str, request: Request):
-    check_thread_permission(thread_id, request, "write")
+    await check_thread_permission(thread_id, request, "write")
 
-    m = messages.get(id=message_id, thread_id=thread_id)
+    m = await messages.aget(id=message_id, thread_id=thread_id)
     if m is not None:
         check_object_permission(m, request, "write")
 
-    return messages.delete(id=message_id, thread_id=thread_id, user_id=request.user.id, mode=_delete_mode())
+    return await messages.adelete(id=message_id, thread_id=thread_id, user_id=request.user.id, mode=_delete_mode())
 
 
 @ api.get("/v1/threads/{thread_id}/messages", response_model=messages.MessageList, tags=['Messages'])
@@ -308,9 +329,9 @@ async def list_messages(
     before: Optional[str] = None,
     tag: Optional[str] = None
 ):
-    check_thread_permission(thread_id, request, "read")
+    await check_thread_permission(thread_id, request, "read")
 
-    return messages.list(
+    return await messages.alist(
         thread_id=thread_id,
         tag=tag,
         limit=limit,
@@ -324,24 +345,42 @@ async def list_messages(
 
 @api.post("/v1/threads/{thread_id}/runs", tags=['Runs'])
 @requires(['authenticated'])
-async def create_run(request: Request, thread_id: str, run: runs.RunCreate, stream: bool = False, timeout: int = 30):
-    t = check_thread_permission(thread_id, request, "write")
+async def create_run(request: Request, thread_id: str, run: runs.RunCreate, stream: bool = False):
+    t = await check_thread_permission(thread_id, request, "write")
+
+    scheduler = RunScheduler.default()
+    if await scheduler.is_full():
+        raise HTTPException(status_code=429, detail="Too many runs queued, please retry later.")
 
     if stream:
         if run.metadata is None:
             run.metadata = {}
         run.metadata["stream"] = True
 
-    r = runs.create(thread_id=thread_id, run=run, user_id=request.user.id, org_id=t.org_id)
+    # The deadline is stored with the run, a shared queue can claim it as soon as it is inserted
+    timeout = await scheduler.resolve_timeout(run)
+    r = await runs.acreate(thread_id=thread_id, run=run, user_id=request.user.id, org_id=t.org_id, timeout=timeout)
 
     # Submit run to run
     if r.metadata is None:
         r.metadata = {}
     # r.metadata["user_id"] = request.user.id
-    RunScheduler.default().submit_run(r)
+    try:
+        await scheduler.submit_run(r)
+    except RunQueueFull as e:
+        await runs.aupdate(
+            id=r.id,
+            status="failed",
+            last_error={
+                "code": "rate_limit_exceeded",
+                "message": str(e)
+            },
+            failed_at=int(round(datetime.now().timestamp()))
+        )
+        raise HTTPException(status_code=429, detail="Too many runs queued, please retry later.")
 
     if stream:
-        r = await create_run_stream(thread_id=thread_id, run_id=r.id, timeout=timeout)
+        r = await create_run_stream(thread_id=thread_id, run_id=r.id)
 
     return r
 
@@ -349,9 +388,9 @@ async def create_run(request: Request, thread_id: str, run: runs.RunCreate, stre
 @api.get("/v1/threads/{thread_id}/runs/{run_id}", response_model=runs.RunRead, tags=['Runs'])
 @requires(['authenticated'])
 async def retrieve_run(thread_id: str, run_id: str, request: Request):
-    check_thread_permission(thread_id, request, "read")
+    await check_thread_permission(thread_id, request, "read")
 
-    r = runs.get(thread_id=thread_id, run_id=run_id)
+    r = await runs.aget(thread_id=thread_id, run_id=run_id)
     if not r:
         raise HTTPException(status_code=404, detail="Run not found")
     return r
@@ -361,38 +400,53 @@ async def retrieve_run(thread_id: str, run_id: str, request: Request):
 @requires(['authenticated'])
 async def modify_run(thread_id: str, run_id: str, run: runs.RunModify, request: Request):
     # TODO: check files permissions
-    check_thread_permission(thread_id, request, "write")
+    await check_thread_permission(thread_id, request, "write")
 
-    r = runs.get(thread_id=thread_id, run_id=run_id)
+    r = await runs.aget(thread_id=thread_id, run_id=run_id)
     if not r:
         raise HTTPException(status_code=404, detail="Run not found")
 
-    return runs.modify(id=run_id, run=run)
+    return await runs.amodify(id=run_id, run=run)
 
 
 @api.delete("/v1/threads/{thread_id}/runs/{run_id}", tags=['Runs'])
 @requires(['authenticated'])
 async def delete_run(thread_id: str, run_id: str, request: Request):
-    check_thread_permission(thread_id, request, "write")
-    r = runs.get(thread_id=thread_id, run_id=run_id)
+    await check_thread_permission(thread_id, request, "write")
+    r = await runs.aget(thread_id=thread_id, run_id=run_id)
     if r is not None:
         check_object_permission(r, request, "write")
 
-    return runs.delete(id=run_id, mode=_delete_mode())
+    return await runs.adelete(id=run_id, mode=_delete_mode())
 
 
 @api.get("/v1/threads/{thread_id}/runs", response_model=runs.RunList, tags=['Runs'])
 @requires(['authenticated'])
 async def list_runs(request: Request, thread_id: str, limit: int = 20, order: str = "desc", after: str = None, before: str = None):
-    check_thread_permission(thread_id, request, "read")
-    return runs.list(thread_id=thread_id, limit=limit, order=order, after=after, before=before, user_id=request.user.id)
+    await check_thread_permission(thread_id, request, "read")
+    return await runs.alist(thread_id=thread_id, limit=limit, order=order, after=after, before=before, user_id=request.user.id)
 
 
 @api.post("/v1/threads/{thread_id}/runs/{run_id}/cancel", response_model=runs.RunRead, tags=['Runs'])
 @requires(['authenticated'])
 async def cancel_run(thread_id: str, run_id: str, request: Request):
-    # TODO: check permissions
-    return runs.cancel(thread_id=thread_id, run_id=run_id)
+    await check_thread_permission(thread_id, request, "write")
+
+    r = await runs.aget(thread_id=thread_id, run_id=run_id)
+    if not r:
+        raise HTTPException(status_code=404, detail="Run not found")
+    check_object_permission(r, request, "write")
+
+    if r.status not in ("queued", "in_progress"):
+        raise HTTPException(status_code=400, detail=f"Cannot cancel run with status '{r.status}'.")
+
+    r = await runs.acancel(thread_id=thread_id, run_id=run_id)
+    if r.status == "cancelled":
+        # Cancelled while queued, no scheduler executes it to close its stream
+        await RunScheduler.default().close_cancelled(run_id)
+    # Runs executed by other workers are cancelled when their scheduler sees the cancelling status
+    await RunScheduler.default().cancel_run(run_id)
+    return r
 
 
 @api.post("/v1/threads/runs", response_model=runs.RunRead, tags=['Runs'])
@@ -416,32 +470,38 @@ async def list_run_steps(thread_id: str, run_id: str, request: Request):
     return runs.list_steps(thread_id=thread_id, run_id=run_id)
 
 
-async def create_run_stream(thread_id: str, run_id: str, timeout=30):
-    # waiting for scheduler
-    begin = datetime.now().timestamp()
-    while True:
-        iter = await RunScheduler.default().get_run_iter(run_id=run_id)
-        if not iter and datetime.now().timestamp() < begin + timeout:
-            await asyncio.sleep(1)
-            continue
-        else:
-            break
+@api.get("/v1/threads/{thread_id}/runs/{run_id}/stream", tags=['Runs'])
+@requires(['authenticated'])
+async def stream_run(thread_id: str, run_id: str, request: Request):
+    """Tail the stream of a run, reconnecting clients resume after the Last-Event-ID header."""
+    await check_thread_permission(thread_id, request, "read")
+
+    r = await runs.aget(thread_id=thread_id, run_id=run_id)
+    if not r:
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    return await create_run_stream(thread_id=thread_id, run_id=run_id, last_event_id=request.headers.get("Last-Event-ID"))
+
+
+async def create_run_stream(thread_id: str, run_id: str, last_event_id: Optional[str] = None):
+    # The stream is registered when the run is submitted
+    iter = await RunScheduler.default().get_run_iter(run_id=run_id, after=last_event_id)
 
     async def aiter():
         if not iter:
-            logger.debug(f"Scheduler timeout: thread_id={thread_id}, run_id={run_id}")
-            yield "event: error\ndata: %s\n\n" % json.dumps({"e": "Timeout."})
+            logger.debug(f"Run stream not found: thread_id={thread_id}, run_id={run_id}")
+            yield "event: error\ndata: %s\n\n" % json.dumps({"e": "Run stream not found."})
             return
 
-        async for c in iter:
+        async for id, c in iter:
             if isinstance(c, str):
                 e = {
                     "c": c
                 }
-                yield "event: message\ndata: %s\n\n" % json.dumps(e)
+                yield "id: %s\nevent: message\ndata: %s\n\n" % (id, json.dumps(e))
             elif isinstance(c, Exception):
-                yield "event: error\ndata: %s\n\n" % json.dumps({"e": str(c)})
-    return StreamingResponse(aiter(), headers={'Content-Type': "text/event-stream"})
+                yield "id: %s\nevent: error\ndata: %s\n\n" % (id, json.dumps({"e": str(c)}))
+    return StreamingResponse(aiter(), headers={'Content-Type': "text/event-stream", 'X-Run-Id': run_id})
 
 # Tools
 
@@ -540,7 +600,7 @@ async def upload_file(request: Request, file: UploadFile):
                     instruction=metadata.get('instruction'),
                     metadata=metadata
                 )
-            await asyncio.get_running_loop().run_in_executor(None, _load_vs)
+            await run_in_executor("ingestion", _load_vs)
         except Exception as e:
             logger.warn(f"Build vectorstore failed:", exc_info=e)
             raise HTTPException(status_code=400, detail=f"Can't build vectorstore. {e}")
@@ -4,6 +4,7 @@ from starlette.authentication import (AuthCredentials, AuthenticationBackend,
                                       SimpleUser)
 
 from . import users
+from ._auth_cache import AuthCache
 
 
 class AuthenticatedUser(SimpleUser):
@@ -31,8 +32,13 @@ class BasicAuthBackend(AuthenticationBackend):
             secret_key = request.cookies.get('secret_key')
 
         if secret_key:
-            sk = users.get_secret_key(id=secret_key)
-            if sk:
+            cache = AuthCache.default()
+            identity = cache.get(secret_key)
+            if identity is None:
+                version = cache.version()
+                sk = users.get_secret_key(id=secret_key)
+                if not sk:
+                    return None
                 orgs = users.list_orgs(user_id=sk.user_id).data
 
                 org_map = {}
@@ -42,9 +48,13 @@ class BasicAuthBackend(AuthenticationBackend):
                     if org.user_id == sk.user_id:
                         primary_org_id = org.id
 
-                auser = AuthenticatedUser(id=sk.user_id, orgs=org_map, primary_org_id=primary_org_id)
+                identity = (sk.user_id, org_map, primary_org_id)
+                cache.put(secret_key, *identity, version=version)
 
-                scopes = ["authenticated"]
-                credentials = AuthCredentials(scopes=scopes)
+            user_id, org_map, primary_org_id = identity
+            auser = AuthenticatedUser(id=user_id, orgs=org_map, primary_org_id=primary_org_id)
 
-                return credentials, auser
+            scopes = ["authenticated"]
+            credentials = AuthCredentials(scopes=scopes)
+
+            return credentials, auser
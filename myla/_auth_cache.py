@@ -0,0 +1,57 @@
+import os
+from typing import Dict, Optional, Tuple
+
+from ._env import env_int
+from ._ttl_cache import TTLCache
+
+
+class AuthCache:
+    """Caches the identity of the secret keys: the user, its organizations and primary organization.
+
+    At most AUTH_CACHE_SIZE keys are kept for AUTH_CACHE_TTL seconds, least recently used first
+    evicted, a size of 0 disables the cache. Keys are invalidated when they are deleted, and all the
+    keys of a user when the user is deleted or its memberships change in this process. Other
+    processes see the changes once their entries expire.
+
+    Unknown keys are not cached.
+    """
+    _instance = None
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30) -> None:
+        # secret_key -> (user_id, org_map, primary_org_id)
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @staticmethod
+    def default():
+        if not AuthCache._instance:
+            AuthCache._instance = AuthCache(
+                max_size=env_int("AUTH_CACHE_SIZE", 1024),
+                ttl=float(os.environ.get("AUTH_CACHE_TTL", 30))
+            )
+        return AuthCache._instance
+
+    def version(self) -> int:
+        """Taken before reading an identity from database, and passed to `put`."""
+        return self._cache.version()
+
+    def get(self, secret_key: str) -> Optional[Tuple[str, Dict, Optional[str]]]:
+        """Returns (user_id, org_map, primary_org_id) of the key, None on miss."""
+        identity = self._cache.get(secret_key)
+        if identity is None:
+            return None
+        return identity[0], dict(identity[1]), identity[2]
+
+    def put(self, secret_key: str, user_id: str, org_map: Dict, primary_org_id: Optional[str], version: int):
+        self._cache.put(secret_key, (user_id, dict(org_map), primary_org_id), version)
+
+    def invalidate_key(self, secret_key: str):
+        self._cache.invalidate(secret_key)
+
+    def invalidate_user(self, user_id: str):
+        self._cache.invalidate_values(lambda identity: identity[0] == user_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def metrics(self) -> Dict:
+        return self._cache.metrics()
@@ -11,6 +11,7 @@ from contextlib import asynccontextmanager
 
 from .persistence import Persistence
 from ._run_scheduler import RunScheduler
+from ._object_cache import ObjectCache
 from . import _tools
 from . import _env
 from ._api import api
@@ -53,7 +54,11 @@ async def lifespan(app: Starlette):
         if sa:
             logger.warn(f"Super admin user created: {sa.username}")
 
-        # Start RunScheduler
+        # Listen to the object cache invalidations of the other workers
+        ObjectCache.default().start()
+
+        # Recover the runs of the previous process and start RunScheduler
+        await RunScheduler.default().recover()
         RunScheduler.default().start()
 
     except Exception as e:
@@ -61,7 +66,7 @@ async def lifespan(app: Starlette):
     finally:
         yield
         # on shutdown
-        pass
+        await Persistence.default().dispose()
 
 # Routes
 routes = [
@@ -1,8 +1,30 @@
+import json
 import os
 
+from ._logging import logger
+
 _here = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 
 
 def webui_dir():
     "Returns the directory where webuid resources ared stored."
     return os.path.join(_here, 'webui')
+
+
+def env_int(name: str, default: int = 0) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warn(f"Invalid {name}: {os.environ.get(name)}, use {default}")
+        return default
+
+
+def env_json(name: str, default=None):
+    v = os.environ.get(name)
+    if not v:
+        return default
+    try:
+        return json.loads(v)
+    except ValueError:
+        logger.warn(f"Invalid {name}: {v}")
+        return default
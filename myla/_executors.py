@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict
+
+from ._env import env_json
+
+# Workers of the named executors, overridden by EXECUTOR_WORKERS
+DEFAULT_WORKERS = {
+    "tools": 16,        # sync tools of runs
+    "search": 8,        # vectorstore searches
+    "embedding": 4,     # embeddings of queries
+    "ingestion": 2,     # vectorstores built from uploaded files
+}
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor counting its queued and running tasks."""
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"myla-{name}")
+        self.name = name
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.monotonic()
+        with self._lock:
+            self._queued += 1
+
+        def _run():
+            wait_time = time.monotonic() - submitted_at
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        return super().submit(_run)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "max_workers": self._max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "wait_time_avg": self._wait_time_total / started if started > 0 else 0.0,
+                "wait_time_max": self._wait_time_max,
+            }
+
+
+_executors: Dict[str, InstrumentedExecutor] = {}
+_lock = threading.Lock()
+
+
+def get_executor(name: str) -> InstrumentedExecutor:
+    """Returns the named executor, sized by EXECUTOR_WORKERS (a JSON object of name to workers)."""
+    executor = _executors.get(name)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(name)
+            if executor is None:
+                workers = env_json("EXECUTOR_WORKERS", {})
+                max_workers = workers.get(name, DEFAULT_WORKERS.get(name, 4))
+                executor = InstrumentedExecutor(name=name, max_workers=max_workers)
+                _executors[name] = executor
+    return executor
+
+
+async def run_in_executor(name: str, fn, *args, **kwargs):
+    """Run fn in the named executor."""
+    return await asyncio.get_running_loop().run_in_executor(get_executor(name), partial(fn, *args, **kwargs))
+
+
+def metrics() -> Dict:
+    return {name: executor.metrics() for name, executor in _executors.items()}
@@ -1,20 +1,31 @@
 import asyncio
+import copy
 import datetime
+import difflib
 import inspect
+import json
 import os
-from typing import Optional
+from typing import List, Optional
 
 from . import assistants, llms, runs, threads
+from ._env import env_int, env_json
+from ._executors import run_in_executor
 from ._logging import logger as log
+from ._response_cache import ResponseCache
 from ._tools import get_tool
 from .llms import Usage
+from .llms.tokens import count_message_tokens, count_messages_tokens, count_tokens
 from .messages import MessageCreate
-from .messages import create as create_message
-from .messages import list as list_messages
+from .messages import acreate as create_message
+from .messages import alist as list_messages
+from .messages import alist_by_tokens as list_messages_by_tokens
+from .persistence import Persistence
 from .tools import Context, Tool
 
 
 async def chat_complete(run: runs.RunRead, iter):
+    # One async session for the run, its transactions are committed before the tools and LLM are called
+    session = Persistence.default().create_async_session()
     try:
         thread_id = run.thread_id
 
@@ -27,7 +38,7 @@ async def chat_complete(run: runs.RunRead, iter):
         file_ids = []
 
         # Get Assistant
-        assistant = assistants.get(id=run.assistant_id)
+        assistant = await assistants.aget(id=run.assistant_id, session=session)
         assistant_id = None
         if assistant is not None:
             assistant_id = assistant.id
@@ -47,7 +58,7 @@ async def chat_complete(run: runs.RunRead, iter):
                 file_ids.extend(assistant.file_ids)
 
         # Get Thread
-        thread = threads.get(id=thread_id)
+        thread = await threads.aget(id=thread_id, session=session)
 
         # set instructions
         if instructions is not None and len(instructions) > 0:
@@ -60,11 +71,21 @@ async def chat_complete(run: runs.RunRead, iter):
         llm_args = run_metadata['llm_args'] if 'llm_args' in run_metadata else {"temperature": 0.0}
 
         # Laod history
-        history_limit = run_metadata['history_limit'] if 'history_limit' in run_metadata else 7
+        prompt_budget = get_prompt_budget(model=model, run_metadata=run_metadata, llm_args=llm_args)
+        history_limit = run_metadata['history_limit'] if 'history_limit' in run_metadata else (50 if prompt_budget else 7)
         if not isinstance(history_limit, int):
             history_limit = 0
-        history = list_messages(thread_id=thread_id, order="desc", limit=history_limit).data
-        history = history[::-1]
+        if prompt_budget:
+            history = await list_messages_by_tokens(
+                thread_id=thread_id,
+                max_tokens=prompt_budget - count_messages_tokens(messages),
+                limit=history_limit,
+                session=session,
+                auto_commit=False
+            )
+        else:
+            history = (await list_messages(thread_id=thread_id, order="desc", limit=history_limit, session=session)).data
+            history = history[::-1]
 
         # append history to messages
         for h in history:
@@ -88,10 +109,12 @@ async def chat_complete(run: runs.RunRead, iter):
 
         file_ids = list(set(file_ids))
 
-        runs.update(
+        # The token counts backfilled while loading the history are committed with the in_progress update
+        await runs.aupdate(
             id=run.id,
             status="in_progress",
-            started_at=int(round(datetime.datetime.now().timestamp()))
+            started_at=int(round(datetime.datetime.now().timestamp())),
+            session=session
         )
 
         stream = False
@@ -128,19 +151,34 @@ async def chat_complete(run: runs.RunRead, iter):
             genereated.append(completed_msg)
             await iter.put(completed_msg)
         else:
+            if prompt_budget:
+                context.messages = fit_messages(messages=context.messages, max_tokens=prompt_budget)
             combined_messages = combine_system_messages(messages=context.messages)
-            llm = llms.get(model_name=model)
 
-            resp = await llm.chat(messages=combined_messages, stream=stream, usage=usage, **llm_args)
+            cache = ResponseCache.default()
+            if run_metadata.get("response_cache") is False:
+                cache = None
+            cached = await cache.get(model, combined_messages, llm_args) if cache else None
 
-            if stream:
-                async for c in resp:
-                    if c is not None:
-                        genereated.append(c)
-                        await iter.put(c)
-                        await asyncio.sleep(0) # back to envent loop for iter.get
+            if cached is not None:
+                genereated.append(cached)
+                await iter.put(cached)
             else:
-                genereated.append(resp)
+                llm = llms.get(model_name=model)
+
+                resp = await llm.chat(messages=combined_messages, stream=stream, usage=usage, **llm_args)
+
+                if stream:
+                    async for c in resp:
+                        if c is not None:
+                            genereated.append(c)
+                            await iter.put(c)
+                            await asyncio.sleep(0) # back to envent loop for iter.get
+                else:
+                    genereated.append(resp)
+
+                if cache:
+                    await cache.put(model, combined_messages, llm_args, ''.join(genereated))
 
         msg_metadata = context.message_metadata
         msg_metadata["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
@@ -150,27 +188,34 @@ async def chat_complete(run: runs.RunRead, iter):
             content=''.join(genereated),
             metadata=msg_metadata
         )
-        create_message(thread_id=thread_id, message=msg_create, assistant_id=assistant_id, run_id=run.id, user_id=run.user_id, org_id=run.org_id)
-
-        runs.update(
+        # The message and the run completion are committed in one transaction
+        await create_message(thread_id=thread_id, message=msg_create, assistant_id=assistant_id, run_id=run.id, user_id=run.user_id, org_id=run.org_id, session=session, auto_commit=False)
+        await runs.aupdate(
             id=run.id,
             status="completed",
-            completed_at=int(round(datetime.datetime.now().timestamp()))
+            completed_at=int(round(datetime.datetime.now().timestamp())),
+            session=session,
+            auto_commit=False
         )
+        await session.commit()
         await iter.put(None) # Completed
     except Exception as e:
         log.warn(f"LLM Failed: ", exc_info=e)
 
-        runs.update(id=run.id,
+        await session.rollback()
+        await runs.aupdate(id=run.id,
             status="failed",
             last_error={
                 "code": "server_error",
                 "message": str(e)
             },
-            failed_at=int(round(datetime.datetime.now().timestamp()))
+            failed_at=int(round(datetime.datetime.now().timestamp())),
+            session=session
         )
         await iter.put(e)
         await iter.put(None) #DONE
+    finally:
+        await session.close()
 
 
 async def run_tools(assistant, run, thread, tools, messages, run_metadata, file_ids=[]):
@@ -188,6 +233,8 @@ async def run_tools(assistant, run, thread, tools, messages, run_metadata, file_
     if not tools:
         tools = []
 
+    # Adjacent parallel tools are grouped in a phase and executed concurrently
+    phases = []
     for tool in tools:
         tool_name = tool["type"]
 
@@ -200,14 +247,19 @@ async def run_tools(assistant, run, thread, tools, messages, run_metadata, file_
             log.warn(f"tool instance is not a Tool: name={tool_name}, instance={tool_instance}")
             continue
 
-        if inspect.iscoroutinefunction(tool_instance.execute):
-            await tool_instance.execute(context=context)
+        parallel = tool.get("parallel", tool_instance.parallel)
+        if parallel and phases and phases[-1][0]:
+            phases[-1][1].append(tool_instance)
         else:
-            await asyncio.get_running_loop().run_in_executor(
-                None,
-                tool_instance.execute,
-                context
-            )
+            phases.append((parallel, [tool_instance]))
+
+    for _, phase in phases:
+        if len(phase) == 1:
+            await execute_tool(phase[0], context)
+        else:
+            forks = [fork_context(context) for _ in phase]
+            await asyncio.gather(*[execute_tool(t, f) for t, f in zip(phase, forks)])
+            context = merge_contexts(context, forks)
 
         if context.is_completed:
             return context
@@ -215,6 +267,63 @@ async def run_tools(assistant, run, thread, tools, messages, run_metadata, file_
     return context
 
 
+async def execute_tool(tool: Tool, context: Context):
+    if inspect.iscoroutinefunction(tool.execute):
+        await tool.execute(context=context)
+    else:
+        await run_in_executor("tools", tool.execute, context)
+
+
+def fork_context(context: Context) -> Context:
+    """Copy the context for a tool executed concurrently, the modifiable attributes are not shared."""
+    return context.model_copy(update={
+        "messages": copy.deepcopy(context.messages),
+        "llm_args": copy.deepcopy(context.llm_args),
+        "message_metadata": copy.deepcopy(context.message_metadata),
+        "file_ids": list(context.file_ids)
+    })
+
+
+def _message_key(message) -> str:
+    return json.dumps(message, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def merge_contexts(context: Context, forks: List[Context]) -> Context:
+    """Merge the contexts modified by concurrent tools, in the order the tools are declared.
+
+    Messages inserted by the tools are placed where they were inserted, in declaration order,
+    and messages removed or replaced by any tool are removed. llm_args and message_metadata are
+    updated in declaration order. If a tool completed the run, its context is used as is.
+    """
+    for f in forks:
+        if f.is_completed:
+            return f
+
+    keys = [_message_key(m) for m in context.messages]
+    inserts = [[] for _ in range(len(keys) + 1)]
+    removed = set()
+    for f in forks:
+        matcher = difflib.SequenceMatcher(None, keys, [_message_key(m) for m in f.messages], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag in ("replace", "delete"):
+                removed.update(range(i1, i2))
+            if tag in ("replace", "insert"):
+                inserts[i1].extend(f.messages[j1:j2])
+
+    messages = []
+    for i in range(len(keys) + 1):
+        messages.extend(inserts[i])
+        if i < len(keys) and i not in removed:
+            messages.append(context.messages[i])
+    context.messages = messages
+
+    for f in forks:
+        context.llm_args.update(f.llm_args)
+        context.message_metadata.update(f.message_metadata)
+        context.file_ids.extend(id for id in f.file_ids if id not in context.file_ids)
+    return context
+
+
 def combine_system_messages(messages):
     """Combine multiple system messages into one"""
     normal_messages = []
@@ -237,3 +346,67 @@ def combine_system_messages(messages):
         )
     r_messages.extend(normal_messages)
     return r_messages
+
+
+def get_prompt_budget(model, run_metadata, llm_args) -> Optional[int]:
+    """Max tokens of the prompt, None if no context window is set for the model.
+
+    The context window is the "context_window" of the run/assistant metadata, else the one of the
+    model in LLM_CONTEXT_WINDOWS ("*" for other models). The completion tokens are reserved:
+    max_tokens of llm_args, else LLM_COMPLETION_TOKENS.
+    """
+    context_window = run_metadata.get("context_window")
+    if not context_window:
+        windows = env_json("LLM_CONTEXT_WINDOWS", {})
+        model_name = model if model else os.environ.get("DEFAULT_LLM_MODEL_NAME")
+        context_window = windows.get(model_name, windows.get("*"))
+    if not context_window:
+        return None
+
+    completion_tokens = llm_args.get("max_tokens") or env_int("LLM_COMPLETION_TOKENS", 1024)
+    return max(int(context_window) - int(completion_tokens), 0)
+
+
+def _trim_docs(content: str, max_tokens: int) -> str:
+    """Drop the last retrieved docs, or truncate the text, to fit in max_tokens."""
+    try:
+        docs = json.loads(content)
+    except ValueError:
+        docs = None
+
+    if isinstance(docs, list):
+        while docs and count_tokens(json.dumps(docs, ensure_ascii=False)) > max_tokens:
+            docs.pop()
+        return json.dumps(docs, ensure_ascii=False)
+
+    tokens = count_tokens(content)
+    while content and tokens > max_tokens:
+        content = content[:int(len(content) * max_tokens / tokens)]
+        tokens = count_tokens(content)
+    return content
+
+
+def fit_messages(messages, max_tokens):
+    """Fit the messages in max_tokens: first trim the retrieved docs, then drop the oldest history."""
+    total = count_messages_tokens(messages)
+    if total <= max_tokens:
+        return messages
+
+    for msg in messages:
+        if total <= max_tokens:
+            break
+        if msg.get("type") == "docs":
+            before = count_message_tokens(msg)
+            msg["content"] = _trim_docs(msg["content"], max(count_tokens(msg["content"]) - (total - max_tokens), 0))
+            total -= before - count_message_tokens(msg)
+
+    i = 0
+    while total > max_tokens and i < len(messages) - 1:
+        if messages[i]["role"] != "system":
+            total -= count_message_tokens(messages.pop(i))
+        else:
+            i += 1
+
+    if total > max_tokens:
+        log.warn(f"Messages exceed the prompt budget: tokens={total}, max_tokens={max_tokens}")
+    return messages
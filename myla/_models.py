@@ -1,10 +1,14 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from pydantic import BaseModel
+from sqlalchemy import Index, tuple_
+from sqlalchemy.orm import aliased, declared_attr
 from sqlmodel import JSON, Field, Session, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from . import utils
+from ._object_cache import ObjectCache
 from .persistence import Persistence
 
 
@@ -35,11 +39,34 @@ class DBModel(SQLModel):
     deleted_at: Optional[int] = Field(default=None)
     tag: Optional[str] = Field(index=True, nullable=True, default=None)
 
+    @declared_attr
+    def __table_args__(cls):
+        # Keyset pagination
+        return (Index(f"ix_{cls.__tablename__}_created_at_id", "created_at", "id"), *cls.composite_indexes())
+
+    @classmethod
+    def composite_indexes(cls) -> Tuple[Index, ...]:
+        """Composite indexes of the queries specific to the table."""
+        return ()
+
     def to_read(self, read_cls: ReadModel) -> ReadModel:
-        """Convert to a ReadModel object."""
-        r = read_cls(**self.model_dump())
-        r.metadata = self.metadata_
-        return r
+        """Convert to a ReadModel object.
+
+        The columns are read from the loaded row and validated once, without dumping the row first.
+        """
+        fields = _read_fields.get((type(self), read_cls))
+        if fields is None:
+            fields = tuple(f for f in read_cls.model_fields if f != "metadata" and f in type(self).model_fields)
+            _read_fields[(type(self), read_cls)] = fields
+
+        loaded = self.__dict__
+        values = {f: loaded[f] if f in loaded else getattr(self, f) for f in fields}
+        values["metadata"] = self.metadata_
+        return read_cls.model_validate(values)
+
+
+# (DBModel class, ReadModel class) -> fields of the ReadModel read from the DBModel
+_read_fields: Dict[Tuple[type, type], Tuple[str, ...]] = {}
 
 
 class DeletionStatus(BaseModel):
@@ -72,17 +99,28 @@ def auto_session(func):
     return inner
 
 
-@auto_session
-def create(
+def auto_async_session(func):
+    """Ensure that an async session is available."""
+    async def inner(*args, **kwargs):
+        session_exists = kwargs.get('session') is not None
+        ss = kwargs['session'] if session_exists else Persistence.default().create_async_session()
+        try:
+            kwargs['session'] = ss
+            return await func(*args, **kwargs)
+        finally:
+            if not session_exists:
+                await ss.close()
+    return inner
+
+
+def _prepare(
     object: str,
     meta_model: MetadataModel,
     db_model: DBModel,
     id: Optional[str] = None,
     tag: Optional[str] = None,
     user_id: Optional[str] = None,
-    org_id: Optional[str] = None,
-    session: Session = None,
-    auto_commit=True
+    org_id: Optional[str] = None
 ):
     id = id if id else utils.random_id()
 
@@ -110,6 +148,22 @@ def create(
     db_model.metadata_ = meta_model.metadata
     db_model.user_id = user_id
     db_model.org_id = org_id
+    return db_model
+
+
+@auto_session
+def create(
+    object: str,
+    meta_model: MetadataModel,
+    db_model: DBModel,
+    id: Optional[str] = None,
+    tag: Optional[str] = None,
+    user_id: Optional[str] = None,
+    org_id: Optional[str] = None,
+    session: Session = None,
+    auto_commit=True
+):
+    db_model = _prepare(object=object, meta_model=meta_model, db_model=db_model, id=id, tag=tag, user_id=user_id, org_id=org_id)
 
     session.add(db_model)
     if auto_commit:
@@ -119,11 +173,67 @@ def create(
     return db_model
 
 
+@auto_async_session
+async def acreate(
+    object: str,
+    meta_model: MetadataModel,
+    db_model: DBModel,
+    id: Optional[str] = None,
+    tag: Optional[str] = None,
+    user_id: Optional[str] = None,
+    org_id: Optional[str] = None,
+    session: AsyncSession = None,
+    auto_commit=True
+):
+    db_model = _prepare(object=object, meta_model=meta_model, db_model=db_model, id=id, tag=tag, user_id=user_id, org_id=org_id)
+
+    session.add(db_model)
+    if auto_commit:
+        await session.commit()
+        await session.refresh(db_model)
+
+    return db_model
+
+
+def _readable(dbo: Optional[DBModel], user_id: Optional[str]) -> bool:
+    return dbo is not None and (not user_id or user_id == dbo.user_id) and not dbo.is_deleted
+
+
+def _cached(cache: Optional[ObjectCache], db_cls: DBModel, id: str):
+    """Returns the cached object of the id if any, and the cache version to put it."""
+    if cache is None:
+        return None, None
+    return cache.get(db_cls.__tablename__, id), cache.version()
+
+
+def _cache(cache: Optional[ObjectCache], db_cls: DBModel, dbo: Optional[DBModel], read_cls: ReadModel, version: Optional[int]):
+    if dbo is None or dbo.is_deleted:
+        return None
+    r = dbo.to_read(read_cls)
+    if cache is not None:
+        cache.put(db_cls.__tablename__, dbo.id, r, version=version)
+    return r
+
+
+def _owned(r: Optional[ReadModel], user_id: Optional[str]):
+    if r is not None and (not user_id or user_id == r.user_id):
+        return r
+
+
 @auto_session
-def get(db_cls: DBModel, read_cls: ReadModel, id: str, user_id: str = None, session: Session = None) -> Union[ReadModel, None]:
-    dbo = session.get(db_cls, id)
-    if dbo and (not user_id or user_id == dbo.user_id) and not dbo.is_deleted:
-        return dbo.to_read(read_cls)
+def get(db_cls: DBModel, read_cls: ReadModel, id: str, user_id: str = None, session: Session = None, cache: Optional[ObjectCache] = None) -> Union[ReadModel, None]:
+    r, version = _cached(cache, db_cls, id)
+    if r is None:
+        r = _cache(cache, db_cls, session.get(db_cls, id), read_cls, version)
+    return _owned(r, user_id)
+
+
+@auto_async_session
+async def aget(db_cls: DBModel, read_cls: ReadModel, id: str, user_id: str = None, session: AsyncSession = None, cache: Optional[ObjectCache] = None) -> Union[ReadModel, None]:
+    r, version = _cached(cache, db_cls, id)
+    if r is None:
+        r = _cache(cache, db_cls, await session.get(db_cls, id), read_cls, version)
+    return _owned(r, user_id)
 
 
 @auto_session
@@ -133,25 +243,46 @@ def get_dbo(db_cls: DBModel, id: str, session: Session = None):
         return dbo
 
 
+def update_dbo(dbo: DBModel, to_update: Dict):
+    for k, v in to_update.items():
+        if k == 'metadata':
+            dbo.metadata_ = v
+        else:
+            setattr(dbo, k, v)
+
+
 @auto_session
-def modify(db_cls: DBModel, read_cls: ReadModel, id: str, to_update: Dict, user_id: str = None, session: Session = None) -> Union[ReadModel, None]:
+def modify(db_cls: DBModel, read_cls: ReadModel, id: str, to_update: Dict, user_id: str = None, session: Session = None, cache: Optional[ObjectCache] = None) -> Union[ReadModel, None]:
     dbo = session.get(db_cls, id)
-    if dbo and (not user_id or user_id == dbo.user_id) and not dbo.is_deleted:
-        for k, v in to_update.items():
-            if k == 'metadata':
-                dbo.metadata_ = v
-            else:
-                setattr(dbo, k, v)
+    if _readable(dbo, user_id):
+        update_dbo(dbo, to_update)
 
         session.add(dbo)
         session.commit()
         session.refresh(dbo)
+        if cache is not None:
+            cache.invalidate(db_cls.__tablename__, id)
+
+        return dbo.to_read(read_cls)
+
+
+@auto_async_session
+async def amodify(db_cls: DBModel, read_cls: ReadModel, id: str, to_update: Dict, user_id: str = None, session: AsyncSession = None, cache: Optional[ObjectCache] = None) -> Union[ReadModel, None]:
+    dbo = await session.get(db_cls, id)
+    if _readable(dbo, user_id):
+        update_dbo(dbo, to_update)
+
+        session.add(dbo)
+        await session.commit()
+        await session.refresh(dbo)
+        if cache is not None:
+            cache.invalidate(db_cls.__tablename__, id)
 
         return dbo.to_read(read_cls)
 
 
 @auto_session
-def delete(db_cls: DBModel, id: str, user_id: str = None, mode="soft", session: Optional[Session] = None) -> DeletionStatus:
+def delete(db_cls: DBModel, id: str, user_id: str = None, mode="soft", session: Optional[Session] = None, cache: Optional[ObjectCache] = None) -> DeletionStatus:
     dbo = session.get(db_cls, id)
     if dbo and (not user_id or user_id == dbo.user_id) and not dbo.is_deleted:
         if mode is not None and mode == 'soft':
@@ -163,35 +294,84 @@ def delete(db_cls: DBModel, id: str, user_id: str = None, mode="soft", session:
         else:
             session.delete(dbo)
             session.commit()
+        if cache is not None:
+            cache.invalidate(db_cls.__tablename__, id)
     return DeletionStatus(id=id, object=f"{dbo.object}.deleted", deleted=True)
 
 
-@auto_session
-def list(db_cls: DBModel,
-         read_cls: ReadModel,
-         list_cls: ListModel,
-         limit: int = 20,
-         order: str = "desc",
-         after: Optional[str] = None,
-         before: Optional[str] = None,
-         tag: Optional[str] = None,
-         user_id: Optional[str] = None,
-         org_id: Optional[str] = None,
-         session: Session = None
-    ) -> ListModel:
-    select_stmt = select(db_cls)
+@auto_async_session
+async def adelete(db_cls: DBModel, id: str, user_id: str = None, mode="soft", session: Optional[AsyncSession] = None, cache: Optional[ObjectCache] = None) -> DeletionStatus:
+    dbo = await session.get(db_cls, id)
+    if dbo and (not user_id or user_id == dbo.user_id) and not dbo.is_deleted:
+        if mode is not None and mode == 'soft':
+            dbo.is_deleted = True
+            dbo.deleted_at = int(datetime.now().timestamp()*1000)
+            session.add(dbo)
+            await session.commit()
+            await session.refresh(dbo)
+        else:
+            await session.delete(dbo)
+            await session.commit()
+        if cache is not None:
+            cache.invalidate(db_cls.__tablename__, id)
+    return DeletionStatus(id=id, object=f"{dbo.object}.deleted", deleted=True)
 
-    select_stmt = select_stmt.filter(db_cls.is_deleted == False)
 
-    select_stmt = select_stmt.order_by(-db_cls.created_at if order == "desc" else db_cls.created_at)
+def _cursor(db_cls: DBModel, id: str, follows: bool):
+    """Whether rows follow (or precede) the object of the id on (created_at, id), resolved in the statement."""
+    c = aliased(db_cls)
+    created_at = select(c.created_at).where(c.id == id).scalar_subquery()
+    key = tuple_(db_cls.created_at, db_cls.id)
+    cursor = tuple_(created_at, id)
+    return key > cursor if follows else key < cursor
+
+
+def keyset(db_cls: DBModel, select_stmt, limit: Optional[int] = 20, order: str = "desc", after: Optional[str] = None, before: Optional[str] = None):
+    """Page a statement with keyset cursors on (created_at, id).
+
+    `after` and `before` are ids of listed objects, the page follows or precedes them in the list order.
+    One more row than `limit` is selected to know whether there are more. Returns the statement and
+    whether its rows are in reverse list order, as the page preceding `before` is selected backwards.
+    """
+    desc = order == "desc"
+    reverse = bool(before) and not after
+
     if after:
-        obj = get(db_cls=db_cls, read_cls=read_cls, id=after, session=session)
-        if obj:
-            select_stmt = select_stmt.filter(db_cls.created_at > obj.created_at)
+        select_stmt = select_stmt.filter(_cursor(db_cls, after, follows=not desc))
     if before:
-        obj = get(db_cls=db_cls, read_cls=read_cls, id=before, session=session)
-        if obj:
-            select_stmt = select_stmt.filter(db_cls.created_at < obj.created_at)
+        select_stmt = select_stmt.filter(_cursor(db_cls, before, follows=desc))
+
+    if desc != reverse:
+        select_stmt = select_stmt.order_by(db_cls.created_at.desc(), db_cls.id.desc())
+    else:
+        select_stmt = select_stmt.order_by(db_cls.created_at, db_cls.id)
+
+    if limit is not None:
+        select_stmt = select_stmt.limit(limit + 1)
+    return select_stmt, reverse
+
+
+def to_page(dbos: List[DBModel], read_cls: ReadModel, list_cls: ListModel, limit: Optional[int] = 20, reverse: bool = False) -> ListModel:
+    """Convert the rows selected by a keyset statement to a list."""
+    has_more = limit is not None and len(dbos) > limit
+    if has_more:
+        dbos = dbos[:limit]
+    if reverse:
+        dbos = dbos[::-1]
+
+    rs = [dbo.to_read(read_cls) for dbo in dbos]
+    return list_cls(data=rs, first_id=rs[0].id if len(rs) > 0 else None, last_id=rs[-1].id if len(rs) > 0 else None, has_more=has_more)
+
+
+def _list_stmt(
+    db_cls: DBModel,
+    tag: Optional[str] = None,
+    user_id: Optional[str] = None,
+    org_id: Optional[str] = None
+):
+    select_stmt = select(db_cls)
+
+    select_stmt = select_stmt.filter(db_cls.is_deleted == False)
 
     if user_id:
         select_stmt = select_stmt.filter(db_cls.user_id == user_id)
@@ -201,10 +381,40 @@ def list(db_cls: DBModel,
     if tag:
         select_stmt = select_stmt.filter(db_cls.tag == tag)
 
-    select_stmt = select_stmt.limit(limit)
+    return select_stmt
+
 
-    dbos = session.exec(select_stmt).all()
-    rs = []
-    for dbo in dbos:
-        rs.append(dbo.to_read(read_cls))
-    return list_cls(data=rs, first_id=rs[0].id if len(rs) > 0 else None, last_id=rs[-1].id if len(rs) > 0 else None)
+@auto_session
+def list(db_cls: DBModel,
+         read_cls: ReadModel,
+         list_cls: ListModel,
+         limit: int = 20,
+         order: str = "desc",
+         after: Optional[str] = None,
+         before: Optional[str] = None,
+         tag: Optional[str] = None,
+         user_id: Optional[str] = None,
+         org_id: Optional[str] = None,
+         session: Session = None
+    ) -> ListModel:
+    select_stmt = _list_stmt(db_cls=db_cls, tag=tag, user_id=user_id, org_id=org_id)
+    select_stmt, reverse = keyset(db_cls, select_stmt, limit=limit, order=order, after=after, before=before)
+    return to_page(session.exec(select_stmt).all(), read_cls=read_cls, list_cls=list_cls, limit=limit, reverse=reverse)
+
+
+@auto_async_session
+async def alist(db_cls: DBModel,
+                read_cls: ReadModel,
+                list_cls: ListModel,
+                limit: int = 20,
+                order: str = "desc",
+                after: Optional[str] = None,
+                before: Optional[str] = None,
+                tag: Optional[str] = None,
+                user_id: Optional[str] = None,
+                org_id: Optional[str] = None,
+                session: AsyncSession = None
+    ) -> ListModel:
+    select_stmt = _list_stmt(db_cls=db_cls, tag=tag, user_id=user_id, org_id=org_id)
+    select_stmt, reverse = keyset(db_cls, select_stmt, limit=limit, order=order, after=after, before=before)
+    return to_page((await session.exec(select_stmt)).all(), read_cls=read_cls, list_cls=list_cls, limit=limit, reverse=reverse)
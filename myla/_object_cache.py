@@ -0,0 +1,112 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+from ._env import env_int
+from ._logging import logger
+from ._ttl_cache import TTLCache
+
+
+class ObjectCache:
+    """Read-through cache of the objects read by id: assistants, threads and files.
+
+    At most OBJECT_CACHE_SIZE objects are kept for OBJECT_CACHE_TTL seconds, least recently used
+    first evicted, a size of 0 disables the cache. Objects are invalidated when they are modified or
+    deleted by this process. Other processes see the changes once their entries expire, unless
+    OBJECT_CACHE_INVALIDATION=redis broadcasts the invalidations through REDIS_URL.
+
+    Cached objects are copied in and out, callers can modify the objects they get.
+    """
+    _instance = None
+
+    CHANNEL = "myla:object_cache:invalidate"
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60, client=None) -> None:
+        # (object, id) -> object
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._client = client
+        self._loop = None
+        self._pending = set()
+
+    @staticmethod
+    def default():
+        if not ObjectCache._instance:
+            client = None
+            if os.environ.get("OBJECT_CACHE_INVALIDATION") == "redis":
+                from ._stream_bus import get_redis_client
+                client = get_redis_client()
+            ObjectCache._instance = ObjectCache(
+                max_size=env_int("OBJECT_CACHE_SIZE", 1024),
+                ttl=float(os.environ.get("OBJECT_CACHE_TTL", 60)),
+                client=client
+            )
+        return ObjectCache._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache.enabled
+
+    def version(self) -> int:
+        """Taken before reading an object from database, and passed to `put`."""
+        return self._cache.version()
+
+    def get(self, object: str, id: str) -> Optional[BaseModel]:
+        value = self._cache.get((object, id))
+        return value.model_copy(deep=True) if value is not None else None
+
+    def put(self, object: str, id: str, value: BaseModel, version: int):
+        if self.enabled:
+            self._cache.put((object, id), value.model_copy(deep=True), version)
+
+    def invalidate(self, object: str, id: str, publish: bool = True):
+        self._cache.invalidate((object, id))
+        if publish and self._client is not None:
+            self._publish(f"{object}:{id}")
+
+    def clear(self):
+        self._cache.clear()
+
+    def _publish(self, message: str):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None:
+            task = loop.create_task(self._client.publish(self.CHANNEL, message))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+        elif self._loop is not None and not self._loop.is_closed():
+            # Invalidated by a worker thread
+            asyncio.run_coroutine_threadsafe(self._client.publish(self.CHANNEL, message), self._loop)
+
+    def start(self):
+        """Listen to the invalidations of the other processes, if OBJECT_CACHE_INVALIDATION is set."""
+        if self._client is None:
+            return None
+        self._loop = asyncio.get_running_loop()
+
+        async def _listen():
+            while True:
+                try:
+                    pubsub = self._client.pubsub()
+                    await pubsub.subscribe(self.CHANNEL)
+                    # Entries cached while unsubscribed may be stale
+                    self.clear()
+                    async for message in pubsub.listen():
+                        if message.get("type") != "message":
+                            continue
+                        data = message["data"]
+                        object, _, id = (data.decode() if isinstance(data, bytes) else data).partition(":")
+                        self.invalidate(object, id, publish=False)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warn(f"ObjectCache invalidation channel error: {e}")
+                    await asyncio.sleep(1)
+        return asyncio.create_task(_listen())
+
+    def metrics(self) -> Dict:
+        return self._cache.metrics()
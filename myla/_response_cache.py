@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ._env import env_int
+from ._logging import logger
+
+
+def _hash(o) -> str:
+    return hashlib.sha256(json.dumps(o, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """Caches the responses generated for identical LLM calls.
+
+    Enabled by RESPONSE_CACHE: `exact` reuses the response of a call with the same model,
+    messages and llm_args. `semantic` additionally reuses the response of a call with the same
+    model, llm_args and preceding messages, whose last message embeddings have a cosine
+    similarity of at least RESPONSE_CACHE_THRESHOLD, using the default embeddings.
+
+    At most RESPONSE_CACHE_SIZE responses are kept for RESPONSE_CACHE_TTL seconds, least
+    recently used first evicted. Assistants and runs can opt out with `"response_cache": false`
+    in their metadata.
+    """
+    _instance = None
+
+    def __init__(
+        self,
+        mode: Optional[str] = None,
+        max_size: int = 1024,
+        ttl: int = 3600,
+        threshold: float = 0.95,
+        embeddings=None
+    ) -> None:
+        if mode not in (None, "exact", "semantic"):
+            raise ValueError(f"RESPONSE_CACHE not supported: {mode}")
+        self.mode = mode
+        self._max_size = max_size
+        self._ttl = ttl
+        self._threshold = threshold
+        self._embeddings = embeddings
+
+        # key -> (expires_at, response, scope, normalized embedding)
+        self._entries: OrderedDict = OrderedDict()
+        # key -> normalized embedding computed by a missed `get`, taken by the `put` that follows
+        self._pending: OrderedDict = OrderedDict()
+
+        # Metrics
+        self._hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def default():
+        if not ResponseCache._instance:
+            ResponseCache._instance = ResponseCache(
+                mode=os.environ.get("RESPONSE_CACHE") or None,
+                max_size=env_int("RESPONSE_CACHE_SIZE", 1024),
+                ttl=env_int("RESPONSE_CACHE_TTL", 3600),
+                threshold=float(os.environ.get("RESPONSE_CACHE_THRESHOLD", 0.95))
+            )
+        return ResponseCache._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None
+
+    def _keys(self, model: str, messages: List[Dict], llm_args: Dict):
+        args = {k: v for k, v in llm_args.items() if k != "timeout"}
+        key = _hash([model, messages, args])
+        scope = _hash([model, messages[:-1], args])
+        return key, scope
+
+    def _get_embeddings(self):
+        if self._embeddings is None:
+            from .vectorstores import get_default_embeddings
+            self._embeddings = get_default_embeddings()
+        return self._embeddings
+
+    async def _embed(self, messages: List[Dict]) -> Optional[np.ndarray]:
+        if self.mode != "semantic" or not messages:
+            return None
+        try:
+            v = np.asarray(await self._get_embeddings().aembed(str(messages[-1]["content"])), dtype=np.float32)
+        except Exception as e:
+            logger.warn(f"ResponseCache embed error: {e}")
+            return None
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else None
+
+    def _evict_expired(self, now: float):
+        expired = [k for k, e in self._entries.items() if e[0] <= now]
+        for k in expired:
+            self._entries.pop(k)
+
+    async def get(self, model: str, messages: List[Dict], llm_args: Dict) -> Optional[str]:
+        """Returns the cached response of the call, None on miss."""
+        if not self.enabled:
+            return None
+        now = datetime.now().timestamp()
+        key, scope = self._keys(model, messages, llm_args)
+
+        entry = self._entries.get(key)
+        if entry and entry[0] > now:
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+        v = await self._embed(messages)
+        if self.mode == "semantic":
+            self._pending[key] = v
+            self._pending.move_to_end(key)
+            while len(self._pending) > self._max_size:
+                self._pending.popitem(last=False)
+        if v is not None:
+            best, best_key = self._threshold, None
+            for k, (expires_at, _, s, e) in self._entries.items():
+                if s == scope and e is not None and expires_at > now and e.shape == v.shape:
+                    similarity = float(np.dot(e, v))
+                    if similarity >= best:
+                        best, best_key = similarity, k
+            if best_key is not None:
+                self._entries.move_to_end(best_key)
+                self._hits += 1
+                self._semantic_hits += 1
+                return self._entries[best_key][1]
+
+        self._misses += 1
+        return None
+
+    async def put(self, model: str, messages: List[Dict], llm_args: Dict, response: str):
+        if not self.enabled or not response:
+            return
+        now = datetime.now().timestamp()
+        key, scope = self._keys(model, messages, llm_args)
+
+        if key in self._pending:
+            v = self._pending.pop(key)
+        else:
+            v = await self._embed(messages)
+        self._entries[key] = (now + self._ttl, response, scope, v)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self._max_size:
+            self._evict_expired(now)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def metrics(self) -> Dict:
+        lookups = self._hits + self._misses
+        return {
+            "mode": self.mode,
+            "size": len(self._entries),
+            "hits": self._hits,
+            "semantic_hits": self._semantic_hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups > 0 else 0.0,
+        }
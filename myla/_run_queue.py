@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from . import runs
+from ._env import env_json
+from ._stream_bus import get_redis_client
+
+
+class RunQueue(ABC):
+    """Runs waiting to be executed by a RunScheduler."""
+
+    # Whether queued runs survive a restart of the worker
+    durable = True
+
+    @abstractmethod
+    async def put(self, run: runs.RunRead):
+        """Enqueue a run."""
+
+    @abstractmethod
+    async def get(self) -> runs.RunRead:
+        """Dequeue the next run, waits until one is available."""
+
+    @abstractmethod
+    async def qsize(self) -> int:
+        """Number of runs waiting in the queue."""
+
+
+DEFAULT_PRIORITY_WEIGHTS = {"interactive": 10, "batch": 1}
+
+
+class MemoryRunQueue(RunQueue):
+    """In-process queue, runs are only executed by the worker which submitted them.
+
+    Runs are dequeued by weighted fair queuing over flows, a flow being the runs of a priority
+    class (the "priority" of the run metadata, interactive by default) from one tenant (org_id,
+    else user_id). A flow gets a share of the dequeues proportional to the weight of its class
+    times the weight of its tenant, so a tenant submitting a batch of runs can not starve others.
+    Runs of the same flow are dequeued in FIFO order.
+
+    A run already waiting in the queue is not enqueued again.
+    """
+    durable = False
+
+    def __init__(
+        self,
+        priority_weights: Optional[Dict[str, float]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        default_priority: str = "interactive"
+    ) -> None:
+        self._priority_weights = priority_weights if priority_weights is not None else DEFAULT_PRIORITY_WEIGHTS
+        self._tenant_weights = tenant_weights if tenant_weights else {}
+        self._default_priority = default_priority
+
+        self._heap = []  # (finish_tag, seq, run)
+        self._seq = itertools.count()
+        self._items = asyncio.Semaphore(0)
+        self._ids = set()
+
+        # Virtual time, the finish tag of the last dequeued run
+        self._vtime = 0.0
+        # flow -> [finish tag of its last queued run, number of queued runs]
+        self._flows: Dict[Tuple[str, str], list] = {}
+
+    def _flow(self, run: runs.RunRead) -> Tuple[Tuple[str, str], float]:
+        priority = run.metadata.get("priority") if run.metadata else None
+        if priority not in self._priority_weights:
+            priority = self._default_priority
+        tenant = run.org_id or run.user_id or ""
+
+        weight = self._priority_weights.get(priority, 1) * self._tenant_weights.get(tenant, self._tenant_weights.get("*", 1))
+        return (priority, tenant), max(weight, 1e-6)
+
+    async def put(self, run: runs.RunRead):
+        if run.id in self._ids:
+            return
+        self._ids.add(run.id)
+
+        key, weight = self._flow(run)
+        flow = self._flows.setdefault(key, [0.0, 0])
+        flow[0] = max(self._vtime, flow[0]) + 1.0 / weight
+        flow[1] += 1
+
+        heapq.heappush(self._heap, (flow[0], next(self._seq), key, run))
+        self._items.release()
+
+    async def get(self) -> runs.RunRead:
+        await self._items.acquire()
+        finish_tag, _, key, run = heapq.heappop(self._heap)
+        self._vtime = finish_tag
+
+        flow = self._flows[key]
+        flow[1] -= 1
+        if flow[1] == 0:
+            del self._flows[key]
+
+        self._ids.discard(run.id)
+        return run
+
+    async def qsize(self) -> int:
+        return len(self._heap)
+
+
+class DatabaseRunQueue(RunQueue):
+    """Uses the queued runs stored in database as the queue.
+
+    Workers claim runs by switching their status from queued to in_progress, so every run
+    is executed once whichever worker submitted it. Runs submitted by other workers are
+    picked up by polling every `poll_interval` seconds.
+    """
+
+    def __init__(self, poll_interval: float = 0.5) -> None:
+        self._poll_interval = poll_interval
+        self._event = asyncio.Event()
+
+    async def put(self, run: runs.RunRead):
+        # The run is already stored with status queued
+        self._event.set()
+
+    async def get(self) -> runs.RunRead:
+        while True:
+            run = await runs.aclaim_queued()
+            if run:
+                return run
+
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def qsize(self) -> int:
+        return await runs.acount(status="queued")
+
+
+class RedisRunQueue(RunQueue):
+    """Queue stored in a Redis list.
+
+    Only `rpush`, `blpop` and `llen` of `redis.asyncio.Redis` are used, so any client with
+    the same semantics can be passed in.
+    """
+
+    def __init__(self, client, key: str = "myla:runs:queue", timeout: int = 1) -> None:
+        self._client = client
+        self._key = key
+        self._timeout = timeout
+
+    async def put(self, run: runs.RunRead):
+        await self._client.rpush(self._key, run.model_dump_json())
+
+    async def get(self) -> runs.RunRead:
+        while True:
+            r = await self._client.blpop(self._key, timeout=self._timeout)
+            if r:
+                return runs.RunRead.model_validate_json(r[1])
+
+    async def qsize(self) -> int:
+        return await self._client.llen(self._key)
+
+
+def create_run_queue(impl: Optional[str] = None) -> RunQueue:
+    """Create the RunQueue configured by RUN_QUEUE: memory(default), database or redis."""
+    impl = impl if impl else os.environ.get("RUN_QUEUE", "memory")
+
+    if impl == "memory":
+        return MemoryRunQueue(
+            priority_weights=env_json("RUN_PRIORITY_WEIGHTS", DEFAULT_PRIORITY_WEIGHTS),
+            tenant_weights=env_json("RUN_TENANT_WEIGHTS", {})
+        )
+    elif impl == "database":
+        return DatabaseRunQueue(poll_interval=float(os.environ.get("RUN_QUEUE_POLL_INTERVAL", 0.5)))
+    elif impl == "redis":
+        return RedisRunQueue(client=get_redis_client())
+    else:
+        raise ValueError(f"RUN_QUEUE not supported: {impl}")
@@ -1,37 +1,91 @@
 from datetime import datetime
 import asyncio
+import os
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from . import assistants, runs
 from ._llm import chat_complete
+from ._env import env_int, env_json
 from ._logging import logger
+from ._run_queue import RunQueue, create_run_queue
+from ._stream_bus import StreamBus, create_stream_bus
 
 
-class AsyncIterator:
-    def __init__(self):
-        self.queue = asyncio.Queue()
-        self.created_at = datetime.now().timestamp()
+class RunQueueFull(Exception):
+    """Raised when the scheduler can not accept more runs."""
 
-    def __aiter__(self):
-        return self
 
-    async def __anext__(self):
-        i = await self.queue.get()
-        if i is None:
-            raise StopAsyncIteration
+class RunScheduler:
+    """Executes submitted runs.
 
-        return i
+    Concurrency is bounded by RUN_MAX_CONCURRENCY (all runs) and RUN_MODEL_CONCURRENCY
+    (a JSON object of model name to limit, "*" applies to unlisted models). Runs waiting
+    for a slot are queued, at most RUN_MAX_QUEUE_SIZE of them. A limit of 0 means unbounded.
+    Runs dequeued while their model is at its limit are parked without holding a slot of all
+    runs, and take over the slots of the next finished run of their model, so a busy model can
+    not starve the others.
 
-    async def put(self, item):
-        await self.queue.put(item)
+    Runs are taken from a RunQueue and their generated chunks are published to a StreamBus,
+    see RUN_QUEUE and RUN_STREAM_BUS. With the database/redis queue and the file/redis bus a
+    run can be submitted, executed and streamed by different workers.
 
+    Runs are cancelled through `cancel_run`, or by marking them cancelling in database which
+    is checked every RUN_CANCEL_POLL_INTERVAL seconds, the executing task is then cancelled.
 
-class RunScheduler:
+    Every run gets a deadline when it is created, see `resolve_timeout`: the "timeout" seconds
+    of the run metadata, of the assistant metadata, or RUN_TIMEOUT. Runs still queued or
+    executing at their expires_at are stopped and marked expired, so hung runs can not hold
+    their slot.
+    """
     _instance = None
 
-    def __init__(self) -> None:
-        self._tasks = set()
-        self._run_queue = asyncio.Queue()
-        self._run_iters = dict()
-        self._run_iters_lock = asyncio.Lock()
-        self._last_clear_at = datetime.now().timestamp()
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        model_concurrency: Optional[Dict[str, int]] = None,
+        max_queue_size: Optional[int] = None,
+        run_queue: Optional[RunQueue] = None,
+        stream_bus: Optional[StreamBus] = None,
+        cancel_poll_interval: Optional[float] = None,
+        timeout: Optional[float] = None
+    ) -> None:
+        if max_concurrency is None:
+            max_concurrency = env_int("RUN_MAX_CONCURRENCY")
+        if model_concurrency is None:
+            model_concurrency = env_json("RUN_MODEL_CONCURRENCY", {})
+        if max_queue_size is None:
+            max_queue_size = env_int("RUN_MAX_QUEUE_SIZE")
+        if cancel_poll_interval is None:
+            cancel_poll_interval = float(os.environ.get("RUN_CANCEL_POLL_INTERVAL", 1.0))
+        if timeout is None:
+            timeout = env_int("RUN_TIMEOUT", 600)
+
+        self._max_concurrency = max_concurrency
+        self._model_concurrency = model_concurrency
+        self._max_queue_size = max_queue_size
+        self._cancel_poll_interval = cancel_poll_interval
+        self._timeout = timeout
+
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._run_queue = run_queue if run_queue else create_run_queue()
+        self._stream_bus = stream_bus if stream_bus else create_stream_bus()
+
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        # model -> number of executing runs, for the models with a limit
+        self._model_running: Dict[str, int] = {}
+        # model -> runs dequeued while the model was at its limit
+        self._parked: Dict[str, Deque[Tuple[object, object]]] = {}
+
+        # Metrics
+        self._waiting = 0
+        self._running = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._finished = 0
+        self._cancelled = 0
+        self._expired = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
 
     @staticmethod
     def default():
@@ -39,58 +93,278 @@ class RunScheduler:
             RunScheduler._instance = RunScheduler()
         return RunScheduler._instance
 
-    def submit_run(self, run):
-        self._run_queue.put_nowait(run)
+    async def queue_depth(self) -> int:
+        """Number of runs waiting for execution."""
+        return await self._run_queue.qsize() + self._waiting
+
+    async def is_full(self) -> bool:
+        return self._max_queue_size > 0 and await self.queue_depth() >= self._max_queue_size
+
+    async def submit_run(self, run):
+        if await self.is_full():
+            self._rejected += 1
+            raise RunQueueFull(f"Run queue is full: max_queue_size={self._max_queue_size}")
+
+        # Register the stream before the run is queued, so clients can attach to it right away
+        await self._stream_bus.open(run.id)
+
+        self._submitted += 1
+        await self._run_queue.put(run)
+
+    async def recover(self) -> Dict[str, int]:
+        """Recover the runs left queued or in_progress by a stopped worker, called on startup.
+
+        With an in-process queue every queued run is enqueued again and every in_progress run
+        was interrupted, so it is failed. With a shared queue the queued runs are still there,
+        and only the in_progress runs past their expires_at are failed, others may be executing
+        in other workers.
+        """
+        recovered = {"requeued": 0, "failed": 0, "cancelled": 0}
+        now = int(round(datetime.now().timestamp()))
+
+        for run in await runs.alist_by_status(status=["queued", "in_progress", "cancelling"]):
+            if run.id in self._tasks:
+                continue
+
+            if run.status == "queued":
+                if not self._run_queue.durable:
+                    await self._stream_bus.open(run.id)
+                    await self._run_queue.put(run)
+                    recovered["requeued"] += 1
+                continue
+
+            if self._run_queue.durable and (not run.expires_at or run.expires_at > now):
+                continue
+
+            if run.status == "cancelling":
+                await runs.aupdate(id=run.id, status="cancelled", cancelled_at=now)
+                recovered["cancelled"] += 1
+            else:
+                await runs.aupdate(
+                    id=run.id,
+                    status="failed",
+                    last_error={
+                        "code": "server_error",
+                        "message": "Run interrupted by a restart of the server."
+                    },
+                    failed_at=now
+                )
+                recovered["failed"] += 1
+
+        if any(recovered.values()):
+            logger.warn(f"Runs recovered: {recovered}")
+        return recovered
+
+    async def metrics(self) -> Dict:
+        started = self._finished + self._running
+        return {
+            "max_concurrency": self._max_concurrency,
+            "model_concurrency": self._model_concurrency,
+            "max_queue_size": self._max_queue_size,
+            "queue_depth": await self.queue_depth(),
+            "running": self._running,
+            "parked": sum(len(parked) for parked in self._parked.values()),
+            "submitted": self._submitted,
+            "rejected": self._rejected,
+            "finished": self._finished,
+            "cancelled": self._cancelled,
+            "expired": self._expired,
+            "wait_time_avg": self._wait_time_total / started if started > 0 else 0.0,
+            "wait_time_max": self._wait_time_max,
+        }
+
+    async def get_run_iter(self, run_id, after: Optional[str] = None):
+        """Returns an async iterator of (id, chunk) over the stream of a run, None if the stream does not exist."""
+        return await self._stream_bus.get(run_id, after=after)
+
+    def _unpark(self, run_id: str) -> Optional[Tuple[object, object]]:
+        """Remove a parked run, returns its (run, iter) or None if it is not parked."""
+        for model, parked in self._parked.items():
+            for run, iter in parked:
+                if run.id == run_id:
+                    parked.remove((run, iter))
+                    if not parked:
+                        del self._parked[model]
+                    self._waiting -= 1
+                    return run, iter
+        return None
 
-    async def _create_run_iter(self, run_id):
-        async with self._run_iters_lock:
-            self._run_iters[run_id] = AsyncIterator()
-            logger.debug(f"Run iters: {self._run_iters.keys()}")
-            return self._run_iters[run_id]
+    async def cancel_run(self, run_id: str) -> bool:
+        """Cancel the task executing a run in this worker, returns False if there is none."""
+        unparked = self._unpark(run_id)
+        if unparked:
+            await self._set_cancelled(run=unparked[0], iter=unparked[1])
+            return True
 
-    async def get_run_iter(self, run_id):
-        async with self._run_iters_lock:
-            logger.debug(f"Run iters: {self._run_iters.keys()}")
-            return self._run_iters.get(run_id)
+        task = self._tasks.get(run_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
 
-    async def _clear_iters(self):
-        expires = 60*10
-        now = datetime.now().timestamp()
-        if self._last_clear_at + expires > now:
+    async def close_cancelled(self, run_id: str):
+        """Close the stream of a run cancelled while queued, the run is skipped when dequeued."""
+        self._unpark(run_id)
+        self._cancelled += 1
+        iter = await self._stream_bus.open(run_id)
+        await iter.put(Exception("Run cancelled."))
+        await iter.put(None)
+
+    async def _set_cancelled(self, run, iter):
+        if not await runs.aset_cancelled(id=run.id):
+            # Already cancelled, e.g. while queued, and its stream closed
             return
-        async with self._run_iters_lock:
-            expired = []
-            for run_id, iter in self._run_iters.items():
-                if iter.created_at + expires < now:
-                    expired.append(run_id)
+        self._cancelled += 1
+        await iter.put(Exception("Run cancelled."))
+        await iter.put(None)
+
+    async def _set_expired(self, run, iter):
+        logger.info(f"Run expired: run_id={run.id}, expires_at={run.expires_at}")
+        await runs.aupdate(id=run.id, status="expired")
+        self._expired += 1
+        await iter.put(Exception("Run expired."))
+        await iter.put(None)
+
+    async def resolve_timeout(self, run) -> float:
+        """Returns the timeout of a run to create, 0 for no deadline."""
+        timeout = run.metadata.get("timeout") if run.metadata else None
+        if timeout is None:
+            assistant = await assistants.aget(id=run.assistant_id)
+            if assistant and assistant.metadata:
+                timeout = assistant.metadata.get("timeout")
+        if timeout is None:
+            return self._timeout
+        try:
+            return float(timeout)
+        except (TypeError, ValueError):
+            logger.warn(f"Invalid run timeout: assistant_id={run.assistant_id}, timeout={timeout}")
+            return self._timeout
+
+    async def _resolve_model(self, run) -> Optional[str]:
+        if run.model:
+            return run.model
+        assistant = await assistants.aget(id=run.assistant_id)
+        if assistant and assistant.model:
+            return assistant.model
+        return os.environ.get("DEFAULT_LLM_MODEL_NAME")
+
+    async def _get_model_limit(self, run) -> Tuple[Optional[str], int]:
+        """Returns the model of the run and its limit, 0 if unbounded."""
+        if not self._model_concurrency:
+            return None, 0
+
+        model = await self._resolve_model(run)
+        limit = self._model_concurrency.get(model, self._model_concurrency.get("*", 0))
+        return model, max(limit or 0, 0)
+
+    def _spawn(self, run, iter, model: Optional[str], limited: bool):
+        wait_time = max(datetime.now().timestamp() - run.created_at / 1000, 0.0)
+        self._wait_time_total += wait_time
+        self._wait_time_max = max(self._wait_time_max, wait_time)
+        self._waiting -= 1
+        self._running += 1
+
+        def _done(_):
+            self._tasks.pop(run.id, None)
+            self._running -= 1
+            self._finished += 1
+            self._release(model, limited)
+
+        task = asyncio.create_task(
+            self._execute(run=run, iter=iter)
+        )
+        self._tasks[run.id] = task
+        task.add_done_callback(_done)
+
+    def _release(self, model: Optional[str], limited: bool):
+        """Release the slots of a finished run, handed over to the next parked run of its model."""
+        if limited:
+            parked = self._parked.get(model)
+            if parked:
+                run, iter = parked.popleft()
+                if not parked:
+                    del self._parked[model]
+                self._spawn(run=run, iter=iter, model=model, limited=True)
+                return
+            self._model_running[model] -= 1
+        if self._slots:
+            self._slots.release()
 
-            for run_id in expired:
-                self._run_iters.pop(run_id)
+    async def _run(self, run, iter):
+        await chat_complete(run=run, iter=iter)
 
-            logger.info(f"Run iters cleared: {expired}")
-        self.last_clear_at = now
+    async def _execute(self, run, iter):
+        try:
+            status = await runs.aget_status(id=run.id)
+            if status == "cancelled":
+                # Cancelled while queued, its stream is already closed
+                return
+            if status == "cancelling":
+                await self._set_cancelled(run=run, iter=iter)
+                return
+
+            if run.expires_at:
+                remaining = run.expires_at - datetime.now().timestamp()
+                if remaining <= 0:
+                    await self._set_expired(run=run, iter=iter)
+                    return
+                try:
+                    await asyncio.wait_for(self._run(run=run, iter=iter), remaining)
+                except asyncio.TimeoutError:
+                    await self._set_expired(run=run, iter=iter)
+            else:
+                await self._run(run=run, iter=iter)
+        except asyncio.CancelledError:
+            logger.info(f"Run cancelled: run_id={run.id}")
+            await self._set_cancelled(run=run, iter=iter)
+        except Exception as e:
+            logger.error(f"RunScheduler execute error: run_id={run.id}, e={e}")
 
     def start(self):
+        self._stream_bus.start()
+
         async def _start():
             while True:
+                acquired = False
                 try:
+                    if self._slots:
+                        await self._slots.acquire()
+                        acquired = True
                     run = await self._run_queue.get()
                     logger.debug(f"RunScheduler received new task, run_id={run.id}")
-                    iter = await self._create_run_iter(run.id)
-
-                    task = asyncio.create_task(
-                        chat_complete(run=run, iter=iter)
-                    )
-                    self._tasks.add(task)
-
-                    await self._clear_iters()
+                    iter = await self._stream_bus.open(run.id)
 
-                    done = []
-                    for t in self._tasks:
-                        if t.done():
-                            done.append(t)
-                    for t in done:
-                        self._tasks.remove(t)
+                    model, limit = await self._get_model_limit(run)
+                    self._waiting += 1
+                    if limit > 0 and self._model_running.get(model, 0) >= limit:
+                        # Waits for a finished run of its model, without holding a slot
+                        self._parked.setdefault(model, deque()).append((run, iter))
+                        if acquired:
+                            self._slots.release()
+                    else:
+                        if limit > 0:
+                            self._model_running[model] = self._model_running.get(model, 0) + 1
+                        self._spawn(run=run, iter=iter, model=model, limited=limit > 0)
+                    acquired = False  # released by the task
                 except Exception as e:
                     logger.error(f"RunScheduler error: {e}")
-        return asyncio.create_task(_start())
+                    if acquired:
+                        self._slots.release()
+
+        async def _watch_cancelling():
+            # Runs cancelled through other workers
+            while True:
+                await asyncio.sleep(self._cancel_poll_interval)
+                try:
+                    ids = [*self._tasks.keys(), *(run.id for parked in self._parked.values() for run, _ in parked)]
+                    for run_id in await runs.afilter_status(ids=ids, status="cancelling"):
+                        await self.cancel_run(run_id)
+                except Exception as e:
+                    logger.error(f"RunScheduler watch cancelling error: {e}")
+
+        async def _main():
+            if self._cancel_poll_interval > 0:
+                await asyncio.gather(_start(), _watch_cancelling())
+            else:
+                await _start()
+        return asyncio.create_task(_main())
@@ -0,0 +1,417 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from ._logging import logger
+
+
+class RunStream:
+    """Broadcasts the chunks of a run to any number of subscribers.
+
+    The last `replay_size` chunks are kept, so late or reconnecting subscribers can replay
+    them from the id of the last chunk they received.
+    """
+
+    def __init__(self, replay_size: int = 4096, on_finished: Optional[Callable[[], None]] = None):
+        self.created_at = datetime.now().timestamp()
+        self.expires_at = None
+        self._events = deque(maxlen=replay_size)
+        self._seq = 0
+        self._closed = False
+        self._changed = asyncio.Event()
+        self._subscribers = 0
+        self._on_finished = on_finished
+
+    async def put(self, item):
+        if self._closed:
+            return
+        if item is None:
+            self._closed = True
+        else:
+            self._seq += 1
+            self._events.append((self._seq, item))
+
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+        if self._closed:
+            self._check_finished()
+
+    def _check_finished(self):
+        """Notify once the stream is closed and no subscriber is reading it."""
+        if self._closed and self._subscribers == 0 and self._on_finished:
+            self._on_finished()
+
+    async def subscribe(self, after: Optional[str] = None):
+        """Iterate (id, chunk) from the chunk following `after`."""
+        seq = _parse_seq(after)
+        self._subscribers += 1
+        try:
+            while True:
+                if self._events and self._events[-1][0] > seq:
+                    start = max(seq + 1 - self._events[0][0], 0)
+                    for event in list(itertools.islice(self._events, start, None)):
+                        seq = event[0]
+                        yield str(event[0]), event[1]
+                    # more chunks may have been put while yielding
+                    continue
+
+                if self._closed:
+                    return
+                await self._changed.wait()
+        finally:
+            self._subscribers -= 1
+            self._check_finished()
+
+
+def _parse_seq(id: Optional[str]) -> int:
+    try:
+        return max(int(id), 0) if id else 0
+    except ValueError:
+        return 0
+
+
+class RunStreamError(Exception):
+    """An error reported by the worker which executed the run."""
+
+
+def encode(item) -> str:
+    """Encode a stream item: a generated chunk, an Exception, or None for the end of the stream."""
+    if item is None:
+        return json.dumps({"done": True})
+    if isinstance(item, Exception):
+        return json.dumps({"e": str(item)}, ensure_ascii=False)
+    return json.dumps({"c": item}, ensure_ascii=False)
+
+
+def decode(data) -> Any:
+    if isinstance(data, bytes):
+        data = data.decode()
+    e = json.loads(data)
+    if "c" in e:
+        return e["c"]
+    if "e" in e:
+        return RunStreamError(e["e"])
+    return None
+
+
+class StreamBus(ABC):
+    """Delivers the chunks generated by a run to the clients streaming it.
+
+    The writer returned by `open` puts str chunks, Exceptions, and None which ends the stream.
+    Every chunk gets an id, readers returned by `get` iterate (id, chunk) and can resume from
+    the id of the last chunk they received. A stream can be read by any number of readers.
+    """
+
+    @abstractmethod
+    async def open(self, run_id: str):
+        """Create the stream of a run if it does not exist, returns a writer with an async `put(item)` method."""
+
+    @abstractmethod
+    async def get(self, run_id: str, after: Optional[str] = None):
+        """Returns an async iterator over the chunks following `after`, None if the stream does not exist."""
+
+    def start(self):
+        """Start background tasks, called by the RunScheduler."""
+
+    def stop(self):
+        """Cancel the background tasks started by `start`."""
+
+
+class LocalStreamBus(StreamBus):
+    """In-process streams, only visible to the worker executing the run.
+
+    A stream is released `expires` seconds after it was opened, or `linger` seconds after it
+    was closed and its last subscriber finished, whichever comes first. Expiry times are kept
+    in a heap and released by a reaper task, so opening a stream costs O(log n).
+    """
+
+    def __init__(self, replay_size: int = 4096, expires: int = 60*10, linger: int = 30, reap_interval: float = 1.0) -> None:
+        self._replay_size = replay_size
+        self._expires = expires
+        self._linger = linger
+        self._reap_interval = reap_interval
+        self._run_iters: Dict[str, RunStream] = dict()
+        self._expiry = []  # heap of (expires_at, run_id), entries are stale if the stream was rescheduled
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._run_iters)
+
+    def _schedule(self, run_id: str, expires_at: float):
+        stream = self._run_iters.get(run_id)
+        if stream is None or (stream.expires_at is not None and stream.expires_at <= expires_at):
+            return
+        stream.expires_at = expires_at
+        heapq.heappush(self._expiry, (expires_at, run_id))
+
+    async def open(self, run_id: str):
+        stream = self._run_iters.get(run_id)
+        if stream is None:
+            stream = RunStream(
+                replay_size=self._replay_size,
+                on_finished=lambda: self._schedule(run_id, datetime.now().timestamp() + self._linger)
+            )
+            self._run_iters[run_id] = stream
+            self._schedule(run_id, stream.created_at + self._expires)
+        return stream
+
+    async def get(self, run_id: str, after: Optional[str] = None):
+        stream = self._run_iters.get(run_id)
+        if stream:
+            return stream.subscribe(after=after)
+
+    def reap(self, now: Optional[float] = None) -> List[str]:
+        """Release the expired streams."""
+        now = now if now is not None else datetime.now().timestamp()
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, run_id = heapq.heappop(self._expiry)
+            stream = self._run_iters.get(run_id)
+            if stream is not None and stream.expires_at == expires_at:
+                self._run_iters.pop(run_id)
+                expired.append(run_id)
+        if expired:
+            logger.debug(f"Run iters released: {expired}")
+        return expired
+
+    def start(self):
+        async def _reap():
+            while True:
+                try:
+                    self.reap()
+                except Exception as e:
+                    logger.error(f"Run iters reaper error: {e}")
+                await asyncio.sleep(self._reap_interval)
+
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(_reap())
+        return self._reaper
+
+    def stop(self):
+        reaper, self._reaper = self._reaper, None
+        if reaper is not None and not reaper.done():
+            reaper.cancel()
+        return reaper
+
+
+class _FileStreamWriter:
+    def __init__(self, fname: str) -> None:
+        self._f = open(fname, "a", encoding="utf-8")
+
+    async def put(self, item):
+        if self._f.closed:
+            return
+        self._f.write(encode(item) + "\n")
+        self._f.flush()
+        if item is None:
+            self._f.close()
+
+
+class _FileStreamReader:
+    def __init__(self, fname: str, poll_interval: float, after: Optional[str] = None) -> None:
+        self._fname = fname
+        self._poll_interval = poll_interval
+        self._after = _parse_seq(after)
+        self._seq = 0
+        self._f = None
+        self._buffer = ""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._f is None:
+            self._f = open(self._fname, "r", encoding="utf-8")
+        while True:
+            line = self._f.readline()
+            if line:
+                self._buffer += line
+                if not self._buffer.endswith("\n"):
+                    continue
+                data, self._buffer = self._buffer, ""
+                item = decode(data)
+                if item is None:
+                    self._f.close()
+                    raise StopAsyncIteration
+                self._seq += 1
+                if self._seq <= self._after:
+                    continue
+                return str(self._seq), item
+
+            if not os.path.exists(self._fname):
+                self._f.close()
+                raise StopAsyncIteration
+            await asyncio.sleep(self._poll_interval)
+
+
+class FileStreamBus(StreamBus):
+    """Streams appended to files in a directory shared by the workers."""
+
+    def __init__(self, path: str, poll_interval: float = 0.05, expires: int = 60*10) -> None:
+        self._path = path
+        self._poll_interval = poll_interval
+        self._expires = expires
+        self._last_clear_at = datetime.now().timestamp()
+
+        os.makedirs(self._path, exist_ok=True)
+
+    def _fname(self, run_id: str) -> str:
+        if not run_id or os.path.basename(run_id) != run_id:
+            raise ValueError(f"Invalid run_id: {run_id}")
+        return os.path.join(self._path, f"{run_id}.jsonl")
+
+    async def open(self, run_id: str):
+        writer = _FileStreamWriter(self._fname(run_id))
+        self._clear_files()
+        return writer
+
+    async def get(self, run_id: str, after: Optional[str] = None):
+        fname = self._fname(run_id)
+        if os.path.exists(fname):
+            return _FileStreamReader(fname, poll_interval=self._poll_interval, after=after)
+
+    def _clear_files(self):
+        now = datetime.now().timestamp()
+        if self._last_clear_at + self._expires > now:
+            return
+        self._last_clear_at = now
+
+        expired = []
+        for fname in os.listdir(self._path):
+            fpath = os.path.join(self._path, fname)
+            try:
+                if os.path.getmtime(fpath) + self._expires < now:
+                    os.remove(fpath)
+                    expired.append(fname)
+            except OSError:
+                pass
+        logger.info(f"Run stream files cleared: {expired}")
+
+
+class _RedisStreamWriter:
+    def __init__(self, client, key: str, expires: int) -> None:
+        self._client = client
+        self._key = key
+        self._expires = expires
+
+    async def put(self, item):
+        await self._client.xadd(self._key, {"d": encode(item)})
+        if item is None:
+            await self._client.expire(self._key, self._expires)
+
+
+class _RedisStreamReader:
+    def __init__(self, client, key: str, block: int, after: Optional[str] = None) -> None:
+        self._client = client
+        self._key = key
+        self._block = block
+        self._last_id = after if after and re.fullmatch(r"\d+-\d+", after) else "0"
+        self._items = []
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._done:
+                raise StopAsyncIteration
+            resp = await self._client.xread({self._key: self._last_id}, block=self._block, count=100)
+            if not resp:
+                if not await self._client.exists(self._key):
+                    raise StopAsyncIteration
+                continue
+            for _, entries in resp:
+                for entry_id, fields in entries:
+                    self._last_id = entry_id
+                    data = fields.get("d", fields.get(b"d"))
+                    if data is None:
+                        continue
+                    self._items.append((entry_id, data))
+
+        entry_id, data = self._items.pop(0)
+        item = decode(data)
+        if item is None:
+            self._done = True
+            self._items.clear()
+            raise StopAsyncIteration
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id, item
+
+
+class RedisStreamBus(StreamBus):
+    """Streams stored in Redis streams.
+
+    Only `xadd`, `xread`, `expire` and `exists` of `redis.asyncio.Redis` are used, so any client
+    with the same semantics can be passed in.
+    """
+
+    def __init__(self, client, prefix: str = "myla:run:", expires: int = 60*10, block: int = 1000) -> None:
+        self._client = client
+        self._prefix = prefix
+        self._expires = expires
+        self._block = block
+
+    def _key(self, run_id: str) -> str:
+        return f"{self._prefix}{run_id}:stream"
+
+    async def open(self, run_id: str):
+        key = self._key(run_id)
+        await self._client.xadd(key, {"open": "1"})
+        await self._client.expire(key, self._expires)
+        return _RedisStreamWriter(self._client, key, expires=self._expires)
+
+    async def get(self, run_id: str, after: Optional[str] = None):
+        key = self._key(run_id)
+        if await self._client.exists(key):
+            return _RedisStreamReader(self._client, key, block=self._block, after=after)
+
+
+_redis_client = None
+
+
+def get_redis_client():
+    """Returns the Redis client connected to REDIS_URL."""
+    global _redis_client
+
+    if _redis_client is None:
+        url = os.environ.get("REDIS_URL")
+        if not url:
+            raise ValueError("REDIS_URL is required.")
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise ImportError(
+                "Could not import redis python package. "
+                "Please install it with `pip install redis`."
+            ) from exc
+        _redis_client = redis.from_url(url)
+    return _redis_client
+
+
+def create_stream_bus(impl: Optional[str] = None) -> StreamBus:
+    """Create the StreamBus configured by RUN_STREAM_BUS: local(default), file or redis."""
+    impl = impl if impl else os.environ.get("RUN_STREAM_BUS", "local")
+
+    if impl == "local":
+        return LocalStreamBus(
+            replay_size=int(os.environ.get("RUN_STREAM_REPLAY_SIZE", 4096)),
+            linger=int(os.environ.get("RUN_STREAM_LINGER", 30))
+        )
+    elif impl == "file":
+        path = os.environ.get("RUN_STREAM_DIR")
+        if not path:
+            path = os.path.join(os.environ.get("DATA_DIR", tempfile.gettempdir()), "streams")
+        return FileStreamBus(path=path)
+    elif impl == "redis":
+        return RedisStreamBus(client=get_redis_client())
+    else:
+        raise ValueError(f"RUN_STREAM_BUS not supported: {impl}")
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class TTLCache:
+    """A thread safe LRU of at most `max_size` values, expiring `ttl` seconds after they are put.
+
+    A size of 0 disables the cache. Every invalidation increments a version: callers take the
+    version before reading a value from its source and pass it to `put`, so a value read before
+    an invalidation is not cached.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+
+        # key -> (expires_at, value)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def version(self) -> int:
+        return self._version
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, version: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            if version != self._version:
+                # Invalidated while it was read
+                return
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._version += 1
+            self._invalidations += 1
+            self._entries.pop(key, None)
+
+    def invalidate_values(self, predicate: Callable[[Any], bool]):
+        """Invalidate the values matching the predicate."""
+        with self._lock:
+            self._version += 1
+            self._invalidations += 1
+            for key in [k for k, e in self._entries.items() if predicate(e[1])]:
+                self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def metrics(self) -> Dict:
+        lookups = self._hits + self._misses
+        return {
+            "size": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "invalidations": self._invalidations,
+            "hit_rate": self._hits / lookups if lookups > 0 else 0.0,
+        }
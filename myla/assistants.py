@@ -3,8 +3,10 @@ from typing import Any, Dict, List, Optional, Union
 
 from pydantic import BaseModel
 from sqlmodel import JSON, Column, Field, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from . import _models
+from ._object_cache import ObjectCache
 
 
 class AssistantBase(BaseModel):
@@ -56,17 +58,22 @@ def create(assistant: AssistantCreate, user_id: str = None, org_id: str = None,
 
 @_models.auto_session
 def get(id: str, user_id: str = None, session: Session = None) -> Union[AssistantRead, None]:
-    return _models.get(db_cls=Assistant, read_cls=AssistantRead, id=id, user_id=user_id, session=session)
+    return _models.get(db_cls=Assistant, read_cls=AssistantRead, id=id, user_id=user_id, session=session, cache=ObjectCache.default())
+
+
+@_models.auto_async_session
+async def aget(id: str, user_id: str = None, session: AsyncSession = None) -> Union[AssistantRead, None]:
+    return await _models.aget(db_cls=Assistant, read_cls=AssistantRead, id=id, user_id=user_id, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
 def modify(id: str, assistant: AssistantModify, user_id: str = None, session: Session = None) -> Union[AssistantRead, None]:
-    return _models.modify(db_cls=Assistant, read_cls=AssistantRead, id=id, to_update=assistant.model_dump(exclude_unset=True), user_id=user_id, session=session)
+    return _models.modify(db_cls=Assistant, read_cls=AssistantRead, id=id, to_update=assistant.model_dump(exclude_unset=True), user_id=user_id, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
 def delete(id: str, user_id: str = None, mode="soft", session: Optional[Session] = None) -> _models.DeletionStatus:
-    return _models.delete(db_cls=Assistant, id=id, user_id=user_id, mode=mode, session=session)
+    return _models.delete(db_cls=Assistant, id=id, user_id=user_id, mode=mode, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
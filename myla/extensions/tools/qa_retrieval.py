@@ -1,3 +1,4 @@
+import asyncio
 import json
 from myla.vectorstores import get_default_vectorstore
 from myla.tools import Tool, Context
@@ -6,6 +7,8 @@ import logging
 
 
 class QARetrievalTool(Tool):
+    parallel = True
+
     def __init__(self) -> None:
         super().__init__()
         self._vs = get_default_vectorstore()
@@ -34,8 +37,8 @@ class QARetrievalTool(Tool):
         query = context.messages[-1]['content']
 
         records = []
-        for c in collections:
-            r_records = await self._vs.asearch(collection=c, query=query, **args)
+        results = await asyncio.gather(*[self._vs.asearch(collection=c, query=query, **args) for c in collections])
+        for r_records in results:
             for r in r_records:
                 records.append(r)
         records.sort(key=lambda r: r['_distance'], reverse=True)
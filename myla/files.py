@@ -1,6 +1,7 @@
 from typing import List, Optional, Union
 from sqlmodel import Field, Session, select
 from . import _models
+from ._object_cache import ObjectCache
 
 
 class FileUpload(_models.MetadataModel):
@@ -47,12 +48,12 @@ def get(id: str, user_id: str = None, session: Optional[Session] = None) -> Unio
     Returns:
         if file exists return FileRead object else return None
     """
-    return _models.get(db_cls=File, read_cls=FileRead, id=id, user_id=user_id, session=session)
+    return _models.get(db_cls=File, read_cls=FileRead, id=id, user_id=user_id, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
 def delete(id: str, user_id: str = None, mode="soft", session: Optional[Session] = None) -> _models.DeletionStatus:
-    return _models.delete(db_cls=File, id=id, user_id=user_id, mode=mode, session=session)
+    return _models.delete(db_cls=File, id=id, user_id=user_id, mode=mode, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
@@ -63,26 +64,10 @@ def list(purpose: str = None, limit: int = 20, order: str = "desc", after: str =
     if purpose:
         select_stmt = select_stmt.filter(File.purpose == purpose)
 
-    select_stmt = select_stmt.order_by(-File.created_at if order == "desc" else File.created_at)
-    if after:
-        f = get(id=after, user_id=user_id, session=session)
-        if f:
-            select_stmt = select_stmt.filter(File.created_at > f.created_at)
-    if before:
-        f = get(id=before, user_id=user_id, session=session)
-        if f:
-            select_stmt = select_stmt.filter(File.created_at < f.created_at)
-
     if user_id:
         select_stmt = select_stmt.filter(File.user_id == user_id)
     if org_id:
         select_stmt = select_stmt.filter(File.org_id == org_id)
 
-    select_stmt = select_stmt.limit(limit)
-
-    dbos = session.exec(select_stmt).all()
-    rs = []
-    for dbo in dbos:
-        rs.append(dbo.to_read(FileRead))
-    r = FileList(data=rs)
-    return r
+    select_stmt, reverse = _models.keyset(File, select_stmt, limit=limit, order=order, after=after, before=before)
+    return _models.to_page(session.exec(select_stmt).all(), read_cls=FileRead, list_cls=FileList, limit=limit, reverse=reverse)
@@ -1,11 +1,15 @@
 import os
+import threading
 
 from .backend import LLM, Usage
 
+_backends = {}
+_lock = threading.Lock()
+
 
 def get(model_name=None):
     """
-    Get LLM
+    Get LLM, backends are created once per model name and shared.
     """
     if not model_name:
         model_name = os.environ.get("DEFAULT_LLM_MODEL_NAME")
@@ -13,6 +17,17 @@ def get(model_name=None):
     if not model_name:
         raise ValueError(f"Invalid LLM backend: {model_name}, you should set DEFAULT_LLM_MODEL_NAME in environment variables.")
 
+    llm = _backends.get(model_name)
+    if llm is None:
+        with _lock:
+            llm = _backends.get(model_name)
+            if llm is None:
+                llm = _create(model_name)
+                _backends[model_name] = llm
+    return llm
+
+
+def _create(model_name):
     idx = model_name.find("@")
 
     backend = model_name[:idx] if idx != -1 else "openai"
@@ -38,8 +53,8 @@ def list_models():
     if os.environ.get("LLM_ENDPOINT"):
         endpoint = os.environ.get("LLM_ENDPOINT")
         api_key = os.environ.get("LLM_API_KEY")
-        import openai
-        client = openai.OpenAI(api_key=api_key, base_url=endpoint)
+        from .openai import get_client
+        client = get_client(api_key=api_key, base_url=endpoint)
         openai_models = client.models.list()
         for m in openai_models.data:
             models[m.id] = m
@@ -1,5 +1,9 @@
+import asyncio
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
+from .._env import env_int
 from .backend import LLM
 
 from chatglm_cpp import Pipeline, ChatMessage
@@ -20,29 +24,97 @@ class ChatGLM(LLM):
         return await generate(instructions=instructions, model=model, stream=stream, **kwargs)
 
 
+_pipelines: Dict[str, Pipeline] = {}
+_pipelines_lock = threading.Lock()
+_model_slots: Dict[str, asyncio.Semaphore] = {}
+_executor = None
+_END = object()
+
+
+def get_pipeline(model: str) -> Pipeline:
+    """Returns the Pipeline of the model, a model is loaded once per process."""
+    pipeline = _pipelines.get(model)
+    if pipeline is None:
+        with _pipelines_lock:
+            pipeline = _pipelines.get(model)
+            if pipeline is None:
+                pipeline = Pipeline(model)
+                _pipelines[model] = pipeline
+    return pipeline
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=env_int("CHATGLM_MAX_WORKERS", 4), thread_name_prefix="chatglm")
+    return _executor
+
+
+def _get_model_slots(model: str) -> asyncio.Semaphore:
+    slots = _model_slots.get(model)
+    if slots is None:
+        slots = asyncio.Semaphore(max(env_int("CHATGLM_MODEL_CONCURRENCY", 1), 1))
+        _model_slots[model] = slots
+    return slots
+
+
+async def _generate(model: str, messages: List[ChatMessage], **kwargs):
+    """Run the generation in the executor and yield its chunks, at most CHATGLM_MODEL_CONCURRENCY generations per model."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed
+            stop.set()
+
+    def produce():
+        try:
+            g = get_pipeline(model).chat(messages=messages, stream=True, **kwargs)
+            for c in g:
+                if stop.is_set():
+                    break
+                put(c.content)
+        except Exception as e:
+            put(e)
+        finally:
+            put(_END)
+
+    async with _get_model_slots(model):
+        future = loop.run_in_executor(_get_executor(), produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stop the generation if the consumer went away, the slot is released once the thread is done
+            stop.set()
+            await future
+
+
 async def chat(messages: List[Dict], model=None, stream=False, **kwargs):
     if not model:
         model = os.environ.get("DEFAULT_LLM_MODEL_NAME")
 
-    pipeline = Pipeline(model)
     history = []
     for m in messages:
         #history.append(f"{m['role']}: {m['content']}")
         history.append(ChatMessage(role=m['role'], content=m['content']))
 
-    g = pipeline.chat(
-        messages=history,
-        stream=True,
-    **kwargs)
+    g = _generate(model, history, **kwargs)
     if stream:
-        async def iter():
-            for c in g:
-                yield c.content
-        return iter()
+        return g
     else:
         genreated = []
-        for c in g:
-            genreated.append(c.content)
+        async for c in g:
+            genreated.append(c)
         return ''.join(genreated)
 
 
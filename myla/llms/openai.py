@@ -1,10 +1,66 @@
+import asyncio
 import os
+import threading
+import weakref
 from typing import Dict, List
 
+import httpx
 import openai
 
-from .. import utils
+from .._env import env_int
 from .backend import LLM
+from .retry import default_policy, retry_async, retry_sync
+
+_clients: Dict = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {(api_key, base_url): AsyncOpenAI}
+_lock = threading.Lock()
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=env_int("LLM_HTTP_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=env_int("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20),
+        keepalive_expiry=env_int("LLM_HTTP_KEEPALIVE_EXPIRY", 30)
+    )
+
+
+def get_async_client(api_key=None, base_url=None) -> openai.AsyncOpenAI:
+    """Returns the AsyncOpenAI client of (api_key, base_url), its connection pool is shared by the calls of the event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = {}
+        _async_clients[loop] = clients
+
+    key = (api_key, base_url)
+    client = clients.get(key)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,  # retried by retry_async
+            http_client=openai.DefaultAsyncHttpxClient(limits=_http_limits())
+        )
+        clients[key] = client
+    return client
+
+
+def get_client(api_key=None, base_url=None) -> openai.OpenAI:
+    """Returns the OpenAI client of (api_key, base_url), shared by all threads."""
+    key = (api_key, base_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=0,  # retried by retry_sync
+                    http_client=openai.DefaultHttpxClient(limits=_http_limits())
+                )
+                _clients[key] = client
+    return client
 
 
 class OpenAI(LLM):
@@ -58,13 +114,13 @@ async def chat(messages: List[Dict], model=None, stream=False, api_key=None, bas
     if not model:
         model = os.environ.get("DEFAULT_LLM_MODEL_NAME")
 
-    llm = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+    llm = get_async_client(api_key=api_key, base_url=base_url)
 
     usage = None
     if "usage" in kwargs:
         usage = kwargs.pop("usage")
 
-    @utils.retry
+    @retry_async(default_policy())
     async def _call():
         resp = await llm.chat.completions.create(
             model=model,
@@ -74,8 +130,12 @@ async def chat(messages: List[Dict], model=None, stream=False, api_key=None, bas
         )
         if stream:
             async def iter():
-                async for r in resp:
-                    yield r.choices[0].delta.content if r.choices else 'Unexpected LLM error, possibly due to context being too long.'
+                try:
+                    async for r in resp:
+                        yield r.choices[0].delta.content if r.choices else 'Unexpected LLM error, possibly due to context being too long.'
+                finally:
+                    # Release the upstream connection when the run is cancelled
+                    await resp.close()
             return iter()
         else:
             genereated = resp.choices[0].message.content
@@ -103,13 +163,13 @@ def sync_chat(messages: List[Dict], model=None, stream=False, api_key=None, base
     if not model:
         model = os.environ.get("DEFAULT_LLM_MODEL_NAME")
 
-    llm = openai.OpenAI(api_key=api_key, base_url=base_url)
+    llm = get_client(api_key=api_key, base_url=base_url)
 
     usage = None
     if "usage" in kwargs:
         usage = kwargs.pop("usage")
 
-    @utils.retry
+    @retry_sync(default_policy())
     def _call():
         resp = llm.chat.completions.create(
             model=model,
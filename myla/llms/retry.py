@@ -0,0 +1,189 @@
+import asyncio
+import email.utils
+import functools
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import httpx
+import openai
+
+from .._env import env_int
+from .._logging import logger
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable(e: Exception) -> bool:
+    """Whether the error is transient: connection errors, timeouts, 408/409/429 and 5xx responses."""
+    if isinstance(e, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500
+    return False
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds to wait requested by the Retry-After(-Ms) header of the error response."""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    v = headers.get("retry-after-ms")
+    if v:
+        try:
+            return float(v) / 1000
+        except ValueError:
+            pass
+
+    v = headers.get("retry-after")
+    if v:
+        try:
+            return float(v)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(v).timestamp() - datetime.now().timestamp(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class RetryBudget:
+    """Limits retries to a ratio of the calls, so retries can not amplify an upstream outage.
+
+    Every call deposits `ratio` token, every retry withdraws one. `min_retries` tokens are
+    available at start and the balance is capped to `min_retries` plus the deposits of
+    `1 / ratio` calls.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10) -> None:
+        self._ratio = ratio
+        self._cap = min_retries + 1
+        self._balance = float(min_retries)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._balance + self._ratio, self._cap)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honoring Retry-After up to `max_retry_after` seconds."""
+
+    def __init__(
+        self,
+        max_retries: int = 2,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        max_retry_after: float = 60.0,
+        budget: Optional[RetryBudget] = None
+    ) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget if budget else RetryBudget()
+
+        self.retries = 0
+        self.gave_up = 0
+
+    def delay(self, attempt: int, e: Exception) -> Optional[float]:
+        """Seconds to wait before the retry following the failed `attempt`, None to give up."""
+        if attempt >= self.max_retries or not is_retryable(e):
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        after = retry_after(e)
+        if after is not None:
+            if after > self.max_retry_after:
+                return None
+            delay = max(delay, after)
+
+        if not self.budget.withdraw():
+            logger.warn(f"LLM retry budget exhausted, e={e}")
+            return None
+        return delay
+
+    def stats(self):
+        return {"retries": self.retries, "gave_up": self.gave_up}
+
+
+def _log(func, attempt, delay, e):
+    logger.warn(f"Retry {getattr(func, '__qualname__', func)} in {delay:.2f}s, attempt={attempt + 1}, e={e}")
+
+
+def retry_async(policy: RetryPolicy):
+    """Retry an async function according to the policy, waiting without blocking the event loop."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            policy.budget.deposit()
+            attempt = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    delay = policy.delay(attempt, e)
+                    if delay is None:
+                        if attempt > 0 or is_retryable(e):
+                            policy.gave_up += 1
+                        raise
+                    _log(func, attempt, delay, e)
+                    policy.retries += 1
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        return inner
+    return decorator
+
+
+def retry_sync(policy: RetryPolicy):
+    """Retry a function according to the policy, for the sync API called out of the event loop."""
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            policy.budget.deposit()
+            attempt = 0
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    delay = policy.delay(attempt, e)
+                    if delay is None:
+                        if attempt > 0 or is_retryable(e):
+                            policy.gave_up += 1
+                        raise
+                    _log(func, attempt, delay, e)
+                    policy.retries += 1
+                    attempt += 1
+                    time.sleep(delay)
+        return inner
+    return decorator
+
+
+_default = None
+
+
+def default_policy() -> RetryPolicy:
+    """The policy of the LLM calls, configured by LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY and LLM_RETRY_BUDGET_RATIO."""
+    global _default
+
+    if _default is None:
+        _default = RetryPolicy(
+            max_retries=env_int("LLM_MAX_RETRIES", 2),
+            base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5)),
+            max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", 20)),
+            budget=RetryBudget(ratio=float(os.environ.get("LLM_RETRY_BUDGET_RATIO", 0.2)))
+        )
+    return _default
@@ -0,0 +1,51 @@
+import math
+import os
+import re
+from typing import Dict, List
+
+from .._logging import logger
+
+# Tokens added by the chat format to every message
+MESSAGE_OVERHEAD = 4
+
+_CJK = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(os.environ.get("LLM_TOKENIZER", "cl100k_base"))
+        except Exception as e:
+            logger.debug(f"tiktoken not available, tokens are estimated: {e}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text with tiktoken if it is installed, else estimate them.
+
+    The estimate counts a token per CJK character and per 4 other characters.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_message_tokens(message: Dict) -> int:
+    content = message.get("content")
+    return count_tokens(content if isinstance(content, str) else str(content)) + MESSAGE_OVERHEAD
+
+
+def count_messages_tokens(messages: List[Dict]) -> int:
+    return sum(count_message_tokens(m) for m in messages)
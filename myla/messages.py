@@ -1,9 +1,12 @@
 from typing import Dict, List, Optional, Union
 
 from pydantic import BaseModel
+from sqlalchemy import Index
 from sqlmodel import JSON, Field, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from . import _models
+from .llms.tokens import MESSAGE_OVERHEAD, count_tokens
 
 
 class MessageText(BaseModel):
@@ -48,6 +51,28 @@ class Message(_models.DBModel, table=True):
     role: str
     content: List[Dict] = Field(sa_type=JSON)
     file_ids: Optional[List[str]] = Field(sa_type=JSON, default=None)
+    token_count: Optional[int] = None
+
+    @classmethod
+    def composite_indexes(cls):
+        # Messages of a thread, in list or history order
+        return (Index("ix_message_thread_id_is_deleted_created_at_id", "thread_id", "is_deleted", "created_at", "id"),)
+
+    def text(self) -> str:
+        return ''.join(t["value"] for c in self.content if c.get("type") == "text" for t in (c.get("text") or []))
+
+
+def _new(thread_id: str, message: MessageCreate, assistant_id: Optional[str] = None, run_id: Optional[str] = None) -> Message:
+    return Message(
+        thread_id=thread_id,
+        role=message.role,
+        content=[
+            MessageContent(type="text", text=[MessageText(value=message.content)]).model_dump()
+        ],
+        assistant_id=assistant_id,
+        run_id=run_id,
+        token_count=count_tokens(message.content)
+    )
 
 
 @_models.auto_session
@@ -59,26 +84,43 @@ def create(
     tag: Optional[str] = None,
     user_id: Optional[str] = None,
     org_id: Optional[str] = None,
-    session: Session = None
+    session: Session = None,
+    auto_commit=True
 ) -> MessageRead:
-    db_model = Message(
-        thread_id=thread_id,
-        role=message.role,
-        content=[
-            MessageContent(type="text", text=[MessageText(value=message.content)]).model_dump()
-        ],
-        assistant_id=assistant_id,
-        run_id=run_id
+    dbo = _models.create(
+        object="thread.message",
+        meta_model=message,
+        db_model=_new(thread_id=thread_id, message=message, assistant_id=assistant_id, run_id=run_id),
+        tag=tag,
+        user_id=user_id,
+        org_id=org_id,
+        session=session,
+        auto_commit=auto_commit
     )
+    return dbo.to_read(MessageRead)
 
-    dbo = _models.create(
+
+@_models.auto_async_session
+async def acreate(
+    thread_id: str,
+    message: MessageCreate,
+    assistant_id: Optional[str] = None,
+    run_id: Optional[str] = None,
+    tag: Optional[str] = None,
+    user_id: Optional[str] = None,
+    org_id: Optional[str] = None,
+    session: AsyncSession = None,
+    auto_commit=True
+) -> MessageRead:
+    dbo = await _models.acreate(
         object="thread.message",
         meta_model=message,
-        db_model=db_model,
+        db_model=_new(thread_id=thread_id, message=message, assistant_id=assistant_id, run_id=run_id),
         tag=tag,
         user_id=user_id,
         org_id=org_id,
-        session=session
+        session=session,
+        auto_commit=auto_commit
     )
     return dbo.to_read(MessageRead)
 
@@ -100,6 +142,17 @@ def get(id: str, thread_id: str = None, user_id: str = None, session: Session =
     return r
 
 
+@_models.auto_async_session
+async def aget(id: str, thread_id: str = None, user_id: str = None, session: AsyncSession = None) -> Union[MessageRead, None]:
+    r = await _models.aget(db_cls=Message, read_cls=MessageRead, id=id, user_id=None, session=session)
+    if not r:
+        return None
+
+    if thread_id is not None and thread_id != r.thread_id:
+        return None
+    return r
+
+
 @_models.auto_session
 def modify(id: str, message: MessageModify, thread_id: str = None, user_id: str = None, session: Session = None) -> Union[MessageRead, None]:
     if thread_id is not None:
@@ -109,6 +162,15 @@ def modify(id: str, message: MessageModify, thread_id: str = None, user_id: str
     return _models.modify(db_cls=Message, read_cls=MessageRead, id=id, to_update=message.model_dump(exclude_unset=True), user_id=user_id, session=session)
 
 
+@_models.auto_async_session
+async def amodify(id: str, message: MessageModify, thread_id: str = None, user_id: str = None, session: AsyncSession = None) -> Union[MessageRead, None]:
+    if thread_id is not None:
+        msg = await aget(id=id, thread_id=thread_id, user_id=user_id, session=session)
+        if not msg:
+            return None
+    return await _models.amodify(db_cls=Message, read_cls=MessageRead, id=id, to_update=message.model_dump(exclude_unset=True), user_id=user_id, session=session)
+
+
 @_models.auto_session
 def delete(id: str, thread_id: str = None, user_id: str = None, mode="soft", session: Optional[Session] = None) -> _models.DeletionStatus:
     if thread_id is not None:
@@ -118,6 +180,26 @@ def delete(id: str, thread_id: str = None, user_id: str = None, mode="soft", ses
     return _models.delete(db_cls=Message, id=id, user_id=user_id, mode=mode, session=session)
 
 
+@_models.auto_async_session
+async def adelete(id: str, thread_id: str = None, user_id: str = None, mode="soft", session: Optional[AsyncSession] = None) -> _models.DeletionStatus:
+    if thread_id is not None:
+        msg = await aget(id=id, thread_id=thread_id, user_id=user_id, session=session)
+        if not msg:
+            return None
+    return await _models.adelete(db_cls=Message, id=id, user_id=user_id, mode=mode, session=session)
+
+
+def _list_stmt(thread_id: str, tag: Optional[str] = None):
+    select_stmt = select(Message)
+    select_stmt = select_stmt.filter(Message.is_deleted == False)
+    select_stmt = select_stmt.where(Message.thread_id == thread_id)
+
+    if tag:
+        select_stmt = select_stmt.filter(Message.tag == tag)
+
+    return select_stmt
+
+
 @_models.auto_session
 def list(
     thread_id: str,
@@ -134,28 +216,107 @@ def list(
     #    if not thread:
     #        return MessageList(data=[])
 
+    select_stmt, reverse = _models.keyset(Message, _list_stmt(thread_id=thread_id, tag=tag), limit=limit, order=order, after=after, before=before)
+    return _models.to_page(session.exec(select_stmt).all(), read_cls=MessageRead, list_cls=MessageList, limit=limit, reverse=reverse)
+
+
+@_models.auto_async_session
+async def alist(
+    thread_id: str,
+    limit: Optional[int] = 20,
+    order: Optional[str] = "desc",
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    tag: Optional[str] = None,
+    user_id: Optional[str] = None,
+    session: AsyncSession = None
+) -> MessageList:
+    select_stmt, reverse = _models.keyset(Message, _list_stmt(thread_id=thread_id, tag=tag), limit=limit, order=order, after=after, before=before)
+    return _models.to_page((await session.exec(select_stmt)).all(), read_cls=MessageRead, list_cls=MessageList, limit=limit, reverse=reverse)
+
+
+def _list_by_tokens_stmt(thread_id: str, limit: Optional[int], batch_size: int):
     select_stmt = select(Message)
     select_stmt = select_stmt.filter(Message.is_deleted == False)
     select_stmt = select_stmt.where(Message.thread_id == thread_id)
+    select_stmt = select_stmt.order_by(Message.created_at.desc(), Message.id.desc())
+    if limit is not None:
+        select_stmt = select_stmt.limit(limit)
+    return select_stmt.execution_options(yield_per=batch_size)
 
-    select_stmt = select_stmt.order_by(-Message.created_at if order == "desc" else Message.created_at)
-    if after:
-        m = get(id=after, thread_id=thread_id, user_id=user_id, session=session)
-        if m:
-            select_stmt = select_stmt.filter(Message.created_at > m.created_at)
-    if before:
-        m = get(id=before, thread_id=thread_id, user_id=user_id, session=session)
-        if m:
-            select_stmt = select_stmt.filter(Message.created_at < m.created_at)
 
-    if tag:
-        select_stmt = select_stmt.filter(Message.tag == tag)
+@_models.auto_session
+def list_by_tokens(
+    thread_id: str,
+    max_tokens: int,
+    limit: Optional[int] = None,
+    batch_size: int = 50,
+    session: Session = None,
+    auto_commit=True
+) -> List[MessageRead]:
+    """List the newest messages of the thread which fit in max_tokens, oldest first.
+
+    The newest message is always listed, unless limit is 0. Messages are fetched batch_size rows at a time,
+    so the older messages of a long thread are not loaded. Token counts missing on message rows are counted and stored.
+    """
+    if limit is not None and limit <= 0:
+        return []
 
-    select_stmt = select_stmt.limit(limit)
+    rs = []
+    total = 0
+    counted = False
+    result = session.exec(_list_by_tokens_stmt(thread_id=thread_id, limit=limit, batch_size=batch_size))
+    try:
+        for dbo in result:
+            if dbo.token_count is None:
+                dbo.token_count = count_tokens(dbo.text())
+                session.add(dbo)
+                counted = True
+
+            tokens = dbo.token_count + MESSAGE_OVERHEAD
+            if rs and total + tokens > max_tokens:
+                break
+            total += tokens
+            rs.append(dbo.to_read(MessageRead))
+    finally:
+        result.close()
+
+    if counted and auto_commit:
+        session.commit()
+    return rs[::-1]
+
+
+@_models.auto_async_session
+async def alist_by_tokens(
+    thread_id: str,
+    max_tokens: int,
+    limit: Optional[int] = None,
+    batch_size: int = 50,
+    session: AsyncSession = None,
+    auto_commit=True
+) -> List[MessageRead]:
+    if limit is not None and limit <= 0:
+        return []
 
-    dbos = session.exec(select_stmt).all()
     rs = []
-    for dbo in dbos:
-        rs.append(dbo.to_read(MessageRead))
-    r = MessageList(data=rs, first_id=rs[0].id if len(rs) > 0 else None, last_id=rs[-1].id if len(rs) > 0 else None)
-    return r
+    total = 0
+    counted = False
+    result = await session.stream_scalars(_list_by_tokens_stmt(thread_id=thread_id, limit=limit, batch_size=batch_size))
+    try:
+        async for dbo in result:
+            if dbo.token_count is None:
+                dbo.token_count = count_tokens(dbo.text())
+                session.add(dbo)
+                counted = True
+
+            tokens = dbo.token_count + MESSAGE_OVERHEAD
+            if rs and total + tokens > max_tokens:
+                break
+            total += tokens
+            rs.append(dbo.to_read(MessageRead))
+    finally:
+        await result.close()
+
+    if counted and auto_commit:
+        await session.commit()
+    return rs[::-1]
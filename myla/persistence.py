@@ -1,23 +1,118 @@
 from typing import Optional, Dict, Any
 import os
 import json
+import atexit
+import tempfile
 
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ._env import env_int
 from ._logging import logger
 
+# Async drivers of the database dialects, used when DATABASE_ASYNC_URL is not specified
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+
+
+def _json_serializer(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _pool_args(backend: str) -> Dict[str, Any]:
+    """Pool parameters set by DATABASE_POOL_*, the SQLAlchemy defaults are kept for the unset ones."""
+    args = {}
+    for name, arg in (
+        ("DATABASE_POOL_SIZE", "pool_size"),
+        ("DATABASE_MAX_OVERFLOW", "max_overflow"),
+        ("DATABASE_POOL_TIMEOUT", "pool_timeout"),
+        ("DATABASE_POOL_RECYCLE", "pool_recycle"),
+    ):
+        if os.environ.get(name):
+            args[arg] = env_int(name)
+
+    # Stale connections of database servers are replaced on checkout, a SQLite file is never stale
+    pre_ping = os.environ.get("DATABASE_POOL_PRE_PING")
+    args["pool_pre_ping"] = pre_ping.lower() in ("1", "true", "yes") if pre_ping else backend != "sqlite"
+    return args
+
+
+def _sqlite_pragmas() -> Dict[str, Any]:
+    """The pragmas applied on SQLite connections, set by SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS and SQLITE_BUSY_TIMEOUT."""
+    pragmas = {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": env_int("SQLITE_BUSY_TIMEOUT", 5000),
+    }
+    return {k: v for k, v in pragmas.items() if v}
+
+
+class PoolStats:
+    """Counts the connections opened and checked out of an engine pool."""
+
+    def __init__(self, engine, pragmas: Optional[Dict[str, Any]] = None) -> None:
+        self._pool = engine.pool
+        self._pragmas = pragmas
+        self.connects = 0
+        self.checkouts = 0
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+        if self._pragmas:
+            cursor = dbapi_connection.cursor()
+            for k, v in self._pragmas.items():
+                cursor.execute(f"PRAGMA {k}={v}")
+            cursor.close()
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        r = {"pool": type(self._pool).__name__, "connects": self.connects, "checkouts": self.checkouts}
+        # Only queue pools are sized
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            f = getattr(self._pool, name, None)
+            if f:
+                r[name] = f()
+        return r
+
 
 class Persistence:
     _instance = None
 
-    def __init__(self, database_url: Optional[str] = None, connect_args: Optional[Dict[str, Any]] = None) -> None:
+    def __init__(
+        self,
+        database_url: Optional[str] = None,
+        connect_args: Optional[Dict[str, Any]] = None,
+        async_database_url: Optional[str] = None,
+        pool_args: Optional[Dict[str, Any]] = None
+    ) -> None:
         self._database_url = database_url
         self._connect_args = connect_args
+        self._async_database_url = async_database_url
 
         if not database_url and 'DATABASE_URL' in os.environ:
             self._database_url = os.environ['DATABASE_URL']
         if not connect_args and 'DATABASE_CONNECT_ARGS' in os.environ:
             self._connect_args = json.loads(
                 os.environ['DATABASE_CONNECT_ARGS'])
+        if not async_database_url and 'DATABASE_ASYNC_URL' in os.environ:
+            self._async_database_url = os.environ['DATABASE_ASYNC_URL']
         if not self._database_url:
             self._database_url = f"sqlite:///{os.path.join(os.getcwd(), 'myla.db')}"
             logger.warn(f"DATABASE_URL not specified, use {self._database_url}")
@@ -25,22 +120,78 @@ class Persistence:
         if not self._connect_args:
             self._connect_args = {}
 
+        url = make_url(self._database_url)
+        if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+            # The sync and async engines can not share an in-memory database, use a temporary one
+            fd, path = tempfile.mkstemp(prefix="myla-", suffix=".db")
+            os.close(fd)
+            atexit.register(_remove, path)
+            self._database_url = f"{url.drivername}:///{path}"
+
+        self._pool_args = {**_pool_args(url.get_backend_name()), **(pool_args or {})}
+        self._pragmas = _sqlite_pragmas() if url.get_backend_name() == "sqlite" else None
+
         self._engine = create_engine(
             self._database_url,
             connect_args=self._connect_args,
-            json_serializer=lambda obj: json.dumps(obj, ensure_ascii=False)
+            json_serializer=_json_serializer,
+            **self._pool_args
         )
+        self._pool_stats = PoolStats(self._engine, pragmas=self._pragmas)
+        self._async_engine = None
+        self._async_pool_stats = None
 
     @property
     def engine(self):
         return self._engine
 
+    @property
+    def async_engine(self):
+        """The engine of the async sessions, created on first use."""
+        if self._async_engine is None:
+            url = self.async_database_url
+            connect_args = self._connect_args if make_url(url).get_backend_name() == "sqlite" else {}
+            self._async_engine = create_async_engine(
+                url,
+                connect_args=connect_args,
+                json_serializer=_json_serializer,
+                **self._pool_args
+            )
+            self._async_pool_stats = PoolStats(self._async_engine.sync_engine, pragmas=self._pragmas)
+        return self._async_engine
+
+    @property
+    def async_database_url(self) -> str:
+        if self._async_database_url:
+            return self._async_database_url
+
+        url = make_url(self._database_url)
+        backend = url.get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            raise ValueError(f"No async driver for database {backend}, please specify DATABASE_ASYNC_URL")
+        return self._database_url.replace(f"{url.drivername}:", f"{backend}+{ASYNC_DRIVERS[backend]}:", 1)
+
     def create_session(self) -> Session:
         return Session(self._engine)
 
+    def create_async_session(self) -> AsyncSession:
+        # Objects stay loaded after commit, attributes can not be lazily refreshed out of the greenlet
+        return AsyncSession(self.async_engine, expire_on_commit=False)
+
     def initialize_database(self):
         SQLModel.metadata.create_all(self._engine)
 
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "sync": self._pool_stats.metrics(),
+            "async": self._async_pool_stats.metrics() if self._async_pool_stats else None,
+        }
+
+    async def dispose(self):
+        """Close the connections of the async engine."""
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+
     @staticmethod
     def default():
         if not Persistence._instance:
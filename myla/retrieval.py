@@ -1,3 +1,4 @@
+import asyncio
 import json
 from .vectorstores import get_default_vectorstore
 from .tools import Tool, Context
@@ -14,6 +15,8 @@ RETRIEVAL_INSTRUCTIONS_ZH = """
 
 
 class RetrievalTool(Tool):
+    parallel = True
+
     def __init__(self) -> None:
         super().__init__()
         self._vs = get_default_vectorstore()
@@ -23,7 +26,7 @@ class RetrievalTool(Tool):
             logger.debug("History is empty, skip retrieval")
             return
 
-        collections = context.file_ids if context.file_ids else []
+        collections = list(context.file_ids) if context.file_ids else []
 
         if 'retrieval_collection' in context.run_metadata:
             collections.append(context.run_metadata["retrieval_collection"])
@@ -43,8 +46,8 @@ class RetrievalTool(Tool):
         query = context.messages[-1]["content"]
 
         docs = []
-        for c in collections:
-            r_docs = await self._vs.asearch(collection=c, query=query, **args)
+        results = await asyncio.gather(*[self._vs.asearch(collection=c, query=query, **args) for c in collections])
+        for r_docs in results:
             for doc in r_docs:
                 if doc['_distance'] < distance:
                     docs.append(doc)
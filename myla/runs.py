@@ -1,7 +1,11 @@
+from datetime import datetime
 from typing import Any, Dict, List, Optional, Union
 
 from pydantic import BaseModel
-from sqlmodel import JSON, Field, Session, select
+from sqlalchemy import Index
+from sqlalchemy import update as sql_update
+from sqlmodel import JSON, Field, Session, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from . import _models
 
@@ -33,6 +37,7 @@ class RunBase(BaseModel):
     expires_at: Optional[int] = None
     started_at: Optional[int] = None
     failed_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
     completed_at: Optional[int] = None
 
 
@@ -49,6 +54,15 @@ class Run(_models.DBModel, RunBase, table=True):
     Represents an assistant that can call the model and use tools.
     """
 
+    @classmethod
+    def composite_indexes(cls):
+        return (
+            # Runs of a thread
+            Index("ix_run_thread_id_is_deleted_created_at_id", "thread_id", "is_deleted", "created_at", "id"),
+            # Runs claimed and recovered by status, oldest first
+            Index("ix_run_status_is_deleted_created_at", "status", "is_deleted", "created_at"),
+        )
+
 
 class ThreadRunCreate(_models.MetadataModel):
     assistant_id: str
@@ -73,13 +87,35 @@ class RunStep(_models.DBModel, _models.MetadataModel):
     completed_at: Optional[int]
 
 
-@_models.auto_session
-def create(thread_id: str, run: RunCreate, user_id: str = None, org_id: str = None, session: Session = None) -> Union[RunRead, None]:
+def _new(thread_id: str, run: RunCreate) -> Run:
     db_model = Run.model_validate(run)
     db_model.thread_id = thread_id
     db_model.status = "queued"
+    return db_model
+
 
-    dbo = _models.create(object="thread.run", meta_model=run, db_model=db_model, user_id=user_id, org_id=org_id, session=session)
+def _set_deadline(dbo: Run, timeout: Optional[float]):
+    if timeout and timeout > 0:
+        dbo.expires_at = int(dbo.created_at / 1000 + timeout)
+
+
+@_models.auto_session
+def create(thread_id: str, run: RunCreate, user_id: str = None, org_id: str = None, timeout: Optional[float] = None, session: Session = None) -> Union[RunRead, None]:
+    """Create a queued run, which expires `timeout` seconds after its creation if set."""
+    dbo = _models.create(object="thread.run", meta_model=run, db_model=_new(thread_id, run), user_id=user_id, org_id=org_id, session=session, auto_commit=False)
+    _set_deadline(dbo, timeout)
+    session.commit()
+    session.refresh(dbo)
+
+    return dbo.to_read(RunRead)
+
+
+@_models.auto_async_session
+async def acreate(thread_id: str, run: RunCreate, user_id: str = None, org_id: str = None, timeout: Optional[float] = None, session: AsyncSession = None) -> Union[RunRead, None]:
+    dbo = await _models.acreate(object="thread.run", meta_model=run, db_model=_new(thread_id, run), user_id=user_id, org_id=org_id, session=session, auto_commit=False)
+    _set_deadline(dbo, timeout)
+    await session.commit()
+    await session.refresh(dbo)
 
     return dbo.to_read(RunRead)
 
@@ -87,7 +123,15 @@ def create(thread_id: str, run: RunCreate, user_id: str = None, org_id: str = No
 @_models.auto_session
 def get(thread_id: str, run_id: str, user_id: str = None, session: Session = None) -> Union[RunRead, None]:
     r = _models.get(db_cls=Run, read_cls=RunRead, id=run_id, user_id=user_id, session=session)
-    if r.thread_id != thread_id:
+    if r is None or r.thread_id != thread_id:
+        return None
+    return r
+
+
+@_models.auto_async_session
+async def aget(thread_id: str, run_id: str, user_id: str = None, session: AsyncSession = None) -> Union[RunRead, None]:
+    r = await _models.aget(db_cls=Run, read_cls=RunRead, id=run_id, user_id=user_id, session=session)
+    if r is None or r.thread_id != thread_id:
         return None
     return r
 
@@ -97,11 +141,36 @@ def modify(id: str, run: RunModify, user_id: str = None, session: Session = None
     return _models.modify(db_cls=Run, read_cls=RunRead, id=id, to_update=run.model_dump(exclude_unset=True), user_id=user_id, session=session)
 
 
+@_models.auto_async_session
+async def amodify(id: str, run: RunModify, user_id: str = None, session: AsyncSession = None) -> Union[RunRead, None]:
+    return await _models.amodify(db_cls=Run, read_cls=RunRead, id=id, to_update=run.model_dump(exclude_unset=True), user_id=user_id, session=session)
+
+
 @_models.auto_session
 def delete(id: str, user_id: str = None, mode="soft", session: Optional[Session] = None) -> _models.DeletionStatus:
     return _models.delete(db_cls=Run, id=id, user_id=user_id, mode=mode, session=session)
 
 
+@_models.auto_async_session
+async def adelete(id: str, user_id: str = None, mode="soft", session: Optional[AsyncSession] = None) -> _models.DeletionStatus:
+    return await _models.adelete(db_cls=Run, id=id, user_id=user_id, mode=mode, session=session)
+
+
+def _list_stmt(thread_id: str, user_id: str = None, org_id: str = None):
+    select_stmt = select(Run)
+    select_stmt = select_stmt.filter(Run.is_deleted == False)
+
+    if thread_id:
+        select_stmt = select_stmt.filter(Run.thread_id == thread_id)
+
+    if user_id:
+        select_stmt = select_stmt.filter(Run.user_id == user_id)
+    if org_id:
+        select_stmt = select_stmt.filter(Run.org_id == org_id)
+
+    return select_stmt
+
+
 @_models.auto_session
 def list(
         thread_id: str,
@@ -113,40 +182,68 @@ def list(
         org_id: str = None,
         session: Optional[Session] = None
     ) -> RunList:
-    select_stmt = select(Run)
-    select_stmt = select_stmt.filter(Run.is_deleted == False)
+    select_stmt = _list_stmt(thread_id=thread_id, user_id=user_id, org_id=org_id)
+    select_stmt, reverse = _models.keyset(Run, select_stmt, limit=limit, order=order, after=after, before=before)
+    return _models.to_page(session.exec(select_stmt).all(), read_cls=RunRead, list_cls=RunList, limit=limit, reverse=reverse)
 
-    if thread_id:
-        select_stmt = select_stmt.filter(Run.thread_id == thread_id)
 
-    select_stmt = select_stmt.order_by(-Run.created_at if order == "desc" else Run.created_at)
+@_models.auto_async_session
+async def alist(
+        thread_id: str,
+        limit: int = 20,
+        order: str = "desc",
+        after: str = None,
+        before: str = None,
+        user_id: str = None,
+        org_id: str = None,
+        session: Optional[AsyncSession] = None
+    ) -> RunList:
+    select_stmt = _list_stmt(thread_id=thread_id, user_id=user_id, org_id=org_id)
+    select_stmt, reverse = _models.keyset(Run, select_stmt, limit=limit, order=order, after=after, before=before)
+    return _models.to_page((await session.exec(select_stmt)).all(), read_cls=RunRead, list_cls=RunList, limit=limit, reverse=reverse)
 
-    if after:
-        r = get(run_id=after, thread_id=thread_id, user_id=user_id, session=session)
-        if r:
-            select_stmt = select_stmt.filter(Run.created_at > r.created_at)
-    if before:
-        r = get(run_id=before, thread_id=thread_id, user_id=user_id, session=session)
-        if r:
-            select_stmt = select_stmt.filter(Run.created_at < r.created_at)
 
-    if user_id:
-        select_stmt = select_stmt.filter(Run.user_id == user_id)
-    if org_id:
-        select_stmt = select_stmt.filter(Run.org_id == org_id)
+def _cancel(dbo: Run) -> bool:
+    """Switch the status of the run for its cancellation, returns whether the run was changed."""
+    if dbo.status == "queued":
+        dbo.status = "cancelled"
+        dbo.cancelled_at = int(round(datetime.now().timestamp()))
+    elif dbo.status == "in_progress":
+        dbo.status = "cancelling"
+    else:
+        return False
+    return True
+
+
+@_models.auto_session
+def cancel(thread_id: str, run_id: str, session: Session = None) -> Union[RunRead, None]:
+    """Cancel a run.
 
-    select_stmt = select_stmt.limit(limit)
+    A queued run is cancelled right away, an in_progress run is marked as cancelling until the
+    scheduler executing it stops it.
+    """
+    dbo = session.get(Run, run_id)
+    if not dbo or dbo.is_deleted or dbo.thread_id != thread_id:
+        return None
 
-    dbos = session.exec(select_stmt).all()
+    if _cancel(dbo):
+        session.add(dbo)
+        session.commit()
+        session.refresh(dbo)
+    return dbo.to_read(RunRead)
 
-    rs = []
-    for dbo in dbos:
-        rs.append(dbo.to_read(RunRead))
-    return RunList(data=rs, first_id=rs[0].id if len(rs) > 0 else None, last_id=rs[-1].id if len(rs) > 0 else None)
 
+@_models.auto_async_session
+async def acancel(thread_id: str, run_id: str, session: AsyncSession = None) -> Union[RunRead, None]:
+    dbo = await session.get(Run, run_id)
+    if not dbo or dbo.is_deleted or dbo.thread_id != thread_id:
+        return None
 
-def cancel(thread_id: str, run_id: str, session: Session = None) -> Union[RunRead, None]:
-    return
+    if _cancel(dbo):
+        session.add(dbo)
+        await session.commit()
+        await session.refresh(dbo)
+    return dbo.to_read(RunRead)
 
 
 def create_thread_and_run(thread_run: ThreadRunCreate, session: Session = None) -> Union[RunRead, None]:
@@ -167,16 +264,75 @@ def get_step(thread_id: str, run_id: str, step_id: str, session: Session = None)
 
 
 @_models.auto_session
-def update(id: str, session: Session = None, **kwargs):
+def update(id: str, session: Session = None, auto_commit=True, **kwargs):
     dbo = session.get(Run, id)
     if dbo:
-        for k, v in kwargs.items():
+        _models.update_dbo(dbo, kwargs)
+
+        session.add(dbo)
+        if auto_commit:
+            session.commit()
+            session.refresh(dbo)
 
-            if k == 'metadata':
-                dbo.metadata_ = v
-            else:
-                setattr(dbo, k, v)
+
+@_models.auto_async_session
+async def aupdate(id: str, session: AsyncSession = None, auto_commit=True, **kwargs):
+    dbo = await session.get(Run, id)
+    if dbo:
+        _models.update_dbo(dbo, kwargs)
 
         session.add(dbo)
-        session.commit()
-        session.refresh(dbo)
+        if auto_commit:
+            await session.commit()
+            await session.refresh(dbo)
+
+
+@_models.auto_async_session
+async def aclaim_queued(session: AsyncSession = None) -> Union[RunRead, None]:
+    """Claim the oldest queued run by switching its status to in_progress.
+
+    The status is switched with a conditional update, so a run is claimed only once when several workers share the database.
+    """
+    stmt = select(Run.id).filter(Run.status == "queued").filter(Run.is_deleted == False).order_by(Run.created_at).limit(10)
+    for id in (await session.exec(stmt)).all():
+        claimed = await session.exec(sql_update(Run).where(Run.id == id, Run.status == "queued").values(status="in_progress"))
+        await session.commit()
+        if claimed.rowcount == 1:
+            return (await session.get(Run, id, populate_existing=True)).to_read(RunRead)
+
+
+@_models.auto_async_session
+async def aset_cancelled(id: str, session: AsyncSession = None) -> bool:
+    """Switch the status of the run to cancelled, returns False if it was already cancelled."""
+    stmt = sql_update(Run).where(Run.id == id, Run.status != "cancelled").values(status="cancelled", cancelled_at=int(round(datetime.now().timestamp())))
+    cancelled = await session.exec(stmt)
+    await session.commit()
+    return cancelled.rowcount == 1
+
+
+@_models.auto_async_session
+async def acount(status: str = None, session: AsyncSession = None) -> int:
+    stmt = select(func.count(Run.id)).filter(Run.is_deleted == False)
+    if status:
+        stmt = stmt.filter(Run.status == status)
+    return (await session.exec(stmt)).one()
+
+
+@_models.auto_async_session
+async def aget_status(id: str, session: AsyncSession = None) -> Union[str, None]:
+    return (await session.exec(select(Run.status).filter(Run.id == id))).first()
+
+
+@_models.auto_async_session
+async def afilter_status(ids: List[str], status: str, session: AsyncSession = None) -> List[str]:
+    """Returns the ids of the runs having the status."""
+    if not ids:
+        return []
+    return (await session.exec(select(Run.id).filter(Run.id.in_(ids)).filter(Run.status == status))).all()
+
+
+@_models.auto_async_session
+async def alist_by_status(status: List[str], session: AsyncSession = None) -> List[RunRead]:
+    """List the runs having any of the statuses, oldest first."""
+    stmt = select(Run).filter(Run.status.in_(status)).filter(Run.is_deleted == False).order_by(Run.created_at)
+    return [r.to_read(RunRead) for r in (await session.exec(stmt)).all()]
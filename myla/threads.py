@@ -1,9 +1,14 @@
 from datetime import datetime
 from typing import List, Optional, Union
 
+from sqlalchemy import Index
+from sqlalchemy import delete as sql_delete
+from sqlalchemy import update as sql_update
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from . import _models
+from ._object_cache import ObjectCache
 from .messages import Message
 
 
@@ -33,6 +38,11 @@ class Thread(_models.DBModel, table=True):
     Represents an assistant that can call the model and use tools.
     """
 
+    @classmethod
+    def composite_indexes(cls):
+        # Threads of an organization
+        return (Index("ix_thread_org_id_is_deleted_created_at_id", "org_id", "is_deleted", "created_at", "id"),)
+
 
 @_models.auto_session
 def create(
@@ -58,12 +68,22 @@ def create(
 
 @_models.auto_session
 def get(id: str, user_id: str = None, session: Session = None) -> Union[ThreadRead, None]:
-    return _models.get(db_cls=Thread, read_cls=ThreadRead, id=id, user_id=user_id, session=session)
+    return _models.get(db_cls=Thread, read_cls=ThreadRead, id=id, user_id=user_id, session=session, cache=ObjectCache.default())
+
+
+@_models.auto_async_session
+async def aget(id: str, user_id: str = None, session: AsyncSession = None) -> Union[ThreadRead, None]:
+    return await _models.aget(db_cls=Thread, read_cls=ThreadRead, id=id, user_id=user_id, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
 def modify(id: str, thread: ThreadEdit, user_id: str = None, session: Session = None):
-    return _models.modify(db_cls=Thread, read_cls=ThreadRead, id=id, to_update=thread.model_dump(exclude_unset=True), user_id=user_id, session=session)
+    return _models.modify(db_cls=Thread, read_cls=ThreadRead, id=id, to_update=thread.model_dump(exclude_unset=True), user_id=user_id, session=session, cache=ObjectCache.default())
+
+
+@_models.auto_async_session
+async def amodify(id: str, thread: ThreadEdit, user_id: str = None, session: AsyncSession = None):
+    return await _models.amodify(db_cls=Thread, read_cls=ThreadRead, id=id, to_update=thread.model_dump(exclude_unset=True), user_id=user_id, session=session, cache=ObjectCache.default())
 
 
 @_models.auto_session
@@ -84,6 +104,29 @@ def delete(id: str, user_id: str = None, mode="soft", session: Optional[Session]
             session.delete(dbo)
             session.query(Message).where(Message.thread_id == id).delete()
             session.commit()
+        ObjectCache.default().invalidate("thread", id)
+    return _models.DeletionStatus(id=id, object="thread.deleted", deleted=True)
+
+
+@_models.auto_async_session
+async def adelete(id: str, user_id: str = None, mode="soft", session: Optional[AsyncSession] = None) -> _models.DeletionStatus:
+    dbo = await session.get(Thread, id)
+    if dbo and (not user_id or user_id == dbo.user_id):
+        deleted_at = int(datetime.now().timestamp()*1000)
+        if mode is not None and mode == 'soft':
+            dbo.is_deleted = True
+            dbo.deleted_at = deleted_at
+            session.add(dbo)
+
+            await session.exec(sql_update(Message).where(Message.thread_id == id).values(is_deleted=True, deleted_at=deleted_at))
+
+            await session.commit()
+            await session.refresh(dbo)
+        else:
+            await session.delete(dbo)
+            await session.exec(sql_delete(Message).where(Message.thread_id == id))
+            await session.commit()
+        ObjectCache.default().invalidate("thread", id)
     return _models.DeletionStatus(id=id, object="thread.deleted", deleted=True)
 
 
@@ -1,6 +1,10 @@
+import asyncio
+import time
+import weakref
 from typing import Any, List, Dict, Optional
 from pydantic import BaseModel
 import aiohttp
+from ._env import env_int
 from ._logging import logger
 from .assistants import AssistantRead
 from .runs import RunRead
@@ -52,34 +56,131 @@ class Tool:
 
     名称以 $ 开始的 tool 一定会被执行, 执行顺序为定义 Assistant/Run tools 的顺序
     名称不以 $ 开始的 tool 将由系统决定是否执行
+
+    parallel 为 True 的相邻 tools 会并发执行, 各自使用 Context 的副本, 执行后按定义顺序合并修改。
+    只读取 messages 并插入新消息 (如 retrieval) 的 tool 可以并发执行, 改写消息的 tool 应顺序执行。
+    Assistant/Run 的 tool 定义中可以用 "parallel" 覆盖。
     """
+    parallel: bool = False
+
     def execute(self, context: Context) -> Any:
         pass
 
 
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后断开, recovery_time 秒内的调用直接跳过,
+    之后放行一次试探调用, 成功则恢复, 失败则继续断开。
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_time: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self._opened_at < self.recovery_time:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or (self.failure_threshold > 0 and self._failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+    def record_cancelled(self):
+        """调用被取消, 不计入成败, 之后可以再次试探"""
+        self._probing = False
+
+
+_sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp.ClientSession
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Returns the session shared by the HTTP tools executed in the event loop."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=env_int("HTTP_TOOL_MAX_CONNECTIONS", 100),
+            keepalive_timeout=env_int("HTTP_TOOL_KEEPALIVE_TIMEOUT", 30)
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[loop] = session
+    return session
+
+
 class HTTPTool(Tool):
     """
     以 HTTP API 调用远程 Tool 执行
 
     method: POST
-    body: Context
-    response body: Cotext
+    body: Context, 不包含值为 None 的字段
+    response body: Context, 只更新返回的 messages, llm_args, message_metadata, file_ids, is_completed
+
+    timeout: 单次调用超时秒数
+    max_concurrency: 最大并发调用数, 0 表示不限制
+    failure_threshold, recovery_time: 熔断设置, 见 CircuitBreaker, failure_threshold 为 0 时不熔断
     """
 
-    def __init__(self, url=None) -> None:
+    def __init__(self, url=None, timeout: float = 30, max_concurrency: int = 0, failure_threshold: int = 5, recovery_time: float = 30) -> None:
         super().__init__()
         self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.circuit_breaker = CircuitBreaker(failure_threshold=failure_threshold, recovery_time=recovery_time)
 
     async def execute(self, context: Context) -> None:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url=self.url, json=context.messages) as resp:
-                try:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        context.messages = result['messages']
-                        context.llm_args.update(result['llm_args'])
-                        context.message_metadata.update(result['message_metadata'])
-                    else:
-                        raise BaseException(f"status: {resp.status}")
-                except Exception as e:
-                    logger.warn(f"HTTP Tool execute failed: url={self.url} status={e}")
+        if not self.circuit_breaker.allow():
+            logger.warn(f"HTTP Tool circuit open, skipped: url={self.url}")
+            return
+
+        try:
+            if self._slots:
+                async with self._slots:
+                    result = await self._call(context)
+            else:
+                result = await self._call(context)
+        except Exception as e:
+            self.circuit_breaker.record_failure()
+            logger.warn(f"HTTP Tool execute failed: url={self.url} error={e!r}")
+            return
+        except BaseException:
+            self.circuit_breaker.record_cancelled()
+            raise
+
+        self.circuit_breaker.record_success()
+        for k in ("messages", "llm_args", "message_metadata", "file_ids", "is_completed"):
+            if k not in result:
+                continue
+            if k in ("llm_args", "message_metadata"):
+                getattr(context, k).update(result[k])
+            else:
+                setattr(context, k, result[k])
+
+    async def _call(self, context: Context) -> Dict:
+        body = context.model_dump_json(exclude_none=True)
+        async with _get_session().post(
+            url=self.url,
+            data=body,
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout
+        ) as resp:
+            if resp.status != 200:
+                raise Exception(f"status: {resp.status}")
+            return await resp.json()
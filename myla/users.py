@@ -4,6 +4,7 @@ from pydantic import BaseModel
 from sqlmodel import Field, Session, SQLModel, select
 
 from . import _models, utils
+from ._auth_cache import AuthCache
 
 
 class UserOrgLink(SQLModel, table=True):
@@ -192,6 +193,7 @@ def delete_user(id: str, session: Session = None) -> _models.DeletionStatus:
     dbo = get_user_dbo(id=id, session=session)
     session.delete(dbo)
     session.commit()
+    AuthCache.default().invalidate_user(id)
     return _models.DeletionStatus(id=id, object="user", deleted=True)
 
 
@@ -289,6 +291,7 @@ def delete_secret_key(id: str, user_id: str, session: Session = None) -> _models
     else:
         session.delete(to_delete[0])
         session.commit()
+        AuthCache.default().invalidate_key(to_delete[0].id)
 
     return _models.DeletionStatus(id=id, object="secret_key", deleted=True)
 
@@ -368,5 +371,6 @@ def add_org_member(org_id: str, member: OrgMemberCreate, session: Session = None
         rel = UserOrgLink(user_id=user.id, org_id=org_id, role=member.role)
         session.add(rel)
         session.commit()
+        AuthCache.default().invalidate_user(user.id)
 
         return user
@@ -2,9 +2,10 @@ import json
 from typing import Optional, List, Dict, Any
 from abc import ABC, abstractmethod
 from functools import partial
-import asyncio
 from operator import itemgetter
 
+from .._executors import run_in_executor
+
 
 class Record(Dict):
     @staticmethod
@@ -79,6 +80,6 @@ class VectorStore(ABC):
         with_distance: bool = False,
         **kwargs
     ):
-        return await asyncio.get_running_loop().run_in_executor(
-            None, partial(self.search, **kwargs), collection, query, vector, filter, limit, columns, with_vector, with_distance
+        return await run_in_executor(
+            "search", partial(self.search, **kwargs), collection, query, vector, filter, limit, columns, with_vector, with_distance
         )
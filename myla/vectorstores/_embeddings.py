@@ -1,6 +1,6 @@
 from typing import List
 from abc import ABC, abstractmethod
-import asyncio
+from .._executors import run_in_executor
 
 
 class Embeddings(ABC):
@@ -15,12 +15,8 @@ class Embeddings(ABC):
 
     async def aembed(self, text: str, **kwargs) -> List[float]:
         """Asynchronous Embed text."""
-        return await asyncio.get_running_loop().run_in_executor(
-            None, self.embed, text, **kwargs
-        )
+        return await run_in_executor("embedding", self.embed, text, **kwargs)
 
     async def aembed_batch(self, texts: [str], **kwargs) -> List[List[float]]:
         """Asynchronous Embed text."""
-        return await asyncio.get_running_loop().run_in_executor(
-            None, self.embed_batch, texts, **kwargs
-        )
+        return await run_in_executor("embedding", self.embed_batch, texts, **kwargs)
@@ -0,0 +1,16 @@
+ALTER TABLE run ADD cancelled_at INTEGER;
+ALTER TABLE message ADD token_count INTEGER;
+
+CREATE INDEX ix_assistant_created_at_id ON assistant (created_at, id);
+CREATE INDEX ix_file_created_at_id ON file (created_at, id);
+CREATE INDEX ix_message_created_at_id ON message (created_at, id);
+CREATE INDEX ix_organization_created_at_id ON organization (created_at, id);
+CREATE INDEX ix_run_created_at_id ON run (created_at, id);
+CREATE INDEX ix_secretkey_created_at_id ON secretkey (created_at, id);
+CREATE INDEX ix_thread_created_at_id ON thread (created_at, id);
+CREATE INDEX ix_user_created_at_id ON "user" (created_at, id);
+
+CREATE INDEX ix_message_thread_id_is_deleted_created_at_id ON message (thread_id, is_deleted, created_at, id);
+CREATE INDEX ix_run_thread_id_is_deleted_created_at_id ON run (thread_id, is_deleted, created_at, id);
+CREATE INDEX ix_run_status_is_deleted_created_at ON run (status, is_deleted, created_at);
+CREATE INDEX ix_thread_org_id_is_deleted_created_at_id ON thread (org_id, is_deleted, created_at, id);
@@ -0,0 +1,83 @@
+import aiounittest
+from sqlalchemy import event
+
+from myla import persistence, users
+from myla._auth import BasicAuthBackend
+from myla._auth_cache import AuthCache
+
+
+class FakeRequest:
+    def __init__(self, secret_key: str) -> None:
+        self.headers = {"Authorization": f"Bearer {secret_key}"}
+        self.cookies = {}
+
+
+class TestBasicAuthBackend(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        persistence.Persistence._instance = self.db
+        AuthCache._instance = AuthCache(max_size=2, ttl=60)
+
+        self.queries = 0
+
+        def _count(*args, **kwargs):
+            self.queries += 1
+        event.listen(self.db.engine, "before_cursor_execute", _count)
+
+        self.user = users.create_user(users.UserCreate(username="u1", password="p"))
+        self.sk = users.create_secret_key(key=users.SecrectKeyCreate(), user_id=self.user.id)
+
+    def tearDown(self) -> None:
+        persistence.Persistence._instance = None
+        AuthCache._instance = None
+
+    async def _authenticate(self, secret_key: str):
+        return await BasicAuthBackend().authenticate(FakeRequest(secret_key))
+
+    async def test_cached(self):
+        _, auser = await self._authenticate(self.sk.id)
+        self.assertEqual(auser.id, self.user.id)
+        self.assertEqual(len(auser.orgs), 1)
+        self.assertIn(auser.primary_org_id, auser.orgs)
+
+        queries = self.queries
+        _, auser = await self._authenticate(self.sk.id)
+        self.assertEqual(auser.id, self.user.id)
+        self.assertEqual(self.queries, queries)
+        self.assertEqual(AuthCache.default().metrics()["hits"], 1)
+
+    async def test_unknown_key(self):
+        self.assertIsNone(await self._authenticate("unknown"))
+        self.assertIsNone(await self._authenticate("unknown"))
+        self.assertEqual(AuthCache.default().metrics()["size"], 0)
+
+    async def test_delete_secret_key(self):
+        self.assertIsNotNone(await self._authenticate(self.sk.id))
+        users.delete_secret_key(id=self.sk.id, user_id=self.user.id)
+        self.assertIsNone(await self._authenticate(self.sk.id))
+
+    async def test_add_org_member(self):
+        other = users.create_user(users.UserCreate(username="u2", password="p"))
+        _, auser = await self._authenticate(self.sk.id)
+        self.assertEqual(len(auser.orgs), 1)
+
+        users.add_org_member(org_id=users.list_orgs(user_id=other.id).data[0].id, member=users.OrgMemberCreate(username="u1", role="member"))
+        _, auser = await self._authenticate(self.sk.id)
+        self.assertEqual(len(auser.orgs), 2)
+
+    def test_put_after_invalidation(self):
+        cache = AuthCache(max_size=2, ttl=60)
+        version = cache.version()
+        cache.invalidate_key("sk_1")
+        cache.put("sk_1", "u1", {}, None, version=version)
+        self.assertIsNone(cache.get("sk_1"))
+
+        for k in ["sk_1", "sk_2", "sk_3"]:
+            cache.put(k, "u1", {}, None, version=cache.version())
+        self.assertIsNone(cache.get("sk_1"))
+        self.assertEqual(cache.get("sk_3"), ("u1", {}, None))
+
+        cache.invalidate_user("u1")
+        self.assertEqual(cache.metrics()["size"], 0)
@@ -0,0 +1,34 @@
+import threading
+import time
+
+import aiounittest
+
+from myla import _executors
+
+
+class TestExecutors(aiounittest.AsyncTestCase):
+
+    async def test_named_executors(self):
+        self.assertIs(_executors.get_executor("search"), _executors.get_executor("search"))
+        self.assertIsNot(_executors.get_executor("search"), _executors.get_executor("ingestion"))
+
+        name = await _executors.run_in_executor("search", lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith("myla-search"))
+
+    async def test_metrics(self):
+        executor = _executors.InstrumentedExecutor(name="test", max_workers=1)
+        release = threading.Event()
+        futures = [executor.submit(release.wait) for _ in range(3)]
+        time.sleep(0.05)
+
+        metrics = executor.metrics()
+        self.assertEqual(metrics["running"], 1)
+        self.assertEqual(metrics["queued"], 2)
+
+        release.set()
+        for f in futures:
+            f.result()
+        metrics = executor.metrics()
+        self.assertEqual(metrics["completed"], 3)
+        self.assertEqual(metrics["queued"], 0)
+        executor.shutdown()
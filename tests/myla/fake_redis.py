@@ -0,0 +1,86 @@
+import asyncio
+
+
+class FakeRedis:
+    """A local stand-in for the subset of redis.asyncio.Redis used by myla."""
+
+    def __init__(self) -> None:
+        self._data = {}
+        self._seq = 0
+        self._changed = asyncio.Event()
+        self._subscribers = []
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def exists(self, key):
+        return 1 if key in self._data else 0
+
+    async def expire(self, key, seconds):
+        return key in self._data
+
+    async def xadd(self, key, fields):
+        self._seq += 1
+        entry_id = f"{self._seq}-0"
+        self._data.setdefault(key, []).append((entry_id, dict(fields)))
+        self._notify()
+        return entry_id
+
+    async def xread(self, streams, block=None, count=None):
+        for _ in range(2):
+            resp = []
+            for key, last_id in streams.items():
+                last = int(str(last_id).split("-")[0])
+                entries = [e for e in self._data.get(key, []) if int(e[0].split("-")[0]) > last]
+                if entries:
+                    resp.append((key, entries[:count] if count else entries))
+            if resp or block is None:
+                return resp
+            await self._wait(block / 1000)
+        return []
+
+    async def rpush(self, key, value):
+        self._data.setdefault(key, []).append(value)
+        self._notify()
+        return len(self._data[key])
+
+    async def blpop(self, key, timeout=0):
+        for _ in range(2):
+            if self._data.get(key):
+                return key, self._data[key].pop(0)
+            await self._wait(timeout)
+
+    async def llen(self, key):
+        return len(self._data.get(key, []))
+
+    async def publish(self, channel, message):
+        for pubsub in self._subscribers:
+            if channel in pubsub.channels:
+                pubsub.queue.put_nowait({"type": "message", "channel": channel.encode(), "data": message.encode()})
+        return len(self._subscribers)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, redis: FakeRedis) -> None:
+        self.channels = set()
+        self.queue = asyncio.Queue()
+        redis._subscribers.append(self)
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.queue.put_nowait({"type": "subscribe", "channel": channel.encode(), "data": 1})
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
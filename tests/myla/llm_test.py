@@ -0,0 +1,138 @@
+import asyncio
+import json
+import time
+import unittest
+
+import aiounittest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from myla import _tools, assistants, messages, persistence, runs, threads
+from myla._llm import chat_complete, fit_messages, get_prompt_budget, run_tools
+from myla._stream_bus import RunStream
+from myla.tools import Tool
+from myla.llms.tokens import count_messages_tokens
+
+
+class TestContextBudget(unittest.TestCase):
+
+    def test_prompt_budget(self):
+        self.assertIsNone(get_prompt_budget(model="m", run_metadata={}, llm_args={}))
+        self.assertEqual(get_prompt_budget(model="m", run_metadata={"context_window": 4096}, llm_args={"max_tokens": 96}), 4000)
+
+    def test_fit_messages_trims_docs(self):
+        docs = [{"text": f"doc {i} " + "word " * 50} for i in range(10)]
+        messages = [
+            {"role": "system", "content": "instructions"},
+            {"role": "user", "content": "old question"},
+            {"role": "system", "content": json.dumps(docs), "type": "docs"},
+            {"role": "user", "content": "question"},
+        ]
+        fitted = fit_messages(messages=messages, max_tokens=300)
+        self.assertLessEqual(count_messages_tokens(fitted), 300)
+        self.assertEqual(len(fitted), 4)
+        kept = json.loads(fitted[2]["content"])
+        self.assertGreater(len(kept), 0)
+        self.assertEqual(kept, docs[:len(kept)])
+
+    def test_fit_messages_drops_history(self):
+        messages = [{"role": "system", "content": "instructions"}]
+        messages += [{"role": "user", "content": "word " * 40} for _ in range(5)]
+        messages.append({"role": "user", "content": "question"})
+
+        fitted = fit_messages(messages=messages, max_tokens=100)
+        self.assertLessEqual(count_messages_tokens(fitted), 100)
+        self.assertEqual(fitted[0]["content"], "instructions")
+        self.assertEqual(fitted[-1]["content"], "question")
+
+
+class _InsertTool(Tool):
+    parallel = True
+
+    def __init__(self, name, delay) -> None:
+        super().__init__()
+        self.name = name
+        self.delay = delay
+
+    async def execute(self, context):
+        await asyncio.sleep(self.delay)
+        context.messages.insert(len(context.messages) - 1, {"role": "system", "content": self.name})
+        context.llm_args["temperature"] = self.delay
+        context.message_metadata[self.name] = True
+
+
+class _RewriteTool(Tool):
+    def execute(self, context):
+        context.messages[-1]["content"] = context.messages[-1]["content"].upper()
+
+
+class TestRunTools(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        _tools._tools.update({
+            "slow": _InsertTool("slow", 0.2),
+            "fast": _InsertTool("fast", 0.1),
+            "rewrite": _RewriteTool(),
+        })
+
+    def tearDown(self) -> None:
+        for name in ["slow", "fast", "rewrite"]:
+            _tools._tools.pop(name)
+
+    async def _run_tools(self, tools):
+        return await run_tools(
+            assistant=None, run=None, thread=None,
+            tools=[{"type": t} for t in tools],
+            messages=[{"role": "system", "content": "instructions"}, {"role": "user", "content": "question"}],
+            run_metadata={}
+        )
+
+    async def test_parallel(self):
+        begin = time.time()
+        context = await self._run_tools(["rewrite", "slow", "fast"])
+        self.assertLess(time.time() - begin, 0.3)
+
+        # merged in declaration order, not completion order
+        self.assertEqual([m["content"] for m in context.messages], ["instructions", "slow", "fast", "QUESTION"])
+        self.assertEqual(context.llm_args["temperature"], 0.1)
+        self.assertEqual(context.message_metadata, {"slow": True, "fast": True})
+
+    async def test_sequential(self):
+        context = await run_tools(
+            assistant=None, run=None, thread=None,
+            tools=[{"type": "fast"}, {"type": "fast", "parallel": False}],
+            messages=[{"role": "user", "content": "question"}],
+            run_metadata={}
+        )
+        self.assertEqual([m["content"] for m in context.messages], ["fast", "fast", "question"])
+
+
+class TestChatComplete(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        persistence.Persistence._instance = self.db
+
+    def tearDown(self) -> None:
+        persistence.Persistence._instance = None
+
+    async def test_commits(self):
+        a = assistants.create(assistants.AssistantCreate(name="a", model="mock@mock"))
+        t = threads.create(threads.ThreadCreate())
+        messages.create(thread_id=t.id, message=messages.MessageCreate(role="user", content="hello"))
+        r = runs.create(thread_id=t.id, run=runs.RunCreate(assistant_id=a.id))
+
+        commits = []
+        listener = lambda session: commits.append(session)
+        event.listen(Session, "after_commit", listener)
+        try:
+            await chat_complete(run=r, iter=RunStream())
+        finally:
+            event.remove(Session, "after_commit", listener)
+
+        # in_progress, then the message and the completion together
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(await runs.aget_status(id=r.id), "completed")
+        self.assertEqual(messages.list(thread_id=t.id, order="desc").data[0].content[0].text[0].value, "hello")
+        self.assertEqual(len(messages.list(thread_id=t.id).data), 2)
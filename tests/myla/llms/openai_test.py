@@ -0,0 +1,21 @@
+import aiounittest
+
+from myla import llms
+from myla.llms import openai
+
+
+class TestOpenAIClient(aiounittest.AsyncTestCase):
+    async def test_async_client_shared(self):
+        c1 = openai.get_async_client(api_key="sk-1", base_url="http://localhost:1/v1")
+        c2 = openai.get_async_client(api_key="sk-1", base_url="http://localhost:1/v1")
+        c3 = openai.get_async_client(api_key="sk-2", base_url="http://localhost:1/v1")
+        self.assertIs(c1, c2)
+        self.assertIsNot(c1, c3)
+
+    def test_client_shared(self):
+        c1 = openai.get_client(api_key="sk-1", base_url="http://localhost:1/v1")
+        self.assertIs(c1, openai.get_client(api_key="sk-1", base_url="http://localhost:1/v1"))
+
+    def test_backend_shared(self):
+        self.assertIs(llms.get("gpt-x"), llms.get("gpt-x"))
+        self.assertIsNot(llms.get("gpt-x"), llms.get("gpt-y"))
@@ -0,0 +1,89 @@
+import unittest
+
+import aiounittest
+import httpx
+import openai
+
+from myla.llms.retry import RetryBudget, RetryPolicy, is_retryable, retry_after, retry_async, retry_sync
+
+
+def _error(status, headers=None):
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    response = httpx.Response(status, headers=headers, request=request)
+    return openai.APIStatusError(f"status {status}", response=response, body=None)
+
+
+class _Flaky:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class TestRetry(aiounittest.AsyncTestCase):
+
+    def test_classification(self):
+        self.assertTrue(is_retryable(_error(429)))
+        self.assertTrue(is_retryable(_error(503)))
+        self.assertTrue(is_retryable(openai.APIConnectionError(request=httpx.Request("POST", "http://localhost"))))
+        self.assertFalse(is_retryable(_error(400)))
+        self.assertFalse(is_retryable(_error(401)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(_error(429, {"retry-after": "2"})), 2)
+        self.assertEqual(retry_after(_error(429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertIsNone(retry_after(_error(429)))
+
+    async def test_retry_async(self):
+        policy = RetryPolicy(max_retries=2, base_delay=0.001)
+        flaky = _Flaky([_error(429), _error(502)])
+
+        @retry_async(policy)
+        async def call():
+            return flaky()
+
+        self.assertEqual(await call(), "ok")
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual(policy.stats(), {"retries": 2, "gave_up": 0})
+
+    async def test_not_retryable(self):
+        policy = RetryPolicy(max_retries=2, base_delay=0.001)
+        flaky = _Flaky([_error(400)])
+
+        @retry_async(policy)
+        async def call():
+            return flaky()
+
+        with self.assertRaises(openai.APIStatusError):
+            await call()
+        self.assertEqual(flaky.calls, 1)
+
+    def test_retry_sync_gives_up(self):
+        policy = RetryPolicy(max_retries=1, base_delay=0.001)
+        flaky = _Flaky([_error(500), _error(500)])
+        with self.assertRaises(openai.APIStatusError):
+            retry_sync(policy)(flaky)()
+        self.assertEqual(flaky.calls, 2)
+        self.assertEqual(policy.stats(), {"retries": 1, "gave_up": 1})
+
+    def test_retry_after_too_long(self):
+        policy = RetryPolicy(max_retries=2, max_retry_after=1)
+        self.assertIsNone(policy.delay(0, _error(429, {"retry-after": "30"})))
+        self.assertGreaterEqual(policy.delay(0, _error(429, {"retry-after": "0.5"})), 0.5)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
@@ -0,0 +1,129 @@
+import time
+import unittest
+
+from sqlalchemy import event
+from sqlmodel import select
+
+from myla import messages, persistence
+
+
+class TestMessages(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        self.session = self.db.create_session()
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    def _create(self, content):
+        time.sleep(0.002)  # distinct created_at
+        return messages.create(thread_id="thread_1", message=messages.MessageCreate(role="user", content=content), session=self.session)
+
+    def test_list_by_tokens(self):
+        for i in range(5):
+            self._create(f"message {i} " + "word " * 20)
+
+        # ~30 tokens per message
+        r = messages.list_by_tokens(thread_id="thread_1", max_tokens=70, session=self.session)
+        self.assertEqual([m.content[0].text[0].value[:9] for m in r], ["message 3", "message 4"])
+
+        r = messages.list_by_tokens(thread_id="thread_1", max_tokens=10000, limit=3, session=self.session)
+        self.assertEqual(len(r), 3)
+
+        # the newest message is always listed
+        r = messages.list_by_tokens(thread_id="thread_1", max_tokens=1, session=self.session)
+        self.assertEqual(len(r), 1)
+
+        # no history
+        self.assertEqual(messages.list_by_tokens(thread_id="thread_1", max_tokens=10000, limit=0, session=self.session), [])
+
+        # fetched in batches
+        r = messages.list_by_tokens(thread_id="thread_1", max_tokens=70, batch_size=1, session=self.session)
+        self.assertEqual([m.content[0].text[0].value[:9] for m in r], ["message 3", "message 4"])
+
+    def test_token_count_backfilled(self):
+        m = self._create("hello world")
+        dbo = self.session.get(messages.Message, m.id)
+        self.assertGreater(dbo.token_count, 0)
+        dbo.token_count = None
+        self.session.add(dbo)
+        self.session.commit()
+
+        messages.list_by_tokens(thread_id="thread_1", max_tokens=100, session=self.session)
+        counts = self.session.exec(select(messages.Message.token_count)).all()
+        self.assertEqual(counts, [messages.count_tokens("hello world")])
+
+    def test_list_keyset(self):
+        ids = [self._create(f"message {i}").id for i in range(3)]
+        # Messages sharing a timestamp
+        for i in range(3, 7):
+            m = messages.create(thread_id="thread_1", message=messages.MessageCreate(role="user", content=f"message {i}"), session=self.session)
+            dbo = self.session.get(messages.Message, m.id)
+            dbo.created_at = 0 if i < 5 else 10 ** 13
+            self.session.add(dbo)
+            ids.append(m.id)
+        self.session.commit()
+        # Ordered by (created_at, id)
+        expected = sorted(ids[3:5]) + ids[:3] + sorted(ids[5:])
+
+        for order, listed in (("asc", expected), ("desc", expected[::-1])):
+            pages = []
+            after = None
+            while True:
+                r = messages.list(thread_id="thread_1", limit=2, order=order, after=after, session=self.session)
+                pages.append(r)
+                after = r.last_id
+                if not r.has_more:
+                    break
+            self.assertEqual([m.id for p in pages for m in p.data], listed)
+            self.assertEqual([len(p.data) for p in pages], [2, 2, 2, 1])
+
+            # Backwards from the last page
+            r = messages.list(thread_id="thread_1", limit=2, order=order, before=pages[-1].first_id, session=self.session)
+            self.assertEqual([m.id for m in r.data], listed[4:6])
+            self.assertTrue(r.has_more)
+            r = messages.list(thread_id="thread_1", limit=2, order=order, before=listed[2], session=self.session)
+            self.assertEqual([m.id for m in r.data], listed[:2])
+            self.assertFalse(r.has_more)
+
+            r = messages.list(thread_id="thread_1", order=order, after=listed[1], before=listed[5], session=self.session)
+            self.assertEqual([m.id for m in r.data], listed[2:5])
+
+        self.assertEqual(messages.list(thread_id="thread_1", after="msg_unknown", session=self.session).data, [])
+
+    def _query_plan(self, f):
+        """The query plan of the statements executed by f."""
+        statements = []
+
+        def _capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append((statement, parameters))
+
+        event.listen(self.db.engine, "before_cursor_execute", _capture)
+        try:
+            f()
+        finally:
+            event.remove(self.db.engine, "before_cursor_execute", _capture)
+
+        plans = []
+        for statement, parameters in statements:
+            rows = self.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+            plans.append([row[-1] for row in rows])
+        return plans
+
+    def test_history_uses_index(self):
+        for i in range(20):
+            messages.create(thread_id=f"thread_{i % 4}", message=messages.MessageCreate(role="user", content=f"message {i}"), session=self.session)
+
+        # The history loaded by chat_complete, with and without a prompt budget
+        for f in (
+            lambda: messages.list(thread_id="thread_1", order="desc", limit=7, session=self.session),
+            lambda: messages.list_by_tokens(thread_id="thread_1", max_tokens=1000, limit=50, session=self.session),
+        ):
+            plans = self._query_plan(f)
+            self.assertEqual(len(plans), 1)
+            plan = " ".join(plans[0])
+            self.assertIn("USING INDEX ix_message_thread_id_is_deleted_created_at_id", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
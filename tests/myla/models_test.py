@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import aiounittest
+
+from myla import messages, persistence, runs, threads
+
+
+class TestAsyncModels(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        persistence.Persistence._instance = self.db
+
+    def tearDown(self) -> None:
+        asyncio.run(self.db.dispose())
+        persistence.Persistence._instance = None
+
+    def test_async_database_url(self):
+        self.assertTrue(self.db.async_database_url.startswith("sqlite+aiosqlite:///"))
+        self.assertEqual(
+            persistence.Persistence(database_url="sqlite:///myla.db").async_database_url,
+            "sqlite+aiosqlite:///myla.db"
+        )
+        self.assertEqual(
+            persistence.Persistence(database_url="sqlite:///myla.db", async_database_url="sqlite+aiosqlite:///other.db").async_database_url,
+            "sqlite+aiosqlite:///other.db"
+        )
+
+    async def test_sync_and_async_share_database(self):
+        t = threads.create(thread=threads.ThreadCreate(metadata={"k": "v"}))
+        t_read = await threads.aget(id=t.id)
+        self.assertEqual(t_read.metadata, {"k": "v"})
+        self.assertIsNone(await threads.aget(id="thread_unknown"))
+
+        m = await messages.acreate(thread_id=t.id, message=messages.MessageCreate(role="user", content="hello"), user_id="u1")
+        self.assertEqual(messages.get(id=m.id).content[0].text[0].value, "hello")
+        self.assertIsNone(await messages.aget(id=m.id, thread_id="thread_other"))
+
+    async def test_alist(self):
+        ids = []
+        for i in range(5):
+            time.sleep(0.002)  # distinct created_at
+            m = await messages.acreate(thread_id="thread_1", message=messages.MessageCreate(role="user", content=f"m{i}"))
+            ids.append(m.id)
+
+        r = await messages.alist(thread_id="thread_1", limit=2, order="asc")
+        self.assertEqual([m.id for m in r.data], ids[:2])
+        self.assertEqual(r.last_id, ids[1])
+
+        r = await messages.alist(thread_id="thread_1", order="asc", after=ids[1])
+        self.assertEqual([m.id for m in r.data], ids[2:])
+        self.assertEqual(messages.list(thread_id="thread_1", order="asc", after=ids[1]).data, r.data)
+
+        r = await messages.alist(thread_id="thread_1", before=ids[3])
+        self.assertEqual([m.id for m in r.data], [ids[4]])
+
+    async def test_alist_by_tokens(self):
+        for i in range(5):
+            time.sleep(0.002)  # distinct created_at
+            messages.create(thread_id="thread_1", message=messages.MessageCreate(role="user", content=f"message {i} " + "word " * 20))
+
+        r = await messages.alist_by_tokens(thread_id="thread_1", max_tokens=70, batch_size=1)
+        self.assertEqual([m.id for m in r], [m.id for m in messages.list_by_tokens(thread_id="thread_1", max_tokens=70)])
+        self.assertEqual(len(r), 2)
+        self.assertEqual(await messages.alist_by_tokens(thread_id="thread_1", max_tokens=10000, limit=0), [])
+
+    async def test_modify_delete(self):
+        t = await threads.amodify(id=threads.create(thread=threads.ThreadCreate()).id, thread=threads.ThreadModify(metadata={"k": "v"}))
+        self.assertEqual(threads.get(id=t.id).metadata, {"k": "v"})
+
+        m = await messages.acreate(thread_id=t.id, message=messages.MessageCreate(role="user", content="hello"))
+        self.assertIsNone(await messages.amodify(id=m.id, thread_id="thread_other", message=messages.MessageModify(metadata={"k": "v"})))
+        self.assertEqual((await messages.amodify(id=m.id, thread_id=t.id, message=messages.MessageModify(metadata={"k": "v"}))).metadata, {"k": "v"})
+        await messages.adelete(id=m.id, thread_id=t.id)
+        self.assertIsNone(messages.get(id=m.id))
+
+        r = await runs.acreate(thread_id=t.id, run=runs.RunCreate(assistant_id="asst_1"))
+        self.assertEqual((await runs.amodify(id=r.id, run=runs.RunModify(metadata={"k": "v"}))).metadata, {"k": "v"})
+        await runs.adelete(id=r.id)
+        self.assertIsNone(runs.get(thread_id=t.id, run_id=r.id))
+
+        m = await messages.acreate(thread_id=t.id, message=messages.MessageCreate(role="user", content="hello"))
+        await threads.adelete(id=t.id)
+        self.assertIsNone(threads.get(id=t.id))
+        self.assertEqual(messages.list(thread_id=t.id).data, [])
+
+    async def test_runs(self):
+        r = await runs.acreate(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"), user_id="u1")
+        self.assertEqual(r.status, "queued")
+        self.assertEqual((await runs.aget(thread_id="thread_1", run_id=r.id)).id, r.id)
+        self.assertIsNone(await runs.aget(thread_id="thread_2", run_id=r.id))
+        self.assertEqual([x.id for x in (await runs.alist(thread_id="thread_1")).data], [r.id])
+
+        await runs.aupdate(id=r.id, status="in_progress", metadata={"k": "v"})
+        self.assertEqual(runs.get(thread_id="thread_1", run_id=r.id).metadata, {"k": "v"})
+        self.assertEqual(await runs.aget_status(id=r.id), "in_progress")
+        self.assertEqual(await runs.afilter_status(ids=[r.id, "run_unknown"], status="in_progress"), [r.id])
+
+        self.assertEqual((await runs.acancel(thread_id="thread_1", run_id=r.id)).status, "cancelling")
+        self.assertEqual(runs.get(thread_id="thread_1", run_id=r.id).status, "cancelling")
+
+    def test_to_read(self):
+        m = messages.create(thread_id="thread_1", message=messages.MessageCreate(role="user", content="hello", metadata={"k": "v"}))
+
+        with self.db.create_session() as session:
+            dbo = session.get(messages.Message, m.id)
+            session.commit()  # expires the loaded columns
+            r = dbo.to_read(messages.MessageRead)
+        self.assertEqual(r, m)
+        self.assertIsInstance(r.content[0], messages.MessageContent)
+        self.assertEqual(r.metadata, {"k": "v"})
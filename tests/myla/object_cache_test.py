@@ -0,0 +1,89 @@
+import asyncio
+
+import aiounittest
+
+from myla import assistants, persistence, threads
+from myla._object_cache import ObjectCache
+
+from .fake_redis import FakeRedis
+
+
+class TestObjectCache(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        persistence.Persistence._instance = self.db
+        ObjectCache._instance = ObjectCache(max_size=2, ttl=60)
+
+    def tearDown(self) -> None:
+        asyncio.run(self.db.dispose())
+        persistence.Persistence._instance = None
+        ObjectCache._instance = None
+
+    def test_read_through(self):
+        cache = ObjectCache.default()
+        t = threads.create(thread=threads.ThreadCreate(metadata={"k": "v"}), user_id="u1")
+
+        self.assertEqual(threads.get(id=t.id).metadata, {"k": "v"})
+        self.assertEqual(cache.metrics()["misses"], 1)
+        r = threads.get(id=t.id)
+        self.assertEqual(cache.metrics()["hits"], 1)
+
+        # Copies are returned
+        r.metadata["k"] = "changed"
+        self.assertEqual(threads.get(id=t.id).metadata, {"k": "v"})
+
+        # The owner is checked on hits
+        self.assertIsNotNone(threads.get(id=t.id, user_id="u1"))
+        self.assertIsNone(threads.get(id=t.id, user_id="u2"))
+
+    def test_invalidation(self):
+        t = threads.create(thread=threads.ThreadCreate(metadata={"k": "v"}))
+        threads.get(id=t.id)
+        threads.modify(id=t.id, thread=threads.ThreadModify(metadata={"k": "v2"}))
+        self.assertEqual(threads.get(id=t.id).metadata, {"k": "v2"})
+        threads.delete(id=t.id)
+        self.assertIsNone(threads.get(id=t.id))
+
+        a = assistants.create(assistants.AssistantCreate(name="a", model="m"))
+        self.assertEqual(assistants.get(id=a.id).name, "a")
+        assistants.modify(id=a.id, assistant=assistants.AssistantModify(name="b", model="m"))
+        self.assertEqual(assistants.get(id=a.id).name, "b")
+        assistants.delete(id=a.id)
+        self.assertIsNone(assistants.get(id=a.id))
+
+    async def test_async_and_lru(self):
+        cache = ObjectCache.default()
+        ts = [threads.create(thread=threads.ThreadCreate()) for _ in range(3)]
+        for t in ts:
+            self.assertEqual((await threads.aget(id=t.id)).id, t.id)
+        self.assertEqual(cache.metrics()["size"], 2)
+        self.assertIsNone(cache.get("thread", ts[0].id))
+        self.assertIsNotNone(cache.get("thread", ts[2].id))
+
+    def test_stale_read_not_cached(self):
+        cache = ObjectCache.default()
+        t = threads.create(thread=threads.ThreadCreate())
+        version = cache.version()
+        cache.invalidate("thread", t.id)
+        cache.put("thread", t.id, t, version=version)
+        self.assertIsNone(cache.get("thread", t.id))
+
+    async def test_invalidation_channel(self):
+        redis = FakeRedis()
+        c1 = ObjectCache(client=redis)
+        c2 = ObjectCache(client=redis)
+        tasks = [c1.start(), c2.start()]
+        await asyncio.sleep(0.01)
+
+        t = threads.create(thread=threads.ThreadCreate())
+        c2.put("thread", t.id, t, version=c2.version())
+        c1.invalidate("thread", t.id)
+        await asyncio.sleep(0.01)
+        self.assertIsNone(c2.get("thread", t.id))
+        self.assertEqual(c2.metrics()["invalidations"], 1)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
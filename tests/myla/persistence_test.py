@@ -1,86 +1,108 @@
 
-import sqlite3
+import os
+import tempfile
 import threading
 import unittest
 
-from myla import persistence, threads, utils
-
-db_file = "./tests/data/myla-test.db"
-stop = False
+from myla import persistence, threads
 
 
 class TestPersistence(unittest.TestCase):
     def setUp(self) -> None:
-
-        self.db = persistence.Persistence(database_url=f"sqlite:///{db_file}", connect_args={"timeout": 1})
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self._tmp.name, "myla-test.db")
+        self.db = persistence.Persistence(database_url=f"sqlite:///{self.db_file}", connect_args={"timeout": 1})
         self.db.initialize_database()
-        #with self.db.create_session() as session:
-        #    session.exec(text("PRAGMA journal_mode = WAL"))
 
     def tearDown(self) -> None:
-        #if os.path.exists(db_file):
-        #    os.remove(db_file)
-        #self.session.close()
-        pass
+        self.db.engine.dispose()
+        self._tmp.cleanup()
 
     def test_database_lock(self):
+        errors = []
 
         def _read_thread():
-            global stop
-            session = self.db.create_session()
-
-            while not stop:
+            with self.db.create_session() as session:
                 try:
-                    tl = threads.list(limit=100, session=session)
-                    print(f"list: {len(tl.data)}")
+                    for _ in range(100):
+                        threads.list(limit=100, session=session)
                 except Exception as e:
-                    #print(f"Read thread error: {e}")
-                    stop = True
-                    raise e
+                    errors.append(e)
 
         def _write_thread():
-            global stop
-            #db = persistence.Persistence(database_url=f"sqlite:///{db_file}")
-            session = self.db.create_session()
-
-            c = 0
-            while not stop:
+            with self.db.create_session() as session:
                 try:
-                    threads.create(thread=threads.ThreadCreate(), session=session)
-
-                    c += 1
-                    if c % 1000 == 0:
-                        print(f"Create threads: {c} {stop}")
+                    for _ in range(200):
+                        threads.create(thread=threads.ThreadCreate(), session=session)
                 except Exception as e:
-                    stop = True
                     session.rollback()
-                    raise e
+                    errors.append(e)
 
-        def _native_write_thread():
-            global stop
-            conn = sqlite3.connect(db_file, isolation_level=None)
-            #conn = self.db.engine.connect().connection
+        ts = [threading.Thread(target=_write_thread) for _ in range(3)]
+        ts.extend(threading.Thread(target=_read_thread) for _ in range(3))
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(errors, [])
 
-            c = 0
-            while not stop:
-                try:
-                    conn.execute("INSERT INTO thread (id) VALUES (?)", (utils.random_id(),))
+        with self.db.create_session() as session:
+            self.assertEqual(len(threads.list(limit=1000, session=session).data), 600)
 
-                    c += 1
-                    if c % 100 == 0:
-                        print(f"Native create threads: {c}")
 
-                    if c == 100000:
-                        stop = True
-                        print("stop")
-                except Exception as e:
-                    stop = True
-                    raise e
-
-        threading.Thread(target=_write_thread).start()
-        threading.Thread(target=_write_thread).start()
-        threading.Thread(target=_write_thread).start()
-        #threading.Thread(target=_native_write_thread).start()
-        threading.Thread(target=_read_thread).start()
-        threading.Thread(target=_read_thread).start()
-        threading.Thread(target=_read_thread).start()
+class TestPersistenceConfig(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._environ = dict(os.environ)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def test_sqlite_pragmas(self):
+        os.environ["SQLITE_BUSY_TIMEOUT"] = "1234"
+        db = persistence.Persistence(database_url="sqlite://")
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(conn.exec_driver_sql("PRAGMA synchronous").scalar(), 1)  # NORMAL
+            self.assertEqual(conn.exec_driver_sql("PRAGMA busy_timeout").scalar(), 1234)
+
+    def test_pool_args(self):
+        os.environ["DATABASE_POOL_SIZE"] = "3"
+        os.environ["DATABASE_MAX_OVERFLOW"] = "2"
+        db = persistence.Persistence(database_url="sqlite://")
+        self.assertEqual(db.engine.pool.size(), 3)
+        self.assertEqual(db.engine.pool._max_overflow, 2)
+        self.assertFalse(db.engine.pool._pre_ping)
+
+        db = persistence.Persistence(database_url="sqlite://", pool_args={"pool_pre_ping": True})
+        self.assertTrue(db.engine.pool._pre_ping)
+
+    def test_concurrent_writes(self):
+        db = persistence.Persistence(database_url="sqlite://")
+        db.initialize_database()
+        errors = []
+
+        def _write():
+            try:
+                for _ in range(50):
+                    with db.create_session() as session:
+                        threads.create(thread=threads.ThreadCreate(), session=session)
+            except Exception as e:
+                errors.append(e)
+
+        ts = [threading.Thread(target=_write) for _ in range(4)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(errors, [])
+
+        with db.create_session() as session:
+            self.assertEqual(len(threads.list(limit=1000, session=session).data), 200)
+
+        metrics = db.metrics()
+        self.assertEqual(metrics["sync"]["pool"], "QueuePool")
+        self.assertGreaterEqual(metrics["sync"]["checkouts"], 200)
+        self.assertEqual(metrics["sync"]["checkedout"], 0)
+        self.assertIsNone(metrics["async"])
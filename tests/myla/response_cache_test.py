@@ -0,0 +1,76 @@
+import aiounittest
+
+from myla._response_cache import ResponseCache
+from myla.vectorstores._embeddings import Embeddings
+
+
+class _Embeddings(Embeddings):
+    vectors = {
+        "How do I reset my password?": [1.0, 0.0, 0.1],
+        "how to reset my password": [1.0, 0.0, 0.12],
+        "What is the weather today?": [0.0, 1.0, 0.0],
+    }
+
+    def __init__(self) -> None:
+        self.embedded = []
+
+    def embed_batch(self, texts, **kwargs):
+        self.embedded.extend(texts)
+        return [self.vectors[t] for t in texts]
+
+
+def _messages(q):
+    return [{"role": "system", "content": "You are a FAQ bot."}, {"role": "user", "content": q}]
+
+
+class TestResponseCache(aiounittest.AsyncTestCase):
+
+    async def test_exact(self):
+        cache = ResponseCache(mode="exact")
+        args = {"temperature": 0.0}
+        self.assertIsNone(await cache.get("m", _messages("hi"), args))
+        await cache.put("m", _messages("hi"), args, "hello")
+
+        self.assertEqual(await cache.get("m", _messages("hi"), {"temperature": 0.0, "timeout": 10}), "hello")
+        self.assertIsNone(await cache.get("m", _messages("hi"), {"temperature": 0.5}))
+        self.assertIsNone(await cache.get("m2", _messages("hi"), args))
+
+        metrics = cache.metrics()
+        self.assertEqual(metrics["hits"], 1)
+        self.assertEqual(metrics["misses"], 3)
+
+    async def test_disabled(self):
+        cache = ResponseCache()
+        await cache.put("m", _messages("hi"), {}, "hello")
+        self.assertIsNone(await cache.get("m", _messages("hi"), {}))
+
+    async def test_lru_ttl(self):
+        cache = ResponseCache(mode="exact", max_size=2)
+        for q in ["a", "b"]:
+            await cache.put("m", _messages(q), {}, q)
+        await cache.get("m", _messages("a"), {})
+        await cache.put("m", _messages("c"), {}, "c")
+        self.assertEqual(await cache.get("m", _messages("a"), {}), "a")
+        self.assertIsNone(await cache.get("m", _messages("b"), {}))
+
+        cache = ResponseCache(mode="exact", ttl=0)
+        await cache.put("m", _messages("a"), {}, "a")
+        self.assertIsNone(await cache.get("m", _messages("a"), {}))
+
+    async def test_semantic(self):
+        cache = ResponseCache(mode="semantic", threshold=0.95, embeddings=_Embeddings())
+        await cache.put("m", _messages("How do I reset my password?"), {}, "Click 'Forgot password'.")
+
+        self.assertEqual(await cache.get("m", _messages("how to reset my password"), {}), "Click 'Forgot password'.")
+        self.assertIsNone(await cache.get("m", _messages("What is the weather today?"), {}))
+        self.assertEqual(cache.metrics()["semantic_hits"], 1)
+
+    async def test_semantic_embeds_once_per_miss(self):
+        embeddings = _Embeddings()
+        cache = ResponseCache(mode="semantic", embeddings=embeddings)
+        self.assertIsNone(await cache.get("m", _messages("How do I reset my password?"), {}))
+        await cache.put("m", _messages("How do I reset my password?"), {}, "Click 'Forgot password'.")
+        self.assertEqual(embeddings.embedded, ["How do I reset my password?"])
+
+        self.assertEqual(await cache.get("m", _messages("how to reset my password"), {}), "Click 'Forgot password'.")
+        self.assertEqual(len(embeddings.embedded), 2)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import aiounittest
+
+from myla import persistence, runs
+from myla._run_queue import DatabaseRunQueue, MemoryRunQueue, RedisRunQueue
+
+from .fake_redis import FakeRedis
+
+
+class TestRunQueue(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        self.session = self.db.create_session()
+        persistence.Persistence._instance = self.db
+
+    def tearDown(self) -> None:
+        self.session.close()
+        persistence.Persistence._instance = None
+
+    def _create_run(self):
+        time.sleep(0.002)  # distinct created_at
+        return runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"), session=self.session)
+
+    async def _test_fifo(self, queue):
+        created = [self._create_run() for _ in range(3)]
+        for r in created:
+            await queue.put(r)
+        self.assertEqual(await queue.qsize(), 3)
+
+        got = [await asyncio.wait_for(queue.get(), 1) for _ in range(3)]
+        self.assertEqual([r.id for r in got], [r.id for r in created])
+        self.assertEqual(await queue.qsize(), 0)
+
+    async def test_memory_run_queue(self):
+        await self._test_fifo(MemoryRunQueue())
+
+    async def test_memory_run_queue_dedup(self):
+        queue = MemoryRunQueue()
+        r = self._create_run()
+        await queue.put(r)
+        await queue.put(r)
+        self.assertEqual(await queue.qsize(), 1)
+
+        await queue.get()
+        await queue.put(r)
+        self.assertEqual(await queue.qsize(), 1)
+
+    def _tenant_run(self, id, org_id, priority=None):
+        return runs.RunRead(
+            id=id, object="thread.run", created_at=0, thread_id="thread_1", assistant_id="asst_1",
+            org_id=org_id, metadata={"priority": priority} if priority else None
+        )
+
+    async def _drain(self, queue):
+        return [(await queue.get()).id for _ in range(await queue.qsize())]
+
+    async def test_memory_run_queue_fair_share(self):
+        queue = MemoryRunQueue()
+        for i in range(4):
+            await queue.put(self._tenant_run(f"a_{i}", "org_a"))
+        for i in range(2):
+            await queue.put(self._tenant_run(f"b_{i}", "org_b"))
+        self.assertEqual(await self._drain(queue), ["a_0", "b_0", "a_1", "b_1", "a_2", "a_3"])
+
+    async def test_memory_run_queue_priority(self):
+        queue = MemoryRunQueue(priority_weights={"interactive": 10, "batch": 1})
+        for i in range(20):
+            await queue.put(self._tenant_run(f"batch_{i}", "org_a", priority="batch"))
+        await queue.get()
+        await queue.put(self._tenant_run("chat_0", "org_b"))
+        await queue.put(self._tenant_run("chat_1", "org_a", priority="interactive"))
+        self.assertEqual((await self._drain(queue))[:2], ["chat_0", "chat_1"])
+
+    async def test_memory_run_queue_tenant_weights(self):
+        queue = MemoryRunQueue(tenant_weights={"org_a": 2})
+        for i in range(4):
+            await queue.put(self._tenant_run(f"a_{i}", "org_a"))
+            await queue.put(self._tenant_run(f"b_{i}", "org_b"))
+        first = (await self._drain(queue))[:6]
+        self.assertEqual(len([id for id in first if id.startswith("a_")]), 4)
+
+    async def test_redis_run_queue(self):
+        await self._test_fifo(RedisRunQueue(client=FakeRedis(), timeout=0.1))
+
+    async def test_database_run_queue(self):
+        await self._test_fifo(DatabaseRunQueue(poll_interval=0.01))
+
+    async def test_database_run_queue_claims_once(self):
+        r = self._create_run()
+        q1 = DatabaseRunQueue(poll_interval=0.01)
+        q2 = DatabaseRunQueue(poll_interval=0.01)
+
+        claimed = await asyncio.wait_for(q1.get(), 1)
+        self.assertEqual(claimed.id, r.id)
+        self.assertEqual(claimed.status, "in_progress")
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(q2.get(), 0.1)
@@ -0,0 +1,311 @@
+import asyncio
+from datetime import datetime
+
+import aiounittest
+
+from myla import assistants, persistence, runs
+from myla._run_queue import DatabaseRunQueue
+from myla._run_scheduler import RunQueueFull, RunScheduler
+
+
+def _run(id, model="mock@mock"):
+    created_at = int(datetime.now().timestamp()*1000)
+    return runs.RunRead(id=id, object="thread.run", created_at=created_at, thread_id="thread_1", assistant_id="asst_1", model=model)
+
+
+class _BlockingScheduler(RunScheduler):
+    async def _run(self, run, iter):
+        runs.update(id=run.id, status="in_progress")
+        await iter.put("hello")
+        await asyncio.sleep(60)
+
+
+class _SlowScheduler(RunScheduler):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.executing = {}
+        self.max_executing = {}
+        self.executed = []
+        self.started = {}
+        self.delay = 0.01
+
+    async def _run(self, run, iter):
+        self.started[run.id] = datetime.now().timestamp()
+        key = run.model
+        self.executing[key] = self.executing.get(key, 0) + 1
+        self.max_executing[key] = max(self.max_executing.get(key, 0), self.executing[key])
+        total = sum(self.executing.values())
+        self.max_executing["*"] = max(self.max_executing.get("*", 0), total)
+        await asyncio.sleep(self.delay)
+        self.executing[key] -= 1
+        self.executed.append(run.id)
+
+
+class TestRunScheduler(aiounittest.AsyncTestCase):
+
+    def setUp(self) -> None:
+        self.db = persistence.Persistence(database_url="sqlite://")
+        self.db.initialize_database()
+        persistence.Persistence._instance = self.db
+
+    def tearDown(self) -> None:
+        asyncio.run(self.db.dispose())
+        persistence.Persistence._instance = None
+
+    async def _stop(self, scheduler, task):
+        # Executing runs hold database connections, they are finished before the loop is closed
+        tasks = [task, *scheduler._tasks.values()]
+        for t in tasks:
+            t.cancel()
+        reaper = scheduler._stream_bus.stop()
+        if reaper is not None:
+            tasks.append(reaper)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # A query of a cancelled task, e.g. a claim of DatabaseRunQueue, completes in the driver thread
+        await asyncio.sleep(0.05)
+
+    async def _drain(self, scheduler, n):
+        while len(scheduler.executed) < n:
+            await asyncio.sleep(0.01)
+
+    async def test_max_concurrency(self):
+        scheduler = _SlowScheduler(max_concurrency=2, model_concurrency={}, max_queue_size=0)
+        task = scheduler.start()
+        for i in range(10):
+            await scheduler.submit_run(_run(f"run_{i}"))
+        await asyncio.wait_for(self._drain(scheduler, 10), 5)
+        await self._stop(scheduler, task)
+
+        self.assertEqual(scheduler.max_executing["*"], 2)
+        metrics = await scheduler.metrics()
+        self.assertEqual(metrics["submitted"], 10)
+        self.assertEqual(metrics["finished"], 10)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertGreater(metrics["wait_time_max"], 0)
+
+    async def test_model_concurrency(self):
+        scheduler = _SlowScheduler(max_concurrency=0, model_concurrency={"a": 1, "*": 2}, max_queue_size=0)
+        task = scheduler.start()
+        for i in range(6):
+            await scheduler.submit_run(_run(f"run_a_{i}", model="a"))
+            await scheduler.submit_run(_run(f"run_b_{i}", model="b"))
+        await asyncio.wait_for(self._drain(scheduler, 12), 5)
+        await self._stop(scheduler, task)
+
+        self.assertEqual(scheduler.max_executing["a"], 1)
+        self.assertEqual(scheduler.max_executing["b"], 2)
+
+    async def test_model_concurrency_with_max_concurrency(self):
+        scheduler = _SlowScheduler(max_concurrency=2, model_concurrency={"a": 1}, max_queue_size=0)
+        scheduler.delay = 0.2
+        task = scheduler.start()
+        for id in ["run_a1", "run_a2", "run_a3"]:
+            await scheduler.submit_run(_run(id, model="a"))
+        await scheduler.submit_run(_run("run_b1", model="b"))
+        await asyncio.wait_for(self._drain(scheduler, 4), 5)
+        await self._stop(scheduler, task)
+
+        # b1 is not kept waiting by the runs of the busy model
+        self.assertLess(scheduler.started["run_b1"], scheduler.started["run_a2"])
+        self.assertEqual([id for id in scheduler.executed if id.startswith("run_a")], ["run_a1", "run_a2", "run_a3"])
+        self.assertEqual(scheduler.max_executing["a"], 1)
+        self.assertEqual(scheduler.max_executing["*"], 2)
+        self.assertEqual((await scheduler.metrics())["finished"], 4)
+
+    async def test_queue_full(self):
+        scheduler = _SlowScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=2)
+        await scheduler.submit_run(_run("run_1"))
+        await scheduler.submit_run(_run("run_2"))
+        self.assertTrue(await scheduler.is_full())
+        with self.assertRaises(RunQueueFull):
+            await scheduler.submit_run(_run("run_3"))
+        self.assertEqual((await scheduler.metrics())["rejected"], 1)
+
+        task = scheduler.start()
+        await asyncio.wait_for(self._drain(scheduler, 2), 5)
+        await self._stop(scheduler, task)
+        self.assertFalse(await scheduler.is_full())
+
+    async def test_stream_registered_on_submit(self):
+        scheduler = _SlowScheduler(max_concurrency=0, model_concurrency={}, max_queue_size=0)
+        await scheduler.submit_run(_run("run_1"))
+        self.assertIsNotNone(await scheduler.get_run_iter("run_1"))
+        self.assertIsNone(await scheduler.get_run_iter("run_2"))
+
+    async def _wait_status(self, run_id, status):
+        while await runs.aget_status(id=run_id) != status:
+            await asyncio.sleep(0.01)
+
+    async def _wait_parked(self, scheduler):
+        while not scheduler._parked:
+            await asyncio.sleep(0.01)
+
+    async def _read(self, scheduler, run_id):
+        return [c async for _, c in await scheduler.get_run_iter(run_id)]
+
+    async def test_cancel_in_progress(self):
+        scheduler = _BlockingScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0)
+        task = scheduler.start()
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r)
+        await asyncio.wait_for(self._wait_status(r.id, "in_progress"), 5)
+
+        self.assertEqual(runs.cancel(thread_id="thread_1", run_id=r.id).status, "cancelling")
+        self.assertTrue(await scheduler.cancel_run(r.id))
+        await asyncio.wait_for(self._wait_status(r.id, "cancelled"), 5)
+
+        chunks = await asyncio.wait_for(self._read(scheduler, r.id), 5)
+        self.assertEqual(chunks[0], "hello")
+        self.assertIsInstance(chunks[-1], Exception)
+        self.assertIsNotNone(runs.get(thread_id="thread_1", run_id=r.id).cancelled_at)
+
+        # the slot is released
+        r2 = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r2)
+        await asyncio.wait_for(self._wait_status(r2.id, "in_progress"), 5)
+        self.assertEqual((await scheduler.metrics())["cancelled"], 1)
+        self.assertFalse(await scheduler.cancel_run(r.id))
+        await self._stop(scheduler, task)
+
+    async def test_cancel_queued(self):
+        scheduler = _SlowScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0)
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r)
+        self.assertEqual(runs.cancel(thread_id="thread_1", run_id=r.id).status, "cancelled")
+        await scheduler.close_cancelled(r.id)
+
+        # closed before the run is dequeued
+        chunks = await asyncio.wait_for(self._read(scheduler, r.id), 5)
+        self.assertIsInstance(chunks[-1], Exception)
+
+        task = scheduler.start()
+        # The dequeued run is skipped
+        while scheduler._finished < 1 or scheduler._tasks:
+            await asyncio.sleep(0.01)
+        await self._stop(scheduler, task)
+        self.assertEqual(scheduler.executed, [])
+        self.assertEqual(len(await asyncio.wait_for(self._read(scheduler, r.id), 5)), 1)
+        self.assertEqual((await scheduler.metrics())["cancelled"], 1)
+
+        # Cancelled once
+        await scheduler._set_cancelled(run=r, iter=await scheduler._stream_bus.open(r.id))
+        self.assertEqual((await scheduler.metrics())["cancelled"], 1)
+
+    async def test_cancel_queued_durable_queue(self):
+        scheduler = _SlowScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, run_queue=DatabaseRunQueue(), cancel_poll_interval=0)
+        task = scheduler.start()
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        self.assertEqual(runs.cancel(thread_id="thread_1", run_id=r.id).status, "cancelled")
+        await scheduler.close_cancelled(r.id)
+
+        chunks = await asyncio.wait_for(self._read(scheduler, r.id), 5)
+        await self._stop(scheduler, task)
+        self.assertIsInstance(chunks[-1], Exception)
+        self.assertEqual(scheduler.executed, [])
+
+    async def test_cancel_parked(self):
+        scheduler = _BlockingScheduler(max_concurrency=2, model_concurrency={"*": 1}, max_queue_size=0, cancel_poll_interval=0)
+        task = scheduler.start()
+        r1 = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        r2 = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r1)
+        await scheduler.submit_run(r2)
+        await asyncio.wait_for(self._wait_status(r1.id, "in_progress"), 5)
+        await asyncio.wait_for(self._wait_parked(scheduler), 5)
+
+        self.assertTrue(await scheduler.cancel_run(r2.id))
+        chunks = await asyncio.wait_for(self._read(scheduler, r2.id), 5)
+        self.assertIsInstance(chunks[-1], Exception)
+        self.assertEqual(await runs.aget_status(id=r2.id), "cancelled")
+        self.assertEqual(await scheduler.queue_depth(), 0)
+        await self._stop(scheduler, task)
+
+    async def test_cancel_from_other_worker(self):
+        scheduler = _BlockingScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0.01)
+        task = scheduler.start()
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r)
+        await asyncio.wait_for(self._wait_status(r.id, "in_progress"), 5)
+
+        runs.cancel(thread_id="thread_1", run_id=r.id)
+        await asyncio.wait_for(self._wait_status(r.id, "cancelled"), 5)
+        await self._stop(scheduler, task)
+
+    async def test_expire_in_progress(self):
+        scheduler = _BlockingScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0)
+        task = scheduler.start()
+        run = runs.RunCreate(assistant_id="asst_1", metadata={"timeout": 1})
+        r = runs.create(thread_id="thread_1", run=run, timeout=await scheduler.resolve_timeout(run))
+        self.assertEqual(r.expires_at, int(r.created_at / 1000 + 1))
+        await scheduler.submit_run(r)
+
+        await asyncio.wait_for(self._wait_status(r.id, "expired"), 5)
+        chunks = await asyncio.wait_for(self._read(scheduler, r.id), 5)
+        self.assertIsInstance(chunks[-1], Exception)
+
+        # the slot is released
+        r2 = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        await scheduler.submit_run(r2)
+        await asyncio.wait_for(self._wait_status(r2.id, "in_progress"), 5)
+        self.assertEqual((await scheduler.metrics())["expired"], 1)
+        await self._stop(scheduler, task)
+
+    async def test_expire_queued(self):
+        scheduler = _SlowScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0)
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        r.expires_at = int(datetime.now().timestamp()) - 1
+        await scheduler.submit_run(r)
+
+        task = scheduler.start()
+        await asyncio.wait_for(self._wait_status(r.id, "expired"), 5)
+        await self._stop(scheduler, task)
+        self.assertEqual(scheduler.executed, [])
+
+    async def test_resolve_timeout(self):
+        scheduler = RunScheduler(timeout=30)
+        a = assistants.create(assistants.AssistantCreate(name="a", model="mock@mock", metadata={"timeout": 60}))
+        self.assertEqual(await scheduler.resolve_timeout(_run("run_1")), 30)
+        r = _run("run_2")
+        r.assistant_id = a.id
+        self.assertEqual(await scheduler.resolve_timeout(r), 60)
+        r.metadata = {"timeout": 10}
+        self.assertEqual(await scheduler.resolve_timeout(r), 10)
+        self.assertEqual(await scheduler.resolve_timeout(runs.RunCreate(assistant_id=a.id)), 60)
+        self.assertIsNone(runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id=a.id), timeout=0).expires_at)
+
+    def _create_run(self, status, expires_at=None):
+        r = runs.create(thread_id="thread_1", run=runs.RunCreate(assistant_id="asst_1"))
+        runs.update(id=r.id, status=status, expires_at=expires_at)
+        return r.id
+
+    async def test_recover_memory_queue(self):
+        queued = self._create_run("queued")
+        in_progress = self._create_run("in_progress")
+        cancelling = self._create_run("cancelling")
+        self._create_run("completed")
+
+        scheduler = _SlowScheduler(max_concurrency=1, model_concurrency={}, max_queue_size=0, cancel_poll_interval=0)
+        self.assertEqual(await scheduler.recover(), {"requeued": 1, "failed": 1, "cancelled": 1})
+        # idempotent
+        self.assertEqual((await scheduler.recover())["requeued"], 1)
+        self.assertEqual(await scheduler.queue_depth(), 1)
+
+        self.assertEqual(await runs.aget_status(id=in_progress), "failed")
+        self.assertEqual(await runs.aget_status(id=cancelling), "cancelled")
+
+        task = scheduler.start()
+        await asyncio.wait_for(self._drain(scheduler, 1), 5)
+        await self._stop(scheduler, task)
+        self.assertEqual(scheduler.executed, [queued])
+
+    async def test_recover_durable_queue(self):
+        now = int(datetime.now().timestamp())
+        queued = self._create_run("queued")
+        running = self._create_run("in_progress", expires_at=now + 600)
+        orphaned = self._create_run("in_progress", expires_at=now - 1)
+
+        scheduler = RunScheduler(run_queue=DatabaseRunQueue(), cancel_poll_interval=0)
+        self.assertEqual(await scheduler.recover(), {"requeued": 0, "failed": 1, "cancelled": 0})
+        self.assertEqual(await runs.aget_status(id=queued), "queued")
+        self.assertEqual(await runs.aget_status(id=running), "in_progress")
+        self.assertEqual(await runs.aget_status(id=orphaned), "failed")
@@ -0,0 +1,150 @@
+import asyncio
+import tempfile
+
+import aiounittest
+
+from myla._stream_bus import FileStreamBus, LocalStreamBus, RedisStreamBus, RunStream, RunStreamError
+
+from .fake_redis import FakeRedis
+
+
+class TestStreamBus(aiounittest.AsyncTestCase):
+
+    async def _test_stream(self, bus):
+        self.assertIsNone(await bus.get("run_1"))
+
+        writer = await bus.open("run_1")
+        reader = await bus.get("run_1")
+        self.assertIsNotNone(reader)
+
+        async def _write():
+            for c in ["a", "b", "c"]:
+                await writer.put(c)
+                await asyncio.sleep(0.01)
+            await writer.put(ValueError("error"))
+            await writer.put(None)
+
+        asyncio.create_task(_write())
+
+        late = await bus.get("run_1")
+
+        items = []
+        async for _, i in reader:
+            items.append(i)
+
+        self.assertEqual(items[:3], ["a", "b", "c"])
+        self.assertIsInstance(items[3], Exception)
+        self.assertEqual(str(items[3]), "error")
+
+        # Every reader gets all the chunks
+        events = [e async for e in late]
+        self.assertEqual([i for _, i in events][:3], ["a", "b", "c"])
+
+        # Resume after the second chunk
+        resumed = [i async for _, i in await bus.get("run_1", after=events[1][0])]
+        self.assertEqual(resumed[0], "c")
+        self.assertEqual(len(resumed), 2)
+
+    async def test_local_stream_bus(self):
+        await self._test_stream(LocalStreamBus())
+
+    async def test_file_stream_bus(self):
+        with tempfile.TemporaryDirectory() as path:
+            await self._test_stream(FileStreamBus(path=path, poll_interval=0.01))
+
+    async def test_file_stream_bus_invalid_run_id(self):
+        with tempfile.TemporaryDirectory() as path:
+            bus = FileStreamBus(path=path)
+            with self.assertRaises(ValueError):
+                await bus.get("../run_1")
+
+    async def test_redis_stream_bus(self):
+        await self._test_stream(RedisStreamBus(client=FakeRedis(), block=100))
+
+    async def test_redis_stream_error(self):
+        bus = RedisStreamBus(client=FakeRedis(), block=100)
+        writer = await bus.open("run_1")
+        await writer.put(ValueError("error"))
+        await writer.put(None)
+
+        items = [i async for _, i in await bus.get("run_1")]
+        self.assertEqual(len(items), 1)
+        self.assertIsInstance(items[0], RunStreamError)
+
+
+class TestRunStream(aiounittest.AsyncTestCase):
+
+    async def test_replay_size(self):
+        stream = RunStream(replay_size=2)
+        for c in ["a", "b", "c"]:
+            await stream.put(c)
+        await stream.put(None)
+
+        events = [e async for e in stream.subscribe()]
+        self.assertEqual(events, [("2", "b"), ("3", "c")])
+
+        events = [e async for e in stream.subscribe(after="2")]
+        self.assertEqual(events, [("3", "c")])
+
+    async def test_concurrent_subscribers(self):
+        stream = RunStream()
+
+        async def _read():
+            return [c async for _, c in stream.subscribe()]
+
+        readers = [asyncio.create_task(_read()) for _ in range(3)]
+        await asyncio.sleep(0)
+        for c in ["a", "b", "c"]:
+            await stream.put(c)
+        await stream.put(None)
+
+        for r in await asyncio.gather(*readers):
+            self.assertEqual(r, ["a", "b", "c"])
+
+
+class TestLocalStreamBusExpiry(aiounittest.AsyncTestCase):
+
+    async def test_expires(self):
+        bus = LocalStreamBus(expires=10, linger=1)
+        stream = await bus.open("run_1")
+        self.assertEqual(bus.reap(now=stream.created_at + 5), [])
+        self.assertEqual(bus.reap(now=stream.created_at + 11), ["run_1"])
+        self.assertIsNone(await bus.get("run_1"))
+        self.assertEqual(len(bus), 0)
+
+    async def test_stop(self):
+        bus = LocalStreamBus()
+        reaper = bus.start()
+        self.assertIs(bus.stop(), reaper)
+        await asyncio.gather(reaper, return_exceptions=True)
+        self.assertTrue(reaper.cancelled())
+        self.assertIsNone(bus.stop())
+
+    async def test_released_after_consumer_finished(self):
+        bus = LocalStreamBus(expires=600, linger=0)
+        writer = await bus.open("run_1")
+        reader = await bus.get("run_1")
+
+        await writer.put("a")
+        await writer.put(None)
+        self.assertEqual([c async for _, c in reader], ["a"])
+
+        bus.reap()
+        self.assertIsNone(await bus.get("run_1"))
+
+    async def test_kept_while_consumer_reading(self):
+        bus = LocalStreamBus(expires=600, linger=0)
+        writer = await bus.open("run_1")
+        reader = (await bus.get("run_1")).__aiter__()
+
+        await writer.put("a")
+        self.assertEqual(await reader.__anext__(), ("1", "a"))
+        await writer.put(None)
+
+        bus.reap()
+        self.assertIsNotNone(await bus.get("run_1"))
+
+        with self.assertRaises(StopAsyncIteration):
+            await reader.__anext__()
+        bus.reap()
+        self.assertIsNone(await bus.get("run_1"))
@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+
+import aiounittest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from myla.tools import CircuitBreaker, Context, HTTPTool
+
+
+class TestHTTPTool(aiounittest.AsyncTestCase):
+
+    async def _server(self, handler):
+        app = web.Application()
+        app.router.add_post("/tool", handler)
+        server = TestServer(app)
+        await server.start_server()
+        return server
+
+    async def test_context_round_trip(self):
+        received = {}
+
+        async def handler(request):
+            received.update(await request.json())
+            return web.json_response({
+                "messages": received["messages"] + [{"role": "system", "content": "from tool"}],
+                "llm_args": {"temperature": 0.5},
+                "message_metadata": {"tool": True}
+            })
+
+        server = await self._server(handler)
+        try:
+            tool = HTTPTool(url=str(server.make_url("/tool")))
+            context = Context(messages=[{"role": "user", "content": "hi"}], run_metadata={"k": "v"}, llm_args={"top_p": 1})
+            await tool.execute(context)
+        finally:
+            await server.close()
+
+        self.assertEqual(received["run_metadata"], {"k": "v"})
+        self.assertNotIn("assistant", received)
+        self.assertEqual(context.messages[-1]["content"], "from tool")
+        self.assertEqual(context.llm_args, {"top_p": 1, "temperature": 0.5})
+        self.assertEqual(context.message_metadata, {"tool": True})
+
+    async def test_timeout_and_circuit_breaker(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(1)
+            await asyncio.sleep(1)
+            return web.json_response({})
+
+        server = await self._server(handler)
+        try:
+            tool = HTTPTool(url=str(server.make_url("/tool")), timeout=0.05, failure_threshold=2, recovery_time=60)
+            context = Context(messages=[{"role": "user", "content": "hi"}])
+            for _ in range(4):
+                await tool.execute(context)
+        finally:
+            await server.close()
+
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(tool.circuit_breaker.is_open)
+        self.assertEqual(context.messages, [{"role": "user", "content": "hi"}])
+
+    async def test_cancelled_probe(self):
+        async def handler(request):
+            await asyncio.sleep(60)
+            return web.json_response({})
+
+        server = await self._server(handler)
+        try:
+            tool = HTTPTool(url=str(server.make_url("/tool")), timeout=60, failure_threshold=1, recovery_time=0)
+            tool.circuit_breaker.record_failure()
+            context = Context(messages=[{"role": "user", "content": "hi"}])
+
+            task = asyncio.create_task(tool.execute(context))  # probe
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        finally:
+            await server.close()
+
+        self.assertTrue(tool.circuit_breaker.is_open)
+        self.assertTrue(tool.circuit_breaker.allow())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+
+        self.assertTrue(breaker.allow())  # probe
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
@@ -0,0 +1,53 @@
+import os
+import statistics
+import sys
+from datetime import datetime
+
+here = os.path.abspath(os.path.dirname(__file__))
+data_dir = os.path.join(here, 'data')
+os.makedirs(data_dir, exist_ok=True)
+
+os.environ['DATA_DIR'] = data_dir
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(data_dir, 'run_stream.db')}"
+os.environ['DEFAULT_LLM_MODEL_NAME'] = 'mock@mock'
+
+from starlette.testclient import TestClient  # noqa: E402
+
+from myla import entry  # noqa: E402
+
+
+def login(client):
+    r = client.post("/api/v1/users/admin/login", json={"username": "admin", "password": "admin"})
+    sk = r.json()["secret_key"]["id"]
+    return {"Authorization": f"Bearer {sk}"}
+
+
+def test_stream_ttfb(n=100):
+    """Time to first byte of streaming runs against the mock LLM."""
+    with TestClient(entry) as client:
+        headers = login(client)
+        assistant = client.post("/api/v1/assistants", json={"model": "mock@mock"}, headers=headers).json()
+        thread = client.post("/api/v1/threads", json={}, headers=headers).json()
+        client.post(f"/api/v1/threads/{thread['id']}/messages", json={"role": "user", "content": "hello"}, headers=headers)
+
+        ttfb = []
+        total = []
+        for _ in range(n):
+            begin = datetime.now().timestamp()
+            first = None
+            with client.stream("POST", f"/api/v1/threads/{thread['id']}/runs?stream=true", json={"assistant_id": assistant["id"]}, headers=headers) as resp:
+                for line in resp.iter_lines():
+                    if first is None and line.startswith("data:"):
+                        first = datetime.now().timestamp()
+            end = datetime.now().timestamp()
+            ttfb.append(first - begin)
+            total.append(end - begin)
+
+        ttfb.sort()
+        print(f"RUN_STREAM_BUS={os.environ.get('RUN_STREAM_BUS', 'local')} runs={n}")
+        print(f"ttfb   p50={statistics.median(ttfb)*1000:.1f}ms p95={ttfb[int(n*0.95)-1]*1000:.1f}ms max={ttfb[-1]*1000:.1f}ms")
+        print(f"total  p50={statistics.median(total)*1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    test_stream_ttfb(n=int(sys.argv[1]) if len(sys.argv) > 1 else 100)
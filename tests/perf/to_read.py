@@ -0,0 +1,61 @@
+import sys
+import time
+
+from sqlmodel import select
+
+from myla import messages, persistence
+
+
+def legacy_to_read(dbo, read_cls):
+    """The conversion replaced by DBModel.to_read: dump then validate."""
+    r = read_cls(**dbo.model_dump())
+    r.metadata = dbo.metadata_
+    return r
+
+
+def best_of(fn, repeat=5):
+    ts = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        ts.append(time.perf_counter() - begin)
+    return min(ts)
+
+
+def convert(to_read, dbos):
+    return len([to_read(dbo, messages.MessageRead) for dbo in dbos])
+
+
+def test_to_read(n=10000, page_size=100):
+    """Convert n messages loaded from database to MessageRead."""
+    db = persistence.Persistence(database_url="sqlite://")
+    db.initialize_database()
+
+    with db.create_session() as session:
+        for i in range(n):
+            m = messages._new(thread_id="thread_1", message=messages.MessageCreate(role="user", content=f"message {i}", metadata={"i": i}))
+            m.id = f"msg_{i}"
+            m.object = "thread.message"
+            m.created_at = i
+            session.add(m)
+        session.commit()
+
+    with db.create_session() as session:
+        dbos = session.exec(select(messages.Message)).all()
+        assert dbos[0].to_read(messages.MessageRead) == legacy_to_read(dbos[0], messages.MessageRead)
+
+        # Converted a page at a time, as the list endpoints do
+        pages = [dbos[i:i + page_size] for i in range(0, n, page_size)]
+        legacy = best_of(lambda: [convert(legacy_to_read, p) for p in pages])
+        current = best_of(lambda: [convert(messages.Message.to_read, p) for p in pages])
+        page = messages.MessageList(data=[dbo.to_read(messages.MessageRead) for dbo in dbos])
+        serialize = best_of(lambda: page.model_dump_json())
+
+    print(f"rows={n} page_size={page_size}")
+    print(f"dump + validate  {legacy*1000:.1f}ms {legacy/n*1e6:.1f}us/row")
+    print(f"to_read          {current*1000:.1f}ms {current/n*1e6:.1f}us/row x{legacy/current:.2f}")
+    print(f"json             {serialize*1000:.1f}ms {serialize/n*1e6:.1f}us/row")
+
+
+if __name__ == '__main__':
+    test_to_read(n=int(sys.argv[1]) if len(sys.argv) > 1 else 10000)